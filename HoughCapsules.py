@@ -1,7 +1,9 @@
+import functools
 import torch
 import torch.nn.functional as F
 from torch import nn
 import numpy as np
+from packed_points import PackedPoints, InstanceMasks
 
 
 def get_centers(center_map, top_k=200):
@@ -20,7 +22,8 @@ def get_centers(center_map, top_k=200):
 
     center_errors = center_map[center_coords[:, 0], center_coords[:, 1]]  # Obtains the errors for the given points
 
-    top_k_inds = torch.argsort(center_errors, descending=False)[:top_k]  # obtains the k indices of centers with least error
+    # obtains the k indices of centers with least error, centers with equal errors stay in raster order
+    top_k_inds = torch.argsort(center_errors, descending=False, stable=True)[:top_k]
 
     sorted_center_coords = center_coords[top_k_inds]
     sorted_center_errors = center_errors[top_k_inds]
@@ -28,61 +31,397 @@ def get_centers(center_map, top_k=200):
     return sorted_center_coords, sorted_center_errors
 
 
-def create_inst_maps(center_coords_pred, center_coords, things_segs):
+def get_batch_centers(center_maps, top_k=200):
+    """
+    Obtains the centers of all images of a batch at once, in the same order as get_centers.
+
+    :param center_maps: The center maps of a batch with shape (B, H, W), see get_centers.
+    :param top_k: The number of centers which will be obtained per image.
+    :return: The center coordinates (B, K, 2) in y-x order, their errors (B, K) and a mask (B, K) of the valid centers,
+    where the centers of every image are padded to the largest number of centers K in the batch.
+    """
+    b = center_maps.shape[0]
+
+    center_coords = torch.nonzero(center_maps, as_tuple=False)  # (N, 3) in batch, then raster order
+    center_errors = center_maps[center_coords[:, 0], center_coords[:, 1], center_coords[:, 2]]
+
+    # sorts by batch index, then error, then raster order
+    order = torch.argsort(center_errors, stable=True)
+    order = order[torch.argsort(center_coords[order, 0], stable=True)]
+    center_coords, center_errors = center_coords[order], center_errors[order]
+
+    batch_inds = center_coords[:, 0]
+    counts = torch.bincount(batch_inds, minlength=b)
+    ranks = torch.arange(len(batch_inds), device=batch_inds.device) - (torch.cumsum(counts, 0) - counts)[batch_inds]
+    top = ranks < top_k
+
+    k = min(top_k, int(counts.max())) if len(batch_inds) != 0 else 0
+
+    batch_coords = torch.zeros((b, k, 2), dtype=torch.long, device=center_maps.device)
+    batch_errors = torch.zeros((b, k), dtype=center_maps.dtype, device=center_maps.device)
+    valid = torch.zeros((b, k), dtype=torch.bool, device=center_maps.device)
+
+    batch_coords[batch_inds[top], ranks[top]] = center_coords[top, 1:]
+    batch_errors[batch_inds[top], ranks[top]] = center_errors[top]
+    valid[batch_inds[top], ranks[top]] = True
+
+    return batch_coords, batch_errors, valid
+
+
+def assign_nearest_centers(coords_pred, center_coords, max_memory_mb=64):
+    """
+    Finds the closest center of every center prediction by brute force.
+
+    :param coords_pred: The center predictions with shape (2, N) in x-y order.
+    :param center_coords: The list of center coordinates (K, 2) in y-x order.
+    :param max_memory_mb: The memory ceiling of the distances, the predictions are processed in chunks which fit into it.
+    :return: The index of the closest center of every prediction (N, ), the first one when several are equally close.
+    """
+    k, _ = center_coords.shape
+    x_centers, y_centers = center_coords[:, 1], center_coords[:, 0]
+
+    # the squared distances, the differences and the boolean tie mask of a chunk of pixels
+    chunk_size = max(1, int(max_memory_mb * 2 ** 20 // (k * (4 * coords_pred.element_size() + 1))))
+
+    closest_inds = torch.empty(coords_pred.shape[1], dtype=torch.long, device=coords_pred.device)
+    for start in range(0, coords_pred.shape[1], chunk_size):
+        x_pred, y_pred = coords_pred[:, start:start + chunk_size].unsqueeze(-1)  # (n, 1) each
+
+        dist = x_pred - x_centers
+        dist_y = y_pred - y_centers
+        dist = dist * dist + dist_y * dist_y  # squared distances (n, K)
+        del dist_y
+
+        min_dist, chunk_inds = torch.min(dist, -1)
+
+        # sqrt can round distinct squared distances to the same distance, where the first center is the closest one. Such
+        # ties are within a relative difference of 2^-21 of the minimum, and are resolved on the rounded distances.
+        ties = torch.nonzero((dist <= min_dist.unsqueeze(-1) * (1 + 2 ** -21)).sum(-1) > 1, as_tuple=False).squeeze(1)
+        if ties.shape[0] != 0:
+            chunk_inds[ties] = torch.argmin(torch.sqrt(dist[ties]), -1)
+
+        closest_inds[start:start + chunk_size] = chunk_inds
+
+    return closest_inds
+
+
+class CenterGrid(object):
+    """
+    A uniform grid over the centers, for finding the closest center of many center predictions.
+
+    The cells have about cell_scale^2 centers on average. A prediction is compared with the centers in the 3x3 cells
+    around it, and the result is exact if the closest of them is nearer than the border of those cells. The remaining
+    predictions (e.g. far away from all centers) fall back to assign_nearest_centers.
+    """
+    def __init__(self, center_coords, cell_scale=1.0):
+        """
+
+        :param center_coords: The list of center coordinates (K, 2) in y-x order.
+        """
+        self.center_coords = center_coords
+        self.x_centers, self.y_centers = center_coords[:, 1], center_coords[:, 0]
+        k = center_coords.shape[0]
+
+        self.x0, self.y0 = self.x_centers.min().item(), self.y_centers.min().item()
+        extent_x = self.x_centers.max().item() - self.x0 + 1
+        extent_y = self.y_centers.max().item() - self.y0 + 1
+
+        self.cell_size = max(1.0, np.sqrt(extent_x * extent_y / k) * cell_scale)
+        self.grid_w, self.grid_h = int(extent_x // self.cell_size) + 1, int(extent_y // self.cell_size) + 1
+
+        cell_x, cell_y = self.get_cells(self.x_centers, self.y_centers)
+        cell_ids = cell_y * self.grid_w + cell_x
+
+        # The centers of every cell, padded with -1 to the largest number of centers in a cell - Shape (G, C)
+        order = torch.argsort(cell_ids, stable=True)
+        counts = torch.bincount(cell_ids, minlength=self.grid_h * self.grid_w)
+        offsets = torch.cumsum(counts, 0) - counts
+        positions = torch.arange(k, device=cell_ids.device) - offsets[cell_ids[order]]
+
+        cell_centers = torch.full((self.grid_h * self.grid_w, int(counts.max())), -1, dtype=torch.long, device=cell_ids.device)
+        cell_centers[cell_ids[order], positions] = order
+
+        # The centers of the 3x3 cells around every cell - Shape (G, 9C)
+        grid_y, grid_x = torch.meshgrid(torch.arange(self.grid_h, device=cell_ids.device), torch.arange(self.grid_w, device=cell_ids.device), indexing='ij')
+        neighbours = []
+        for dy in [-1, 0, 1]:
+            for dx in [-1, 0, 1]:
+                ny, nx = grid_y.reshape(-1) + dy, grid_x.reshape(-1) + dx
+                valid = (ny >= 0) & (ny < self.grid_h) & (nx >= 0) & (nx < self.grid_w)
+                neighbour_centers = cell_centers[(ny * self.grid_w + nx).clamp(0, self.grid_h * self.grid_w - 1)]
+                neighbours.append(torch.where(valid.unsqueeze(1), neighbour_centers, torch.full_like(neighbour_centers, -1)))
+        self.neighbour_centers = torch.cat(neighbours, 1)
+
+    def get_cells(self, x, y):
+        cell_x = torch.floor((x - self.x0) / self.cell_size).long().clamp(0, self.grid_w - 1)
+        cell_y = torch.floor((y - self.y0) / self.cell_size).long().clamp(0, self.grid_h - 1)
+        return cell_x, cell_y
+
+    def get_search_radius(self, x, y, cell_x, cell_y):
+        """
+
+        :return: The distance of the predictions to the border of the 3x3 cells around them, less a margin of one pixel for
+        rounding errors. Sides at the border of the grid are infinitely far away, since no centers lie beyond them.
+        """
+        inf = torch.full_like(x, float('inf'))
+
+        distances = [torch.where(cell_x > 0, x - (self.x0 + (cell_x - 1) * self.cell_size), inf),
+                     torch.where(cell_x < self.grid_w - 1, self.x0 + (cell_x + 2) * self.cell_size - x, inf),
+                     torch.where(cell_y > 0, y - (self.y0 + (cell_y - 1) * self.cell_size), inf),
+                     torch.where(cell_y < self.grid_h - 1, self.y0 + (cell_y + 2) * self.cell_size - y, inf)]
+
+        return (torch.stack(distances).min(0)[0] - 1).clamp(min=0)
+
+    def assign(self, coords_pred, max_memory_mb=64):
+        """
+
+        :param coords_pred: The center predictions with shape (2, N) in x-y order.
+        :return: The same closest center indices (N, ) as assign_nearest_centers.
+        """
+        n_candidates = self.neighbour_centers.shape[1]
+        if n_candidates >= len(self.x_centers):  # the cells are too coarse to skip any centers
+            return assign_nearest_centers(coords_pred, self.center_coords, max_memory_mb)
+
+        chunk_size = max(1, int(max_memory_mb * 2 ** 20 // (n_candidates * (5 * coords_pred.element_size() + 9))))
+
+        closest_inds = torch.empty(coords_pred.shape[1], dtype=torch.long, device=coords_pred.device)
+        certified = torch.empty(coords_pred.shape[1], dtype=torch.bool, device=coords_pred.device)
+        for start in range(0, coords_pred.shape[1], chunk_size):
+            x_pred, y_pred = coords_pred[:, start:start + chunk_size]
+
+            cell_x, cell_y = self.get_cells(x_pred, y_pred)
+            candidates = self.neighbour_centers[cell_y * self.grid_w + cell_x]  # (n, M)
+            valid = candidates >= 0
+            candidates = candidates.clamp(min=0)
+
+            dist = x_pred.unsqueeze(-1) - self.x_centers[candidates]
+            dist_y = y_pred.unsqueeze(-1) - self.y_centers[candidates]
+            dist = dist * dist + dist_y * dist_y  # squared distances (n, M)
+            del dist_y
+            dist[~valid] = float('inf')
+
+            min_dist, chunk_inds = torch.min(dist, -1)
+            chunk_inds = candidates.gather(1, chunk_inds.unsqueeze(1)).squeeze(1)
+
+            # As in assign_nearest_centers, near ties are resolved on the rounded distances, with the first center winning
+            ties = torch.nonzero((dist <= min_dist.unsqueeze(-1) * (1 + 2 ** -21)).sum(-1) > 1, as_tuple=False).squeeze(1)
+            if ties.shape[0] != 0:
+                tie_dist = torch.sqrt(dist[ties])
+                is_min = tie_dist == tie_dist.min(-1, keepdim=True)[0]
+                chunk_inds[ties] = torch.where(is_min, candidates[ties], torch.full_like(candidates[ties], len(self.x_centers))).min(-1)[0]
+
+            # every center which may tie with the closest candidate has to lie within the searched cells
+            radius = self.get_search_radius(x_pred, y_pred, cell_x, cell_y)
+            certified[start:start + chunk_size] = min_dist * (1 + 2 ** -20) < radius * radius
+
+            closest_inds[start:start + chunk_size] = chunk_inds
+
+        fallback = torch.nonzero(~certified, as_tuple=False).squeeze(1)
+        if fallback.shape[0] != 0:
+            closest_inds[fallback] = assign_nearest_centers(coords_pred[:, fallback], self.center_coords, max_memory_mb)
+
+        return closest_inds
+
+
+def create_inst_maps(center_coords_pred, center_coords, things_segs, max_memory_mb=64, center_index='brute_force'):
     """
 
     :param center_coords_pred: A map of center predictions with shape (2, H, W).
     :param center_coords: The list of center coordinates (N, 2)
     :param things_segs: A boolean map containing the foreground segmentation of shape (H, W).
+    :param max_memory_mb: The memory ceiling of the distances, the foreground pixels are processed in chunks which fit into it.
+    :param center_index: How the closest centers are found, either 'brute_force' or 'grid' (see CenterGrid). Both give
+    the same instance map.
     :return: Returns the instance map which maps all foreground pixels to the center which is closest to its prediction.
     """
+    h, w = things_segs.shape
 
-    center_coords_pred = center_coords_pred.unsqueeze(-1)  # (2, H, W, 1)
+    fg_inds = torch.nonzero(things_segs.reshape(-1), as_tuple=False).squeeze(1)  # only foreground pixels are assigned
 
-    k, _ = center_coords.shape
+    fg_coords_pred = center_coords_pred.reshape(2, -1)[:, fg_inds]  # (2, N)
+
+    if center_index == 'grid':
+        closest_inds = CenterGrid(center_coords).assign(fg_coords_pred, max_memory_mb)
+    else:
+        closest_inds = assign_nearest_centers(fg_coords_pred, center_coords, max_memory_mb)
+
+    instance_map = torch.zeros(h * w, dtype=torch.long, device=fg_inds.device)
+    instance_map[fg_inds] = closest_inds + 1
+
+    return instance_map.view(h, w)
+
+
+def assign_padded_centers(fg_coords_pred, batch_inds, counts, center_coords, valid, max_memory_mb=64):
+    """
+    Finds the closest center of the foreground pixels of all images at once, with the pixels and centers of every image
+    padded to the largest number in the batch.
+
+    :param fg_coords_pred: The center predictions of the foreground pixels of all images (2, N), grouped by image.
+    :param batch_inds: The image of every pixel (N, ).
+    :param counts: The number of pixels of every image (B, ).
+    :param center_coords: The padded center coordinates (B, K, 2), as returned by get_batch_centers.
+    :param valid: The mask of the valid centers (B, K).
+    :return: The index of the closest center of every pixel (N, ), the same as assign_nearest_centers for every image.
+    """
+    b, k = valid.shape
+
+    # the center predictions of the foreground pixels of every image, padded to the largest number of pixels - (B, 2, N)
+    ranks = torch.arange(len(batch_inds), device=fg_coords_pred.device) - (torch.cumsum(counts, 0) - counts)[batch_inds]
+    n = int(counts.max()) if len(batch_inds) != 0 else 0
+
+    padded_coords_pred = torch.zeros((b, 2, n), dtype=fg_coords_pred.dtype, device=fg_coords_pred.device)
+    padded_coords_pred[batch_inds, :, ranks] = fg_coords_pred.t()
+
+    x_centers, y_centers = center_coords[:, :, 1].unsqueeze(1), center_coords[:, :, 0].unsqueeze(1)  # (B, 1, K)
+    invalid = ~valid.unsqueeze(1)
+
+    # the squared distances, the differences and the boolean tie mask of a chunk of pixels
+    chunk_size = max(1, int(max_memory_mb * 2 ** 20 // (b * max(k, 1) * (4 * fg_coords_pred.element_size() + 1))))
+
+    closest_inds = torch.empty((b, n), dtype=torch.long, device=fg_coords_pred.device)
+    for start in range(0, n, chunk_size):
+        x_pred, y_pred = padded_coords_pred[:, :, start:start + chunk_size].unsqueeze(-1).unbind(1)  # (B, n, 1) each
+
+        dist = x_pred - x_centers
+        dist_y = y_pred - y_centers
+        dist = dist * dist + dist_y * dist_y  # squared distances (B, n, K)
+        del dist_y
+        dist.masked_fill_(invalid, float('inf'))  # the padding centers are never the closest
+
+        min_dist, chunk_inds = torch.min(dist, -1)
 
-    y_centers, x_centers = center_coords[:, 0], center_coords[:, 1]
+        # As in assign_nearest_centers, near ties are resolved on the rounded distances, with the first center winning
+        ties = torch.nonzero((dist <= min_dist.unsqueeze(-1) * (1 + 2 ** -21)).sum(-1) > 1, as_tuple=True)
+        if ties[0].shape[0] != 0:
+            chunk_inds[ties] = torch.argmin(torch.sqrt(dist[ties]), -1)
 
-    center_batch_t = torch.stack((x_centers, y_centers), 0).view(2, 1, 1, k)  # (2, 1, 1, K)
+        closest_inds[:, start:start + chunk_size] = chunk_inds
 
-    dist = center_coords_pred - center_batch_t  # (2, H, W, K)
-    dist = torch.sqrt(torch.sum(dist * dist, 0))  # (H, W, K)
+    return closest_inds[batch_inds, ranks]
 
-    closest_inds = torch.argmin(dist, -1) + 1  # (H, W)
 
-    instance_map = closest_inds.cuda() * things_segs.cuda()
+def create_batch_inst_maps(center_coords_pred, center_coords, valid, things_segs, max_memory_mb=64, padding_tolerance=1.25):
+    """
+    Creates the instance maps of all images of a batch at once, the same as create_inst_maps for every image.
+
+    :param center_coords_pred: The center predictions of shape (B, 2, H, W).
+    :param center_coords: The padded center coordinates (B, K, 2), as returned by get_batch_centers.
+    :param valid: The mask of the valid centers (B, K).
+    :param things_segs: The boolean foreground segmentations of shape (B, H, W).
+    :param max_memory_mb: The memory ceiling of the distances, the foreground pixels are processed in chunks which fit into it.
+    :param padding_tolerance: The largest ratio of the padded to the actual number of distances for which all images are
+    assigned at once.
+    :return: The instance maps (B, H, W), which are zero for images without centers.
+    """
+    b, _, h, w = center_coords_pred.shape
+    k = center_coords.shape[1]
+
+    # only the foreground pixels of images with centers are assigned
+    fg_inds = torch.nonzero((things_segs & valid.any(1).view(b, 1, 1)).reshape(-1), as_tuple=False).squeeze(1)
+    batch_inds, pixel_inds = fg_inds // (h * w), fg_inds % (h * w)
+
+    counts = torch.bincount(batch_inds, minlength=b)
+    fg_coords_pred = center_coords_pred.reshape(b, 2, h * w)[batch_inds, :, pixel_inds].t()  # (2, N) grouped by image
+
+    n_pixels, n_centers = counts.tolist(), valid.sum(1).tolist()  # the valid centers of every image come first
 
-    return instance_map
+    # Padding every image to the largest number of pixels and centers only pays off when they are similar, otherwise the
+    # images are assigned one after another (from the same gathered predictions)
+    if b * max(n_pixels) * k > padding_tolerance * sum(n * c for n, c in zip(n_pixels, n_centers)):
+        closest_inds = torch.cat([assign_nearest_centers(coords_pred, center_coords[i, :n_centers[i]], max_memory_mb)
+                                  for i, coords_pred in enumerate(torch.split(fg_coords_pred, n_pixels, 1)) if n_pixels[i] != 0])
+    else:
+        closest_inds = assign_padded_centers(fg_coords_pred, batch_inds, counts, center_coords, valid, max_memory_mb)
 
+    instance_maps = torch.zeros(b * h * w, dtype=torch.long, device=fg_inds.device)
+    instance_maps[fg_inds] = closest_inds + 1
 
-def get_instance_pixels(instance_map):
+    return instance_maps.view(b, h, w)
+
+
+def get_instance_pixels(instance_map, with_masks=True):
     """
+    Groups the pixels of all instances with a single stable sort of the foreground pixels by instance id.
 
     :param instance_map: An instance map of shape (H, W)
-    :return: Returns the points and segmentations for each instance in the instance map. The points are of shape (2, N)
-    and the segmentations are of shape (H, W).
+    :param with_masks: Whether the segmentation of every instance is also returned.
+    :return: Returns the points of all instances as PackedPoints (the points of each instance are of shape (2, N) in
+    raster order), and their segmentations as InstanceMasks cropped to the bounding box of each instance (or None).
     """
+    h, w = instance_map.shape
 
-    point_list = []
-    segmentation_list = []
+    flat_instances = instance_map.reshape(-1)
+    fg_inds = torch.nonzero(flat_instances, as_tuple=False).squeeze(1)  # in raster order
 
-    unique_insts = torch.unique(instance_map)
+    order = torch.argsort(flat_instances[fg_inds], stable=True)
+    fg_inds = fg_inds[order]
 
-    for inst in unique_insts:
-        if inst == 0:
-            continue
+    _, counts = torch.unique_consecutive(flat_instances[fg_inds], return_counts=True)
+    offsets = torch.cat((torch.zeros(1, dtype=torch.long, device=counts.device), torch.cumsum(counts, 0)))
+
+    point_list = PackedPoints(fg_inds.int(), offsets, (h, w))
 
-        inst_map = (instance_map == inst)
+    if not with_masks:
+        return point_list, None
 
-        pixels = torch.stack(torch.where(inst_map), 0)
+    return point_list, InstanceMasks.from_packed_points(point_list)
 
-        inst_map = inst_map.type(torch.uint8)
 
-        point_list.append(pixels)
-        segmentation_list.append(inst_map)
+def get_batch_instance_pixels(instance_maps, with_masks=True):
+    """
+    The same as get_instance_pixels for every image of a batch, with a single stable sort of all foreground pixels by
+    image and instance id.
+
+    :param instance_maps: The instance maps of shape (B, H, W).
+    :param with_masks: Whether the segmentations of the instances are also returned.
+    :return: A list with the PackedPoints and InstanceMasks (or None) of every image.
+    """
+    b, h, w = instance_maps.shape
+
+    flat_instances = instance_maps.reshape(-1)
+    fg_inds = torch.nonzero(flat_instances, as_tuple=False).squeeze(1)  # in batch, then raster order
+
+    n_ids = int(flat_instances.max()) + 1 if fg_inds.shape[0] != 0 else 1
+    keys = (fg_inds // (h * w)) * n_ids + flat_instances[fg_inds]
+
+    order = torch.argsort(keys, stable=True)
+    fg_inds, keys = fg_inds[order], keys[order]
+
+    segment_keys, counts = torch.unique_consecutive(keys, return_counts=True)
+    offsets = torch.cat((torch.zeros(1, dtype=torch.long, device=counts.device), torch.cumsum(counts, 0)))
+
+    # the first instance of every image, and the first instance after the last image
+    image_segments = torch.cumsum(torch.bincount(segment_keys // n_ids, minlength=b), 0).tolist()
+
+    outputs = []
+    for i in range(b):
+        first, last = (image_segments[i - 1] if i > 0 else 0), image_segments[i]
+        pixel_start = offsets[first]
+
+        point_list = PackedPoints((fg_inds[offsets[first]:offsets[last]] - i * h * w).int(), offsets[first:last + 1] - pixel_start, (h, w))
+        outputs.append((point_list, InstanceMasks.from_packed_points(point_list) if with_masks else None))
+
+    return outputs
+
+
+def from_numpy_outputs(outputs, with_masks=True):
+    """
+    Converts the outputs of hough_numpy.group_images into the outputs of HoughRouting1.
+
+    :param outputs: The instance map and instance points of every image, or None for images without centers.
+    :return: The instance maps, point lists (PackedPoints) and segmentation lists (InstanceMasks or None) of the images.
+    """
+    results = []  # [(inst_map, point_list, segmentation_list)]
+    for output in outputs:
+        if output is None:
+            results.append(([], [], []))
+            continue
 
-    return point_list, segmentation_list
+        inst_map, fg_inds, offsets = output
+        point_list = PackedPoints(torch.from_numpy(fg_inds), torch.from_numpy(offsets), inst_map.shape)
+        results.append((torch.from_numpy(inst_map), point_list, InstanceMasks.from_packed_points(point_list) if with_masks else None))
 
+    return zip(*results)
 
 def get_patches(regressions, kernel_size=3):
     regressions = F.pad(regressions, [kernel_size//2, kernel_size//2, kernel_size//2, kernel_size//2])
@@ -99,65 +438,156 @@ def get_patches(regressions, kernel_size=3):
     return x
 
 
+def get_vote_errors(center_regressions, circle_coords, circle_mask, n_pixels_in_circle, band_rows=None):
+    """
+    Computes the mean center error of the circular region around each pixel, one band of rows at a time.
+
+    The neighbourhoods are strided views of the padded regressions, so only the center predictions of a band, of shape
+    (B, 2, band_rows, W, K, K), are materialized. The result is identical to computing all rows at once.
+
+    :param center_regressions: The center regressions of shape (B, 2, H, W).
+    :param circle_coords: The x-y offsets within the circle kernel of shape (1, 2, 1, 1, K, K).
+    :param circle_mask: The circle mask of shape (1, 1, 1, 1, K, K).
+    :param n_pixels_in_circle: The number of pixels inside the circle.
+    :param band_rows: The number of rows processed at once, None processes all rows.
+    :return: The mean center error of shape (B, 1, H, W).
+    """
+    b, _, h, w = center_regressions.shape
+    k_size = circle_coords.shape[-1]
+    band_rows = h if band_rows is None else max(1, band_rows)
+
+    regressions = F.pad(center_regressions, [k_size//2, k_size//2, k_size//2, k_size//2])
+
+    errors = []
+    for y0 in range(0, h, band_rows):
+        y1 = min(y0 + band_rows, h)
+
+        regression_patches = regressions[:, :, y0:y1 + k_size - 1].unfold(2, k_size, 1).unfold(3, k_size, 1)  # (B, 2, rows, W, K, K)
+
+        patches_offset = circle_coords - regression_patches  # converts regressions into center predictions
+
+        patches_offset_error = (patches_offset**2).sum(1, keepdim=True).sqrt()  # calculates the magnitude of the center prediction errors
+
+        errors.append((patches_offset_error * circle_mask).sum((-1, -2)) / n_pixels_in_circle)  # averages the center prediction errors
+
+    return torch.cat(errors, 2) if len(errors) > 1 else errors[0]
+
+
+# Buffers of HoughRouting1 in older checkpoints, which are now created by get_coordinate_grid and get_circle_kernel
+LEGACY_BUFFERS = ['ones', 'zeros', 'xy_coords', 'box_filter', 'circle_coords', 'circle_mask', 'n_pixels_in_circle', 'center_threshold']
+
+
+@functools.lru_cache(maxsize=8)
+def get_coordinate_grid(h, w, device):
+    """
+    The grids are cached per input size and device, so they must not be modified in place.
+
+    :return: The x and y coordinates of every pixel plus 1, of shape (1, 2, H, W).
+    """
+    x_coords = torch.arange(1, w + 1, device=device).view(1, w).expand(h, w)
+    y_coords = torch.arange(1, h + 1, device=device).view(h, 1).expand(h, w)
+
+    return torch.stack((x_coords, y_coords), 0).unsqueeze(0)
+
+
+@functools.lru_cache(maxsize=8)
+def get_circle_kernel(circle_radius, device):
+    """
+    The kernels are cached per radius and device, so they must not be modified in place.
+
+    :return: The offsets of the kernel positions from its center (1, 2, 1, 1, K, K), the mask of the positions inside the
+    circle (1, 1, 1, 1, K, K), the number of positions inside the circle and the error threshold of the centers.
+    """
+    k_size = circle_radius * 2 + 1
+
+    x_coords = np.tile(np.expand_dims(np.arange(k_size), 0), (k_size, 1)) + 1
+    y_coords = np.tile(np.expand_dims(np.arange(k_size), 1), (1, k_size)) + 1
+
+    x_coords = torch.from_numpy(x_coords)
+    y_coords = torch.from_numpy(y_coords)
+
+    xy_coords = torch.stack((x_coords, y_coords), 0) - (k_size + 1) // 2
+    xy_coords = xy_coords.float()
+
+    circle_dists = (xy_coords**2).sum(0, keepdim=True).sqrt()
+    circle_mask = (circle_dists <= circle_radius).float()
+    n_pixels_in_circle = circle_mask.sum()
+
+    center_threshold = (circle_dists*circle_mask).sum()/n_pixels_in_circle+0.5
+
+    return (xy_coords.view(1, 2, 1, 1, k_size, k_size).to(device), circle_mask.view(1, 1, 1, 1, k_size, k_size).to(device),
+            n_pixels_in_circle.to(device), center_threshold.to(device))
+
+
 class HoughRouting1(nn.Module):
-    def __init__(self, nms_kernel_size=7, dims=(512, 1024), top_k=200, circle_radius=5):
+    def __init__(self, nms_kernel_size=7, dims=(512, 1024), top_k=200, circle_radius=5, max_vote_memory_mb=None, center_index='brute_force',
+                 batched=True, scale=1):
+        """
+
+        :param max_vote_memory_mb: The memory ceiling of the vote map computation for a batch, the rows of the map are
+        processed in bands which fit into it. None processes the whole map at once.
+        :param center_index: How the closest center of every foreground pixel is found, 'brute_force' or 'grid' (faster
+        with hundreds of centers). Both give the same instance maps.
+        :param batched: Whether the centers and instances of all images are found at once, otherwise every image is
+        processed separately. Both give the same outputs.
+        :param scale: The downscaling factor of the maps on which the centers are found and the pixels are grouped. Only
+        the instance maps are upsampled to the full resolution, where they are masked by the foreground.
+        """
         super(HoughRouting1, self).__init__()
 
         self.kernel_size = nms_kernel_size
         self.top_k = top_k
+        self.max_vote_memory_mb = max_vote_memory_mb
+        self.center_index = center_index
+        self.batched = batched
+        self.scale = scale
 
         self.max_pool = nn.MaxPool2d(self.kernel_size, stride=1, padding=self.kernel_size//2)
 
         self.class_thresh = nn.Threshold(23.99, 50)
 
-        self.h, self.w = dims
-
-        h, w = dims
-
-        ones = torch.ones((h, w))
-        zeros = torch.zeros((h, w))
+        self.h, self.w = dims  # the default input size, any other size can be used
 
-        self.register_buffer('ones', ones)
-        self.register_buffer('zeros', zeros)
-
-        x_coords = np.tile(np.expand_dims(np.arange(w), 0), (h, 1)) + 1
-        y_coords = np.tile(np.expand_dims(np.arange(h), 1), (1, w)) + 1
+        self.circle_radius = circle_radius
+        self.circle_k_size = self.circle_radius * 2 + 1
 
-        x_coords = torch.from_numpy(x_coords)
-        y_coords = torch.from_numpy(y_coords)
+    def get_xy_coords(self, h, w, device):
+        return get_coordinate_grid(h, w, torch.device(device))
 
-        xy_coords = torch.stack((x_coords, y_coords), 0)
+    def get_circle_kernel(self, device):
+        return get_circle_kernel(self.circle_radius, torch.device(device))
 
-        self.register_buffer('xy_coords', xy_coords.unsqueeze(0))
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints written before the grids and kernels were cached stored them as buffers
+        for name in LEGACY_BUFFERS:
+            state_dict.pop(prefix + name, None)
 
-        kernel_size = 1
-        box_filter = torch.ones((1, 1, kernel_size, kernel_size))
+        super(HoughRouting1, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        self.register_buffer('box_filter', box_filter)
+    def get_band_rows(self, center_regressions):
+        if self.max_vote_memory_mb is None:
+            return None
 
-        self.circle_radius = circle_radius
-        k_size = self.circle_radius * 2 + 1
-        self.circle_k_size = k_size
+        b, _, h, w = center_regressions.shape
 
-        x_coords = np.tile(np.expand_dims(np.arange(k_size), 0), (k_size, 1)) + 1
-        y_coords = np.tile(np.expand_dims(np.arange(k_size), 1), (1, k_size)) + 1
+        # the center predictions (2 channels), their squares (2) and the errors (1) of every pixel and kernel position
+        bytes_per_row = b * 5 * w * self.circle_k_size ** 2 * center_regressions.element_size()
 
-        x_coords = torch.from_numpy(x_coords)
-        y_coords = torch.from_numpy(y_coords)
+        return max(1, int(self.max_vote_memory_mb * 2 ** 20 // bytes_per_row))
 
-        xy_coords = torch.stack((x_coords, y_coords), 0) - (k_size + 1) // 2
-        xy_coords = xy_coords.float()
-
-        self.register_buffer('circle_coords', xy_coords.view(1, 2, 1, 1, k_size, k_size))
+    def get_center_maps(self, center_regressions):
+        # Computes center maps based on some circular region around each pixel
+        circle_coords, circle_mask, n_pixels_in_circle, center_threshold = self.get_circle_kernel(center_regressions.device)
+        patches_offset_error = get_vote_errors(center_regressions, circle_coords, circle_mask, n_pixels_in_circle,
+                                               self.get_band_rows(center_regressions))
 
-        circle_dists = (xy_coords**2).sum(0, keepdim=True).sqrt()
-        circle_mask = (circle_dists <= self.circle_radius).float()
-        n_pixels_in_circle = circle_mask.sum()
+        vote_map = patches_offset_error + 1
 
-        self.register_buffer('circle_mask', circle_mask.view(1, 1, 1, 1, k_size, k_size))
-        self.register_buffer('n_pixels_in_circle', n_pixels_in_circle)
+        pooled_centers = 0-self.max_pool(0-vote_map)  # performs NMS on the prediction error (lowest error is a center)
+        vote_map[pooled_centers != vote_map] = 0
+        vote_map[vote_map >= center_threshold] = 0  # Removes possible noisy centers (i.e. if all zeros regressions - the case in the gt regressions)
 
-        self.register_buffer('center_threshold', (circle_dists*circle_mask).sum()/n_pixels_in_circle+0.5)
+        return vote_map.squeeze(1)  # (B, H, W)
 
     def forward(self, fg_pred, center_regressions, gt_fg=None):
         # fg_pred should be of shape (B, 1, H, W)
@@ -165,43 +595,116 @@ class HoughRouting1(nn.Module):
         # gt_fg should be of shape (B, 1, H, W)
         # Returns a list of instance maps, point lists, and segmentation maps
 
-        center_coords_pred = self.xy_coords - center_regressions
-
+        # With scale > 1, center_regressions can also be given at the reduced resolution
         if gt_fg is None:
             things_segs = fg_pred >= 0.5
         else:
             things_segs = gt_fg >= 0.5
 
-        # Computes center maps based on some circular region around each pixel
+        if self.scale != 1:
+            return self.forward_low_res(things_segs[:, 0], center_regressions)
 
-        regression_patches = get_patches(center_regressions, self.circle_k_size)  # Obtains the regressions around each pixel
+        center_coords_pred = self.get_xy_coords(*center_regressions.shape[-2:], center_regressions.device) - center_regressions
 
-        patches_offset = self.circle_coords - regression_patches  # converts regressions into center predictions
+        center_maps = self.get_center_maps(center_regressions)  # (B, H, W)
 
-        patches_offset_error = (patches_offset**2).sum(1, keepdim=True).sqrt()  # calculates the magnitude of the center prediction errors
+        if self.batched:
+            return self.group_batch(center_maps, center_coords_pred, things_segs[:, 0])
 
-        patches_offset_error = (patches_offset_error * self.circle_mask).sum((-1, -2)) / self.n_pixels_in_circle  # averages the center prediction errors
+        return self.group_images(center_maps, center_coords_pred, things_segs[:, 0])
 
-        vote_map = patches_offset_error + 1
+    def forward_low_res(self, things_segs, center_regressions):
+        """
+        Finds the centers and groups the pixels on maps reduced by self.scale.
 
-        pooled_centers = 0-self.max_pool(0-vote_map)  # performs NMS on the prediction error (lowest error is a center)
-        vote_map[pooled_centers != vote_map] = 0
-        vote_map[vote_map >= self.center_threshold] = 0  # Removes possible noisy centers (i.e. if all zeros regressions - the case in the gt regressions)
+        A low resolution pixel (i, j) stands for the full resolution pixel (s*i + s//2, s*j + s//2). Its center
+        prediction and regression are divided by s, and the offset of the +1 coordinates of xy_coords is scaled to 1/s,
+        so that the low resolution centers and predictions relate to each other as at the full resolution.
+
+        :param things_segs: The boolean foreground segmentations at the full resolution (B, H, W).
+        :param center_regressions: The center regressions in full resolution pixels, of shape (B, 2, H, W) or of the resolution
+        of the capsules, which is resized to (B, 2, H/s, W/s).
+        """
+        s = self.scale
+        h, w = things_segs.shape[-2:]
+        h_low, w_low = h // s, w // s
+
+        if center_regressions.shape[-2:] == (h, w):
+            center_regressions = center_regressions[:, :, s // 2::s, s // 2::s][:, :, :h_low, :w_low]
+        elif center_regressions.shape[-2:] != (h_low, w_low):
+            center_regressions = F.interpolate(center_regressions, size=(h_low, w_low), mode='bilinear', align_corners=False)
+        center_regressions = center_regressions / s
+
+        center_coords_pred = self.get_xy_coords(h_low, w_low, center_regressions.device) - 1 + 1 / s - center_regressions
+
+        # the low resolution pixels which contain foreground
+        things_segs_low = F.max_pool2d(things_segs[:, None, :h_low * s, :w_low * s].float(), s)[:, 0] > 0
 
-        center_maps = vote_map.squeeze(1)  # (B, H, W)
+        center_maps = self.get_center_maps(center_regressions)  # (B, H/s, W/s)
 
-        outputs = []  # [(inst_map, point_list, segmentation_list)]
+        if self.batched:
+            return self.group_batch(center_maps, center_coords_pred, things_segs_low, things_segs)
+
+        return self.group_images(center_maps, center_coords_pred, things_segs_low, things_segs)
+
+    def upsample_inst_maps(self, inst_maps, things_segs):
+        """
+
+        :param inst_maps: Instance maps of shape (B, H/s, W/s) or (H/s, W/s).
+        :param things_segs: The foreground segmentations at the full resolution (B, H, W) or (H, W).
+        :return: The instance maps upsampled with nearest interpolation and masked by the foreground.
+        """
+        size = things_segs.shape[-2:]
+        inst_maps = F.interpolate(inst_maps.view((-1, 1) + inst_maps.shape[-2:]).float(), size=size, mode='nearest').long()
+
+        return inst_maps.view(things_segs.shape) * things_segs
+
+    def group_images(self, center_maps, center_coords_pred, things_segs, full_things_segs=None):
+        # full_things_segs is the full resolution foreground, if the centers and things_segs have a reduced resolution
+        outputs = []  # [(inst_map, point_list, segmentation_list)] with PackedPoints and InstanceMasks
         for i, center_map in enumerate(center_maps):
-            sorted_coords, sorted_counts = get_centers(center_map)
+            sorted_coords, sorted_counts = get_centers(center_map, self.top_k)
 
             if sorted_coords is None:
                 outputs.append(([], [], []))
                 continue
 
-            inst_map = create_inst_maps(center_coords_pred[i], sorted_coords, things_segs[i, 0])
+            inst_map = create_inst_maps(center_coords_pred[i], sorted_coords, things_segs[i], center_index=self.center_index)
 
-            point_list, segmentation_list = get_instance_pixels(inst_map)
+            if full_things_segs is not None:
+                inst_map = self.upsample_inst_maps(inst_map, full_things_segs[i])
+
+            # the segmentations are only used by inference, so they are not built while training
+            point_list, segmentation_list = get_instance_pixels(inst_map, with_masks=not self.training)
 
             outputs.append((inst_map, point_list, segmentation_list))
 
         return zip(*outputs)
+
+    def group_batch(self, center_maps, center_coords_pred, things_segs, full_things_segs=None):
+        center_coords, _, valid = get_batch_centers(center_maps, self.top_k)
+
+        if self.center_index == 'brute_force':
+            inst_maps = create_batch_inst_maps(center_coords_pred, center_coords, valid, things_segs)
+        else:
+            inst_maps = torch.zeros(things_segs.shape, dtype=torch.long, device=things_segs.device)
+            for i in range(len(inst_maps)):
+                if valid[i].any():
+                    inst_maps[i] = create_inst_maps(center_coords_pred[i], center_coords[i, valid[i]], things_segs[i], center_index=self.center_index)
+
+        if full_things_segs is not None:
+            inst_maps = self.upsample_inst_maps(inst_maps, full_things_segs)
+
+        # the segmentations are only used by inference, so they are not built while training
+        instance_pixels = get_batch_instance_pixels(inst_maps, with_masks=not self.training)
+
+        outputs = []  # [(inst_map, point_list, segmentation_list)] with PackedPoints and InstanceMasks
+        for i, has_centers in enumerate(valid.any(1).tolist()):
+            if not has_centers:
+                outputs.append(([], [], []))
+                continue
+
+            point_list, segmentation_list = instance_pixels[i]
+            outputs.append((inst_maps[i], point_list, segmentation_list))
+
+        return zip(*outputs)
@@ -0,0 +1,928 @@
+import os
+import copy
+import json
+import resource
+import multiprocessing as mp
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+from unittest import mock
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import config
+from PIL import Image
+from torchvision import transforms
+from dataloader import CustomCityscapes, get_instance_targets, get_augmentation_params, resample_map
+from pyramid import ImagePyramid, build_pyramid
+from samplers import InfiniteSampler, InstanceBalancedBatchSampler
+from HoughCapsules import HoughRouting1, get_patches, get_vote_errors, create_inst_maps, CenterGrid, get_instance_pixels, from_numpy_outputs
+import hough_numpy
+from modelNew import CapsuleModel5, VotingModule, route_instances, get_instance_index_map
+import setTransformer
+from setTransformer import TransformerRouting, qkv_attention, multi_head_attention
+from packed_points import get_downsampled_points, get_grid_size
+
+
+def timeit(fn, n_repeats=10):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        fn()
+    return (time.perf_counter() - start) / n_repeats
+
+
+def random_instance_scene(n_instances=60, h=config.h, w=config.w, seed=0):
+    """
+    Creates a synthetic street scene with overlapping elliptical instances.
+
+    :return: An instance map of shape (H, W) with ids >= 1000 and a segmentation map of shape (H, W).
+    """
+    rng = np.random.RandomState(seed)
+    instance_maps = np.zeros((h, w), dtype=np.int32)
+    segmentation_maps = np.zeros((h, w), dtype=np.uint8)
+
+    y_coords, x_coords = np.mgrid[:h, :w]
+    for i in range(n_instances):
+        cls = rng.randint(24, 34)
+        cy, cx = rng.randint(0, h), rng.randint(0, w)
+        ry, rx = rng.randint(4, h // 6), rng.randint(4, w // 10)
+        inst_map = ((y_coords - cy) / ry) ** 2 + ((x_coords - cx) / rx) ** 2 <= 1
+        instance_maps[inst_map] = cls * 1000 + i
+        segmentation_maps[inst_map] = cls
+
+    return instance_maps, segmentation_maps
+
+
+def write_synthetic_cityscapes(root, split, n_samples, h=1024, w=2048):
+    """
+    Writes synthetic samples with the Cityscapes directory layout, so the data pipeline can be benchmarked without the
+    dataset.
+    """
+    image_dir = os.path.join(root, 'leftImg8bit', split, 'synthetic')
+    target_dir = os.path.join(root, 'gtFine', split, 'synthetic')
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(target_dir, exist_ok=True)
+
+    for i in range(n_samples):
+        instance_maps, segmentation_maps = random_instance_scene(20 + 10 * i, h, w, seed=i)
+
+        rng = np.random.RandomState(i)
+        colors = rng.randint(0, 256, (256, 3))
+        image = colors[segmentation_maps] + rng.randint(-8, 9, (h, w, 3))
+        image = np.clip(image, 0, 255).astype(np.uint8)
+
+        name = 'synthetic_%06d_000019' % i
+        Image.fromarray(image).save(os.path.join(image_dir, name + '_leftImg8bit.png'))
+        Image.fromarray(segmentation_maps).save(os.path.join(target_dir, name + '_gtFine_labelIds.png'))
+        Image.fromarray(instance_maps.astype(np.uint16)).save(os.path.join(target_dir, name + '_gtFine_instanceIds.png'))
+
+
+def loop_instance_targets(instance_maps, segmentation_maps):
+    # The per-instance loop previously used in CustomCityscapes.__getitem__
+    h, w = instance_maps.shape
+    instance_regressions = np.zeros((2, h, w))
+    regression_present = np.zeros((h, w))
+    segmentation_weights = np.ones((h, w))
+
+    unique_values = np.unique(instance_maps)
+
+    instance_values = [x for x in unique_values if x >= 1000]
+
+    point_list = []
+    class_list = []
+    for instance in instance_values:
+        pixels = np.stack(np.where(instance_maps == instance))
+
+        point_list.append(pixels)
+
+        center = np.round(np.mean(pixels, 1)).astype(np.int32)  # gives the center (y, x)
+        center = np.array((min(h - 17, max(17, center[0])), min(w - 17, max(17, center[1]))))
+
+        class_list.append(np.array(segmentation_maps)[pixels[0][0]][pixels[1][0]])
+
+        dists = pixels - np.expand_dims(center, 1)
+
+        instance_regressions[:, pixels[0], pixels[1]] = dists
+        regression_present[pixels[0], pixels[1]] = 1
+
+        if pixels.shape[1] <= 64 * 64:
+            segmentation_weights[pixels[0], pixels[1]] = 10
+
+    return instance_regressions, regression_present, segmentation_weights, class_list, point_list
+
+
+def bench_instance_targets():
+    for n_instances in [0, 10, 60, 120]:
+        instance_maps, segmentation_maps = random_instance_scene(n_instances)
+
+        expected = loop_instance_targets(instance_maps, segmentation_maps)
+        output = get_instance_targets(instance_maps, segmentation_maps)
+
+        for a, b in zip(expected[:3], output[:3]):
+            assert np.array_equal(a, b)  # the targets are stored in compact dtypes, but have the same values
+        assert expected[3] == list(output[3])
+        point_list = np.split(output[4], np.cumsum(output[5])[:-1], axis=1) if len(output[5]) != 0 else []
+        assert len(expected[4]) == len(point_list) and all(np.array_equal(a, b) for a, b in zip(expected[4], point_list))
+
+        loop_time = timeit(lambda: loop_instance_targets(instance_maps, segmentation_maps))
+        vec_time = timeit(lambda: get_instance_targets(instance_maps, segmentation_maps))
+
+        print('instance targets | %3d instances | loop: %7.2f ms | single pass: %7.2f ms | speedup: %5.1fx'
+              % (len(output[5]), loop_time * 1000, vec_time * 1000, loop_time / vec_time), flush=True)
+
+
+def sequential_augmentation(image, segmentation_maps, instance_maps, size, flip=False):
+    # The flip, pad, crop and resize steps previously used in CustomCityscapes.__getitem__
+    w, h = size
+    if flip:
+        image = transforms.functional.hflip(image)
+        segmentation_maps = transforms.functional.hflip(segmentation_maps)
+        instance_maps = transforms.functional.hflip(instance_maps)
+
+    crop_perc = np.random.choice([x / 10 for x in range(5, 15)])
+    image_w, image_h = image.size
+    crop_w, crop_h = int(image_w * crop_perc), int(image_h * crop_perc)
+
+    if crop_perc > 1:
+        diff_w, diff_h = crop_w - image_w, crop_h - image_h
+        left_padding = np.random.randint(0, diff_w)
+        top_padding = np.random.randint(0, diff_h)
+        pad_tuple = (left_padding, top_padding, crop_w - left_padding, crop_h - top_padding)
+
+        image = transforms.functional.pad(image, pad_tuple, fill=255)
+        segmentation_maps = transforms.functional.pad(segmentation_maps, pad_tuple, fill=255)
+        instance_maps = transforms.functional.pad(instance_maps, pad_tuple, fill=255)
+
+        image_w, image_h = image.size
+
+    start_x = np.random.randint(0, image_w - crop_w + 1)
+    start_y = np.random.randint(0, image_h - crop_h + 1)
+    crop_tuple = (start_x, start_y, start_x + crop_w, start_y + crop_h)
+    image = image.crop(crop_tuple)
+    segmentation_maps = segmentation_maps.crop(crop_tuple)
+    instance_maps = instance_maps.crop(crop_tuple)
+
+    image = image.resize(size=(w, h), resample=Image.BILINEAR)
+    segmentation_maps = segmentation_maps.resize(size=(w, h), resample=Image.NEAREST)
+    instance_maps = instance_maps.resize(size=(w, h), resample=Image.NEAREST)
+
+    return image, segmentation_maps, instance_maps
+
+
+def fused_augmentation(image, segmentation_maps, instance_maps, size, flip=False):
+    _, crop_box = get_augmentation_params(image.size)
+
+    image = resample_map(image, flip, crop_box, size, Image.BILINEAR)
+    segmentation_maps = resample_map(segmentation_maps, flip, crop_box, size, Image.NEAREST)
+    instance_maps = resample_map(instance_maps, flip, crop_box, size, Image.NEAREST)
+
+    return image, segmentation_maps, instance_maps
+
+
+def bench_augmentation(n_samples=40):
+    instance_maps, segmentation_maps = random_instance_scene(60, 1024, 2048)
+    image = np.random.RandomState(0).randint(0, 256, (1024, 2048, 3)).astype(np.uint8)
+    maps = (Image.fromarray(image), Image.fromarray(segmentation_maps), Image.fromarray(instance_maps))
+    size = (config.w, config.h)
+
+    for flip in [False, True]:
+        label_mismatch, image_diff = [], []
+        for seed in range(n_samples):
+            np.random.seed(seed)
+            expected = sequential_augmentation(*maps, size, flip)
+            np.random.seed(seed)
+            output = fused_augmentation(*maps, size, flip)
+
+            image_diff.append(np.abs(np.array(expected[0], dtype=np.float32) - np.array(output[0], dtype=np.float32)).mean())
+            label_mismatch.append(np.mean([np.mean(np.array(a) != np.array(b)) for a, b in zip(expected[1:], output[1:])]))
+
+        print('augmentation | flip: %d | label pixels changed: %.5f%% | mean abs image difference: %.4f'
+              % (flip, np.mean(label_mismatch) * 100, np.mean(image_diff)), flush=True)
+
+    for name, fn in [('flip/pad/crop/resize', sequential_augmentation), ('fused', fused_augmentation)]:
+        np.random.seed(0)
+        sample_time = timeit(lambda: fn(*maps, size), n_samples)
+        print('augmentation | %20s | %6.2f ms/sample | %6.1f samples/s' % (name, sample_time * 1000, 1 / sample_time), flush=True)
+
+
+def bench_pyramid(n_samples=8):
+    root = tempfile.mkdtemp()
+    try:
+        for split in ['train', 'val']:
+            write_synthetic_cityscapes(root, split, n_samples)
+            build_pyramid(root, split, os.path.join(root, 'pyramid'))
+
+            datasets = [CustomCityscapes(root, split, 'fine', ['semantic', 'instance']),
+                        CustomCityscapes(root, split, 'fine', ['semantic', 'instance'], pyramid=ImagePyramid(root, os.path.join(root, 'pyramid')))]
+
+            image_diff, target_diff = [], []
+            for i in range(n_samples):
+                np.random.seed(i)
+                expected = datasets[0][i]
+                np.random.seed(i)
+                output = datasets[1][i]
+
+                image_diff.append((expected[0] - output[0]).abs().mean().item() * 255)
+                target_diff.append(np.mean([np.mean(np.array(a) != np.array(b)) for a, b in zip(expected[1], output[1])]))
+
+            times = []
+            for dataset in datasets:
+                np.random.seed(0)
+                times.append(timeit(lambda: [dataset[i] for i in range(n_samples)], 2) / n_samples)
+
+            print('pyramid | %5s | mean abs image difference: %.3f | target pixels changed: %.4f%% | full res: %6.1f ms/sample | pyramid: %6.1f ms/sample'
+                  % (split, np.mean(image_diff), np.mean(target_diff) * 100, times[0] * 1000, times[1] * 1000), flush=True)
+    finally:
+        shutil.rmtree(root)
+
+
+def measure_peak_memory(fn):
+    """
+    Runs fn in a forked process and returns its result (sent back with pickle, so tensors should be converted to numpy)
+    and the increase of the peak resident memory in MB.
+    """
+    def run(conn):
+        with open('/proc/self/status') as f:
+            rss = [int(line.split()[1]) for line in f if line.startswith('VmRSS')][0]
+        result = fn()
+        conn.send((result, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024))
+
+    parent_conn, child_conn = mp.get_context('fork').Pipe()
+    process = mp.get_context('fork').Process(target=run, args=(child_conn, ))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+
+    return result
+
+
+def patch_vote_errors(hough_routing, center_regressions):
+    # The vote map computation previously used in HoughRouting1.forward
+    circle_coords, circle_mask, n_pixels_in_circle, _ = hough_routing.get_circle_kernel(center_regressions.device)
+    regression_patches = get_patches(center_regressions, hough_routing.circle_k_size)
+    patches_offset = circle_coords - regression_patches
+    patches_offset_error = (patches_offset**2).sum(1, keepdim=True).sqrt()
+    return (patches_offset_error * circle_mask).sum((-1, -2)) / n_pixels_in_circle
+
+
+def bench_vote_map(batch_size=2):
+    torch.manual_seed(0)
+    center_regressions = torch.randn(batch_size, 2, config.h, config.w) * 20
+
+    with torch.no_grad():
+        expected, peak_mb = measure_peak_memory(lambda: patch_vote_errors(HoughRouting1(), center_regressions).numpy())
+        vote_time = timeit(lambda: patch_vote_errors(HoughRouting1(), center_regressions), 2)
+        print('vote map | batch %d | %12s | peak memory: %6d MB | %6.2f s' % (batch_size, 'patches', peak_mb, vote_time), flush=True)
+
+        for max_vote_memory_mb in [None, 1024, 256, 64]:
+            hough_routing = HoughRouting1(max_vote_memory_mb=max_vote_memory_mb)
+            band_rows = hough_routing.get_band_rows(center_regressions)
+            circle_coords, circle_mask, n_pixels_in_circle, _ = hough_routing.get_circle_kernel(center_regressions.device)
+            vote_errors = lambda: get_vote_errors(center_regressions, circle_coords, circle_mask, n_pixels_in_circle, band_rows)
+
+            output, peak_mb = measure_peak_memory(lambda: vote_errors().numpy())
+            vote_time = timeit(vote_errors, 2)
+
+            print('vote map | batch %d | ceiling %4s | peak memory: %6d MB | %6.2f s | identical: %s'
+                  % (batch_size, max_vote_memory_mb, peak_mb, vote_time, np.array_equal(expected, output)), flush=True)
+
+
+def random_center_predictions(n_instances, seed=0, noise=2.0):
+    """
+    Creates center predictions of a synthetic scene, from its ground truth regressions with added noise.
+
+    :return: The center predictions (2, H, W) in x-y order, the foreground map (H, W) and the instance centers (K, 2) in y-x order.
+    """
+    instance_maps, segmentation_maps = random_instance_scene(n_instances, seed=seed)
+    instance_regressions, regression_present = get_instance_targets(instance_maps, segmentation_maps)[:2]
+
+    h, w = instance_maps.shape
+    y_coords, x_coords = np.mgrid[:h, :w]
+    center_coords_pred = np.stack((x_coords - instance_regressions[1], y_coords - instance_regressions[0])).astype(np.float32)
+
+    things_segs = regression_present != 0
+    centers = torch.unique(torch.from_numpy(center_coords_pred[::-1, things_segs].T.astype(np.int64)), dim=0)  # (y, x) of every instance
+
+    center_coords_pred += np.random.RandomState(seed).normal(0, noise, center_coords_pred.shape).astype(np.float32)
+
+    return torch.from_numpy(center_coords_pred), torch.from_numpy(things_segs), centers
+
+
+def dense_inst_maps(center_coords_pred, center_coords, things_segs):
+    # The nearest center assignment previously used in create_inst_maps
+    center_coords_pred = center_coords_pred.unsqueeze(-1)  # (2, H, W, 1)
+    k, _ = center_coords.shape
+    y_centers, x_centers = center_coords[:, 0], center_coords[:, 1]
+    center_batch_t = torch.stack((x_centers, y_centers), 0).view(2, 1, 1, k)  # (2, 1, 1, K)
+
+    dist = center_coords_pred - center_batch_t  # (2, H, W, K)
+    dist = torch.sqrt(torch.sum(dist * dist, 0))  # (H, W, K)
+    closest_inds = torch.argmin(dist, -1) + 1  # (H, W)
+
+    return closest_inds * things_segs
+
+
+def bench_inst_maps():
+    for n_centers in [10, 50, 100, 200]:
+        center_coords_pred, things_segs, center_coords = random_center_predictions(60, seed=n_centers)
+        center_coords = torch.cat((center_coords, torch.randint(0, config.h, (n_centers, 2))))[:n_centers]  # includes false positives
+
+        expected, dense_mb = measure_peak_memory(lambda: dense_inst_maps(center_coords_pred, center_coords, things_segs).numpy())
+        output, chunked_mb = measure_peak_memory(lambda: create_inst_maps(center_coords_pred, center_coords, things_segs).numpy())
+
+        dense_time = timeit(lambda: dense_inst_maps(center_coords_pred, center_coords, things_segs), 3)
+        chunked_time = timeit(lambda: create_inst_maps(center_coords_pred, center_coords, things_segs), 3)
+
+        print('instance maps | %3d centers | %4.1f%% foreground | dense: %7.1f ms, %5d MB | foreground chunks: %7.1f ms, %5d MB | identical: %s'
+              % (n_centers, things_segs.float().mean() * 100, dense_time * 1000, dense_mb, chunked_time * 1000, chunked_mb,
+                 np.array_equal(expected, output)), flush=True)
+
+
+def bench_center_index():
+    for n_centers in [10, 30, 100, 300, 1000]:
+        center_coords_pred, things_segs, center_coords = random_center_predictions(n_centers, seed=n_centers)
+        n_instances = center_coords.shape[0]
+        center_coords = torch.cat((center_coords, torch.randint(0, config.h, (n_centers, 2))))[:n_centers]  # includes false positives
+
+        expected = create_inst_maps(center_coords_pred, center_coords, things_segs)
+        output = create_inst_maps(center_coords_pred, center_coords, things_segs, center_index='grid')
+
+        fg_coords_pred = center_coords_pred.reshape(2, -1)[:, things_segs.reshape(-1)]
+        grid = CenterGrid(center_coords)
+        radius = grid.get_search_radius(*fg_coords_pred, *grid.get_cells(*fg_coords_pred))
+        nearest = center_coords[expected[things_segs] - 1]
+        nearest_dist = ((fg_coords_pred[0] - nearest[:, 1]) ** 2 + (fg_coords_pred[1] - nearest[:, 0]) ** 2)
+        fallback = (nearest_dist * (1 + 2 ** -20) >= radius * radius).float().mean()
+
+        brute_force_time = timeit(lambda: create_inst_maps(center_coords_pred, center_coords, things_segs), 3)
+        grid_time = timeit(lambda: create_inst_maps(center_coords_pred, center_coords, things_segs, center_index='grid'), 3)
+
+        print('center index | %4d centers (%4d instances) | brute force: %7.1f ms | grid: %7.1f ms (%4.1f%% fallback) | speedup: %4.1fx | identical: %s'
+              % (n_centers, n_instances, brute_force_time * 1000, grid_time * 1000, fallback * 100, brute_force_time / grid_time,
+                 torch.equal(expected, output)), flush=True)
+
+
+def loop_instance_pixels(instance_map):
+    # The per-instance loop previously used in get_instance_pixels
+    point_list = []
+    segmentation_list = []
+    for inst in torch.unique(instance_map):
+        if inst == 0:
+            continue
+
+        inst_map = (instance_map == inst)
+        point_list.append(torch.stack(torch.where(inst_map), 0))
+        segmentation_list.append(inst_map.type(torch.uint8))
+
+    return point_list, segmentation_list
+
+
+def bench_instance_pixels():
+    for n_centers in [10, 50, 100, 200]:
+        center_coords_pred, things_segs, center_coords = random_center_predictions(n_centers, seed=n_centers)
+        instance_map = create_inst_maps(center_coords_pred, center_coords, things_segs)
+
+        expected = loop_instance_pixels(instance_map)
+        output = get_instance_pixels(instance_map)
+
+        identical = len(expected[0]) == len(output[0]) and all(torch.equal(a, b) for a, b in zip(expected[0], output[0])) and \
+            all(torch.equal(a, output[1].get_dense(k)) for k, a in enumerate(expected[1]))
+
+        loop_mb = sum(mask.numel() for mask in expected[1]) / 2 ** 20
+        packed_mb = output[1].data.numel() / 2 ** 20
+
+        loop_time = timeit(lambda: loop_instance_pixels(instance_map), 3)
+        packed_time = timeit(lambda: get_instance_pixels(instance_map), 3)
+        points_time = timeit(lambda: get_instance_pixels(instance_map, with_masks=False), 3)
+
+        print('instance pixels | %3d instances | loop: %7.1f ms, masks %5.1f MB | single sort: %6.1f ms, masks %5.1f MB (points only: %6.1f ms) | identical: %s'
+              % (len(output[0]), loop_time * 1000, loop_mb, packed_time * 1000, packed_mb, points_time * 1000, identical), flush=True)
+
+
+def bench_batched_hough(batch_sizes=(1, 2, 4, 8, 16)):
+    hough_routing = HoughRouting1(max_vote_memory_mb=256).eval()
+
+    # the center maps of a few synthetic scenes, which are repeated to fill the batches
+    scenes = []
+    for seed in range(4):
+        center_coords_pred, things_segs, _ = random_center_predictions(20 + 20 * seed, seed=seed)
+        with torch.no_grad():
+            center_maps = hough_routing.get_center_maps(hough_routing.get_xy_coords(config.h, config.w, 'cpu') - center_coords_pred.unsqueeze(0))
+        scenes.append((center_maps[0], center_coords_pred, things_segs))
+
+    for batch_size in batch_sizes:
+        center_maps, center_coords_pred, things_segs = [torch.stack(x) for x in zip(*[scenes[i % len(scenes)] for i in range(batch_size)])]
+
+        with torch.no_grad():
+            expected = list(zip(*hough_routing.group_images(center_maps, center_coords_pred, things_segs)))
+            output = list(zip(*hough_routing.group_batch(center_maps, center_coords_pred, things_segs)))
+
+            identical = all(torch.equal(a[0], b[0]) and len(a[1]) == len(b[1]) and all(torch.equal(p, q) for p, q in zip(a[1], b[1]))
+                            for a, b in zip(expected, output))
+
+            image_time = timeit(lambda: hough_routing.group_images(center_maps, center_coords_pred, things_segs), 3)
+            batch_time = timeit(lambda: hough_routing.group_batch(center_maps, center_coords_pred, things_segs), 3)
+
+        print('batched hough | batch %2d | per image: %7.1f ms | batched: %7.1f ms | speedup: %4.2fx | identical: %s'
+              % (batch_size, image_time * 1000, batch_time * 1000, image_time / batch_time, identical), flush=True)
+
+
+def simulated_model_outputs(n_instances, seed=0, noise=0.05, scale=4):
+    """
+    Simulates the outputs of the model for a synthetic scene: the ground truth foreground and regressions are averaged
+    over scale x scale cells, as the capsules predict them at a reduced resolution, noise is added to the regressions and
+    the maps are upsampled bilinearly as in get_outputs_from_caps.
+
+    :return: The ground truth instance map (H, W), the foreground probabilities (1, 1, H, W), the regressions at the full
+    resolution (1, 2, H, W) and at the reduced resolution (1, 2, H/s, W/s), in x-y order.
+    """
+    instance_maps, segmentation_maps = random_instance_scene(n_instances, seed=seed)
+    instance_regressions, regression_present = get_instance_targets(instance_maps, segmentation_maps)[:2]
+    h, w = instance_maps.shape
+
+    regressions = torch.from_numpy(instance_regressions[::-1].astype(np.float32))[None]  # (1, 2, H, W) in x-y order
+    fg = torch.from_numpy(regression_present.astype(np.float32))[None, None]
+
+    native_regressions = F.avg_pool2d(regressions, scale)
+    native_regressions = native_regressions * (1 + noise * torch.randn(native_regressions.shape, generator=torch.Generator().manual_seed(seed)))
+    regressions = F.interpolate(native_regressions, size=(h, w), mode='bilinear', align_corners=False)
+    fg_pred = F.interpolate(F.avg_pool2d(fg, scale), size=(h, w), mode='bilinear', align_corners=False)
+
+    return torch.from_numpy(instance_maps * (regression_present != 0)), fg_pred, regressions, native_regressions
+
+
+def match_instances(inst_map, gt_instance_map):
+    """
+
+    :param inst_map: A predicted instance map (H, W) with ids 1..K, 0 is the background.
+    :param gt_instance_map: A ground truth instance map (H, W) with arbitrary ids, 0 is the background.
+    :return: The IoU of every predicted and ground truth instance (K, G) and the ids of the predictions.
+    """
+    pred_ids, pred_inds = torch.unique(inst_map, return_inverse=True)
+    gt_ids, gt_inds = torch.unique(gt_instance_map, return_inverse=True)
+
+    intersections = torch.bincount((pred_inds * len(gt_ids) + gt_inds).view(-1), minlength=len(pred_ids) * len(gt_ids))
+    intersections = intersections.view(len(pred_ids), len(gt_ids)).double()
+    areas_pred, areas_gt = intersections.sum(1, keepdim=True), intersections.sum(0, keepdim=True)
+    ious = intersections / (areas_pred + areas_gt - intersections)
+
+    # removes the background of both maps
+    return ious[pred_ids != 0][:, gt_ids != 0], pred_ids[pred_ids != 0]
+
+
+def panoptic_quality(ious):
+    """
+    Class-agnostic panoptic quality of the predictions of an image, where a prediction matches a ground truth instance
+    if their IoU is > 0.5 (such matches are unique).
+
+    :return: The sum of the IoUs of the matches, and the numbers of true positives, false positives and false negatives.
+    """
+    matches = ious > 0.5
+    n_tp = int(matches.sum())
+
+    return float(ious[matches].sum()), n_tp, ious.shape[0] - n_tp, ious.shape[1] - n_tp
+
+
+def average_precision(scores, ious, n_gt, threshold=0.5):
+    """
+
+    :param scores: The scores of all predictions of the dataset.
+    :param ious: The IoU of every prediction with its best ground truth instance, where a ground truth instance is matched
+    at most once (by the prediction with the highest score).
+    :param n_gt: The number of ground truth instances of the dataset.
+    :return: The area under the interpolated precision-recall curve.
+    """
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    tp = np.cumsum(np.asarray(ious)[order] > threshold)
+    precision = tp / np.arange(1, len(order) + 1)
+    recall = tp / max(n_gt, 1)
+
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    return float(np.sum(np.diff(np.concatenate(([0], recall))) * precision))
+
+
+def bench_low_res_hough(n_scenes=8, scale=4):
+    """
+    Compares Hough routing at the full resolution with Hough routing at the resolution of the capsules, in time and in
+    the quality of the instances (class-agnostic PQ, SQ, RQ and AP at IoU 0.5 against the ground truth of the scenes).
+    """
+    modes = [('full resolution', HoughRouting1(max_vote_memory_mb=config.hough_vote_memory_mb).eval()),
+             ('1/%d resolution' % scale, HoughRouting1(max_vote_memory_mb=config.hough_vote_memory_mb, scale=scale).eval())]
+
+    scenes = [simulated_model_outputs(15 + 10 * seed, seed=seed, scale=scale) for seed in range(n_scenes)]
+
+    for name, hough_routing in modes:
+        times, iou_sum, n_tp, n_fp, n_fn = [], 0, 0, 0, 0
+        scores, best_ious, n_gt = [], [], 0
+        for gt_instance_map, fg_pred, regressions, native_regressions in scenes:
+            inputs = (fg_pred, native_regressions if hough_routing.scale != 1 else regressions)
+
+            with torch.no_grad():
+                times.append(timeit(lambda: hough_routing(*inputs), 3))
+                inst_map = next(hough_routing(*inputs))[0]
+
+            ious, pred_ids = match_instances(inst_map, gt_instance_map)
+            image_iou_sum, image_tp, image_fp, image_fn = panoptic_quality(ious)
+            iou_sum, n_tp, n_fp, n_fn = iou_sum + image_iou_sum, n_tp + image_tp, n_fp + image_fp, n_fn + image_fn
+
+            # the score of an instance is its mean foreground probability
+            image_scores = torch.bincount(inst_map.view(-1), weights=fg_pred.view(-1).double())[pred_ids] / torch.bincount(inst_map.view(-1))[pred_ids]
+            image_best_ious = torch.zeros(len(pred_ids), dtype=torch.float64)
+            matched = torch.zeros(ious.shape[1], dtype=torch.bool)
+            for k in torch.argsort(-image_scores).tolist():
+                if ious.shape[1] != 0:
+                    ious_k = ious[k].masked_fill(matched, -1)
+                    image_best_ious[k] = ious_k.max()
+                    matched[ious_k.argmax()] |= ious_k.max() > 0.5
+
+            scores += image_scores.tolist()
+            best_ious += image_best_ious.tolist()
+            n_gt += ious.shape[1]
+
+        sq = iou_sum / max(n_tp, 1)
+        rq = n_tp / max(n_tp + (n_fp + n_fn) / 2, 1)
+        print('low res hough | %15s | %7.1f ms/image | PQ %5.1f | SQ %5.1f | RQ %5.1f | AP50 %5.1f | %d TP, %d FP, %d FN'
+              % (name, np.mean(times) * 1000, sq * rq * 100, sq * 100, rq * 100, average_precision(scores, best_ious, n_gt) * 100,
+                 n_tp, n_fp, n_fn), flush=True)
+
+
+def bench_numpy_hough(batch_size=8, worker_counts=(1, 2, 4)):
+    hough_routing = HoughRouting1(max_vote_memory_mb=config.hough_vote_memory_mb).eval()
+
+    scenes = [simulated_model_outputs(15 + 10 * seed, seed=seed) for seed in range(batch_size)]
+    fg_pred, center_regressions = torch.cat([scene[1] for scene in scenes]), torch.cat([scene[2] for scene in scenes])
+
+    with torch.no_grad():
+        expected = list(zip(*hough_routing(fg_pred, center_regressions)))
+        torch_time = timeit(lambda: hough_routing(fg_pred, center_regressions), 2)
+
+    output = list(zip(*from_numpy_outputs(hough_numpy.group_images(fg_pred.numpy(), center_regressions.numpy()))))
+    n_identical = sum(torch.equal(a[0], b[0]) and len(a[1]) == len(b[1]) and all(torch.equal(p, q) for p, q in zip(a[1], b[1]))
+                      for a, b in zip(expected, output))
+
+    # the vote errors are reduced in a different order by the two backends
+    with torch.no_grad():
+        circle_coords, circle_mask, n_pixels_in_circle, _ = hough_routing.get_circle_kernel(center_regressions.device)
+        torch_errors = get_vote_errors(center_regressions, circle_coords, circle_mask, n_pixels_in_circle,
+                                       hough_routing.get_band_rows(center_regressions))[:, 0].numpy()
+    numpy_errors = np.stack([hough_numpy.get_vote_errors(regressions) for regressions in center_regressions.numpy()])
+    error_difference = np.abs(numpy_errors / torch_errors - 1).max()
+
+    print('numpy hough | batch %d | numba: %s | %d CPU cores | identical images: %d/%d | vote error relative difference: %.1e (tolerance %.0e)'
+          % (batch_size, hough_numpy.numba is not None, os.cpu_count(), n_identical, batch_size, error_difference, hough_numpy.VOTE_ERROR_RTOL))
+    print('numpy hough | %18s | %6.2f s' % ('torch', torch_time), flush=True)
+
+    numpy_time = timeit(lambda: hough_numpy.group_images(fg_pred.numpy(), center_regressions.numpy()), 2)
+    print('numpy hough | %18s | %6.2f s' % ('numpy', numpy_time), flush=True)
+
+    for n_workers in worker_counts:
+        with mp.Pool(n_workers) as pool:
+            pool_time = timeit(lambda: hough_numpy.group_images(fg_pred.numpy(), center_regressions.numpy(), pool), 2)
+        print('numpy hough | %2d worker processes | %6.2f s' % (n_workers, pool_time), flush=True)
+
+
+def bench_balanced_batches(n_steps=2000, n_ranks=4):
+    if os.path.exists(config.instance_index_file):
+        with open(config.instance_index_file) as f:
+            instance_counts = np.array(list(json.load(f).values()))
+        source = config.instance_index_file
+    else:  # a long tailed distribution of instance counts, similar to the Cityscapes train split
+        instance_counts = np.random.RandomState(0).negative_binomial(1.5, 0.075, 2975)
+        source = 'synthetic counts'
+
+    batch_size = config.batch_size
+    samplers = [('random', InfiniteSampler(len(instance_counts), seed=0)),
+                ('balanced', InstanceBalancedBatchSampler(instance_counts, batch_size, config.balance_window_batches, seed=0))]
+
+    print('balanced batches | %s | %d images | %.1f instances/image on average' % (source, len(instance_counts), instance_counts.mean()))
+    for name, sampler in samplers:
+        indices = iter(sampler)
+        if name == 'random':
+            batches = ([next(indices) for _ in range(batch_size)] for _ in range(n_steps * n_ranks))
+        else:
+            batches = (next(indices) for _ in range(n_steps * n_ranks))
+
+        # the step time grows linearly with the instances of the batch, and with several ranks every step waits for the slowest
+        loads = np.array([instance_counts[batch].sum() for batch in batches]).reshape(n_steps, n_ranks)
+
+        print('balanced batches | %8s | instances/batch: mean %6.1f, std %5.1f, max %4d | slowest of %d ranks / mean: %.2f'
+              % (name, loads.mean(), loads.std(), loads.max(), n_ranks, loads.max(1).mean() / loads.mean()), flush=True)
+
+
+def instance_capsules(n_instances, seed=0, n_caps=8, vote_dim=config.vote_dim, scale=16):
+    """
+    Gathers random capsule votes and activations at the points of the instances of a synthetic scene, as
+    CapsuleModel5.get_instance_votes does at the resolution of the primary capsules.
+
+    :return: The votes (n_caps*p, vote_dim) and activations (n_caps*p, ) of every instance, as leaves which require
+    gradients.
+    """
+    instance_maps, segmentation_maps = random_instance_scene(n_instances, seed=seed)
+    instance_regressions, regression_present = get_instance_targets(instance_maps, segmentation_maps)[:2]
+    gt_reg = torch.from_numpy(instance_regressions[::-1].astype(np.float32))[None]
+    gt_seg = torch.from_numpy(regression_present.astype(np.float32))[None, None]
+
+    with torch.no_grad():
+        _, (point_list, ), _ = HoughRouting1()(gt_seg, gt_reg, gt_seg)
+
+    generator = torch.Generator().manual_seed(seed)
+    h, w = get_grid_size((config.h, config.w), scale)
+    capsule_votes = torch.randn((n_caps * vote_dim, h, w), generator=generator)
+    capsule_acts = torch.rand((n_caps, h, w), generator=generator)
+
+    votes_list, acts_list = [], []
+    for k in range(len(point_list)):
+        y_coords, x_coords = get_downsampled_points(point_list, k, scale)
+        votes_list.append(capsule_votes[:, y_coords, x_coords].view(n_caps, vote_dim, -1).transpose(1, 2).reshape(-1, vote_dim).requires_grad_())
+        acts_list.append(capsule_acts[:, y_coords, x_coords].reshape(-1).requires_grad_())
+
+    return votes_list, acts_list
+
+
+def bench_instance_routing(instance_counts=(10, 40, 80, 160)):
+    torch.manual_seed(0)
+    transformer_routing = TransformerRouting(n_feats_in=config.vote_dim, n_caps_out=34, output_dim=16, use_vote_transform=False)
+
+    def loop_routing(votes_list, acts_list):
+        outputs = [transformer_routing(votes, acts) for votes, acts in zip(votes_list, acts_list)]
+        return torch.stack([poses for poses, _ in outputs]), torch.stack([acts for _, acts in outputs])
+
+    def train_step(routing_fn, votes_list, acts_list):
+        poses, acts = routing_fn(votes_list, acts_list)
+        (poses.sum() + (acts ** 2).sum()).backward()
+
+    for n_instances in instance_counts:
+        votes_list, acts_list = instance_capsules(n_instances)
+
+        with torch.no_grad():
+            expected = loop_routing(votes_list, acts_list)
+            output = route_instances(transformer_routing, votes_list, acts_list)
+            max_diff = max((a - b).abs().max().item() for a, b in zip(expected, output))
+
+            loop_time = timeit(lambda: loop_routing(votes_list, acts_list), 3)
+            batched_time = timeit(lambda: route_instances(transformer_routing, votes_list, acts_list), 3)
+
+        loop_train_time = timeit(lambda: train_step(loop_routing, votes_list, acts_list), 3)
+        batched_train_time = timeit(lambda: train_step(lambda *x: route_instances(transformer_routing, *x), votes_list, acts_list), 3)
+
+        print('instance routing | %3d instances, %6d capsules | inference: loop %7.1f ms, batched %7.1f ms | train step: loop %7.1f ms, '
+              'batched %7.1f ms | max difference: %.1e' % (len(votes_list), sum(len(votes) for votes in votes_list), loop_time * 1000,
+                                                          batched_time * 1000, loop_train_time * 1000, batched_train_time * 1000, max_diff), flush=True)
+
+
+def bench_instance_scatter(batch_size=2, n_instances=60, scale=4):
+    point_lists = []
+    for i in range(batch_size):
+        instance_maps, segmentation_maps = random_instance_scene(n_instances, seed=i)
+        instance_regressions, regression_present = get_instance_targets(instance_maps, segmentation_maps)[:2]
+        gt_reg = torch.from_numpy(instance_regressions[::-1].astype(np.float32))[None]
+        gt_seg = torch.from_numpy(regression_present.astype(np.float32))[None, None]
+
+        with torch.no_grad():
+            _, (point_list, ), _ = HoughRouting1()(gt_seg, gt_reg, gt_seg)
+        point_lists.append(point_list)
+
+    n_total = sum(len(point_list) for point_list in point_lists)
+    out_capsule_poses = torch.randn((n_total, 34, 16))
+    size = (config.h // scale, config.w // scale)
+
+    def loop_scatter():
+        instance_poses = torch.zeros((batch_size, ) + size + (34, 16))
+        n = 0
+        for i, point_list in enumerate(point_lists):
+            for k in range(len(point_list)):
+                y_coords, x_coords = get_downsampled_points(point_list, k, scale)
+                instance_poses[i, y_coords, x_coords] = out_capsule_poses[n]
+                n += 1
+        return instance_poses
+
+    def batched_scatter():
+        instance_map = get_instance_index_map(point_lists, scale, size, out_capsule_poses.device) + 1
+        return torch.cat((out_capsule_poses.new_zeros((1, 34, 16)), out_capsule_poses))[instance_map]
+
+    identical = torch.equal(loop_scatter(), batched_scatter())
+    loop_time, batched_time = timeit(loop_scatter, 3), timeit(batched_scatter, 3)
+
+    print('instance scatter | batch %d, %d instances | per instance: %6.1f ms | single gather: %6.1f ms | identical: %s'
+          % (batch_size, n_total, loop_time * 1000, batched_time * 1000, identical), flush=True)
+
+
+def loop_attention(queries, keys, values, n_heads, presence=None, top_down=False):
+    # The previous attention of TransformerRouting, one qkv_attention per head
+    split_size = queries.shape[-1] // n_heads
+    q_splits, k_splits, v_splits = [torch.split(x, split_size, -1) for x in (queries, keys, values)]
+
+    return torch.cat([qkv_attention(q_splits[i], k_splits[i], v_splits[i], presence, top_down) for i in range(n_heads)], -1)
+
+
+def bench_attention(batch_size=2, n_heads=8):
+    # the attention of transformer_routing_seg (2 output capsules at every h/4 position) and transformer_routing (34
+    # output capsules for a chunk of instances)
+    h, w = config.h // 4, config.w // 4
+    cases = [('seg', (2, 32), (batch_size, h, w, 36, 32)), ('instances', (34, config.vote_dim), (32, 400, config.vote_dim))]
+
+    generator = torch.Generator().manual_seed(0)
+    for name, query_shape, key_shape in cases:
+        queries = torch.randn(query_shape, generator=generator)
+        keys, values = torch.randn(key_shape, generator=generator), torch.randn(key_shape, generator=generator)
+        presence = (torch.rand(key_shape[:-1], generator=generator) > 0.2).float()
+
+        with torch.no_grad():
+            max_diff = max((loop_attention(queries, keys, values, n_heads, p, top_down) - multi_head_attention(queries, keys, values, n_heads, p, top_down)).abs().max().item()
+                           for p in (None, presence) for top_down in (False, True))
+
+            loop_time = timeit(lambda: loop_attention(queries, keys, values, n_heads), 3)
+            batched_time = timeit(lambda: multi_head_attention(queries, keys, values, n_heads), 3)
+
+        print('attention | %9s | keys %s | per head: %7.1f ms | heads batched: %7.1f ms | speedup: %4.2fx | max difference: %.1e'
+              % (name, tuple(key_shape), loop_time * 1000, batched_time * 1000, loop_time / batched_time, max_diff), flush=True)
+
+
+def pairwise_agreement_cost(poses, votes, acts):
+    # The agreement cost previously used in TransformerRouting.forward, from the differences of all pairs (N_j, N_i, F)
+    diff = (poses.unsqueeze(-2) - votes.unsqueeze(-3))**2
+    acts_res = acts.unsqueeze(-1).unsqueeze(-3)
+    return torch.sum(diff*acts_res, -2) / (torch.sum(acts_res, -2) + 1e-8)
+
+
+def saved_tensors_mb(fn):
+    """
+    Runs fn and returns the total size of the tensors saved for the backward pass in MB, counting the views of a tensor
+    once. Works on the meta device, so the memory of large batches can be found without allocating it.
+    """
+    saved = {}
+
+    def pack(tensor):
+        base = tensor._base if tensor._base is not None else tensor
+        saved[id(base)] = base
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+
+    return sum(tensor.numel() * tensor.element_size() for tensor in saved.values()) / 2 ** 20
+
+
+def bench_agreement_cost(batch_size=8, n_caps=36):
+    # transformer_routing_seg of the second stage (36 capsules at every h/4 position) with the training batch size
+    torch.manual_seed(0)
+    transformer_routing = TransformerRouting(n_feats_in=32, n_caps_out=2, hidden_dim=32, output_dim=16, use_vote_transform=False)
+    shape = (config.h // 4, config.w // 4, n_caps)
+
+    meta_routing = copy.deepcopy(transformer_routing).to('meta')
+
+    def train_step(routing, b):
+        device = routing.inducing_points.device
+        votes = torch.randn((b, ) + shape + (32, ), device=device, requires_grad=True)
+        acts = torch.rand((b, ) + shape, device=device, requires_grad=True)
+
+        poses, out_acts = routing(votes, acts)
+        if device.type != 'meta':
+            torch.autograd.grad(poses.sum() + (out_acts ** 2).sum(), [votes, acts])
+
+    votes, acts = torch.randn((1, ) + shape + (32, )), torch.rand((1, ) + shape)
+    with torch.no_grad():
+        expected = transformer_routing(votes, acts)[1]
+        with mock.patch.object(setTransformer, 'agreement_cost', pairwise_agreement_cost):
+            max_diff = (transformer_routing(votes, acts)[1] - expected).abs().max().item()
+
+    for name, cost_fn in [('pairwise', pairwise_agreement_cost), ('closed form', setTransformer.agreement_cost)]:
+        with mock.patch.object(setTransformer, 'agreement_cost', cost_fn):
+            saved_mb = saved_tensors_mb(lambda: train_step(meta_routing, batch_size))
+            _, peak_mb = measure_peak_memory(lambda: train_step(transformer_routing, 1))
+            step_time = timeit(lambda: train_step(transformer_routing, 1), 2)
+
+        print('agreement cost | %11s | batch %d: %7.0f MB saved for backward | batch 1: peak %6.0f MB, %6.0f ms/step'
+              % (name, batch_size, saved_mb, peak_mb, step_time * 1000), flush=True)
+
+    print('agreement cost | max difference of the activations: %.1e' % max_diff, flush=True)
+
+
+def bench_model_forward(batch_size=2, n_instances=30, h=512, w=1024, n_repeats=3):
+    """
+    Times the inference forward pass of CapsuleModel5 on the device of config.use_cuda. The instances are grouped with
+    the ground truth of synthetic scenes, so that the second stage routes a realistic number of instances even with
+    untrained weights.
+    """
+    device = 'cuda' if config.use_cuda else 'cpu'
+    model = CapsuleModel5('CapsuleModel5', tempfile.mkdtemp()).to(device).eval()
+
+    gt_seg, gt_reg = [], []
+    for i in range(batch_size):
+        instance_maps, segmentation_maps = random_instance_scene(n_instances, h, w, seed=i)
+        instance_regressions, regression_present = get_instance_targets(instance_maps, segmentation_maps)[:2]
+        gt_reg.append(torch.from_numpy(instance_regressions[::-1].astype(np.float32)))  # in x-y order
+        gt_seg.append(torch.from_numpy(regression_present.astype(np.float32))[None])
+
+    images = torch.randn(batch_size, 3, h, w, device=device)
+    gt_seg, gt_reg = torch.stack(gt_seg).to(device), torch.stack(gt_reg).to(device)
+
+    def forward():
+        with torch.no_grad():
+            outputs = model(images, gt_seg=gt_seg, gt_reg=gt_reg)
+        if config.use_cuda:
+            torch.cuda.synchronize()
+        return outputs
+
+    n_routed = sum(len(class_output) for class_output in forward()[2][-1])
+    seconds = timeit(forward, n_repeats)
+    print('model forward | %s | %dx%d, batch %d, %d instances: %7.0f ms/batch, %.2f images/s'
+          % (device, h, w, batch_size, n_routed, seconds * 1000, batch_size / seconds), flush=True)
+
+
+class LoopVotingModule(nn.Module):
+    # The previous VotingModule, one convolution per capsule type
+    def __init__(self, n_caps_in, in_caps_dim, vote_dim, kernel_dim=1, dilation=1, relu=False):
+        super(LoopVotingModule, self).__init__()
+        self.n_caps_in, self.in_caps_dim, self.vote_dim, self.relu = n_caps_in, in_caps_dim, vote_dim, relu
+        padding = (kernel_dim - 1 + (kernel_dim - 1)*(dilation - 1))//2
+        self.vote_transform = nn.ModuleList([nn.Conv2d(in_caps_dim, vote_dim, kernel_dim, padding=padding, dilation=dilation) for _ in range(n_caps_in)])
+
+    def forward(self, poses):
+        b, _, h, w = poses.shape
+        poses = poses.view(b, self.n_caps_in, self.in_caps_dim, h, w)
+        votes = torch.stack([self.vote_transform[i](poses[:, i]) for i in range(self.n_caps_in)], 1).view(b, self.n_caps_in*self.vote_dim, h, w)
+        return F.relu(votes) if self.relu else votes
+
+
+def bench_voting_modules(batch_size=2, n_repeats=3):
+    # Every VotingModule of CapsuleModel5, at the input shape it gets in a forward pass of a batch of batch_size
+    # config.h x config.w images. The grouped modules load the state_dict of the previous modules, which checks the
+    # conversion of the old checkpoints.
+    device = 'cuda' if config.use_cuda else 'cpu'
+    model = CapsuleModel5('CapsuleModel5', tempfile.mkdtemp()).to(device).eval()
+    voting_modules = [(name, module) for name, module in model.named_modules() if isinstance(module, VotingModule)]
+
+    input_shapes = {}
+
+    def record_input_shape(name):
+        def hook(module, inputs):
+            input_shapes[name] = inputs[0].shape
+        return hook
+
+    hooks = [module.register_forward_pre_hook(record_input_shape(name)) for name, module in voting_modules]
+    with torch.no_grad():
+        model(torch.randn(1, 3, config.h, config.w, device=device))
+    for hook in hooks:
+        hook.remove()
+
+    generator = torch.Generator().manual_seed(0)
+    total_loop_time, total_grouped_time = 0, 0
+    for name, module in voting_modules:
+        if name not in input_shapes:  # not used by the forward pass
+            continue
+
+        loop_module = LoopVotingModule(module.n_caps_in, module.in_caps_dim, module.vote_dim, module.kernel_dim, module.dilation, module.relu).to(device)
+        grouped_module = copy.deepcopy(module)
+        grouped_module.load_state_dict(loop_module.state_dict())
+
+        poses = torch.randn((batch_size,) + tuple(input_shapes[name][1:]), generator=generator).to(device)
+
+        def run(voting_module):
+            with torch.no_grad():
+                votes = voting_module(poses)
+            if config.use_cuda:
+                torch.cuda.synchronize()
+            return votes
+
+        max_diff = (run(loop_module) - run(grouped_module)).abs().max().item()
+        loop_time, grouped_time = timeit(lambda: run(loop_module), n_repeats), timeit(lambda: run(grouped_module), n_repeats)
+        total_loop_time, total_grouped_time = total_loop_time + loop_time, total_grouped_time + grouped_time
+
+        print('voting modules | %s | %28s | poses %s, %dx%d kernel: per capsule %7.1f ms | grouped %7.1f ms | speedup: %4.2fx | max difference: %.1e'
+              % (device, name, tuple(poses.shape), module.kernel_dim, module.kernel_dim, loop_time * 1000, grouped_time * 1000,
+                 loop_time / grouped_time, max_diff), flush=True)
+
+    print('voting modules | %s | %28s | per capsule %7.1f ms | grouped %7.1f ms | speedup: %4.2fx'
+          % (device, 'total', total_loop_time * 1000, total_grouped_time * 1000, total_loop_time / total_grouped_time), flush=True)
+
+
+benchmarks = {
+    'instance_targets': bench_instance_targets,
+    'augmentation': bench_augmentation,
+    'pyramid': bench_pyramid,
+    'balanced_batches': bench_balanced_batches,
+    'vote_map': bench_vote_map,
+    'inst_maps': bench_inst_maps,
+    'center_index': bench_center_index,
+    'instance_pixels': bench_instance_pixels,
+    'batched_hough': bench_batched_hough,
+    'low_res_hough': bench_low_res_hough,
+    'numpy_hough': bench_numpy_hough,
+    'instance_routing': bench_instance_routing,
+    'instance_scatter': bench_instance_scatter,
+    'attention': bench_attention,
+    'agreement_cost': bench_agreement_cost,
+    'model_forward': bench_model_forward,
+    'voting_modules': bench_voting_modules,
+}
+
+
+if __name__ == '__main__':
+    # Usage: python benchmarks.py [benchmark_name ...]
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks)
+    for name in names:
+        benchmarks[name]()
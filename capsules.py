@@ -40,7 +40,7 @@ class PrimaryCaps(nn.Module):
         a = self.a(x)
 
         if self.training:
-            a += ((torch.rand(*a.shape) - 0.5) * self.noise_scale).cuda()
+            a += (torch.rand_like(a) - 0.5) * self.noise_scale
 
         a = self.sigmoid(a)
 
@@ -101,7 +101,7 @@ class ConvCaps(nn.Module):
         self.eps = 1e-8
         # self._lambda = 1e-03
         self._lambda = 1e-3  # could have this as lower value for more stability
-        self.ln_2pi = torch.cuda.FloatTensor(1).fill_(math.log(2*math.pi))
+        self.ln_2pi = math.log(2*math.pi)
         # params
         # Note that \beta_u and \beta_a are per capsul/home/bruce/projects/capsulese type,
         # which are stated at https://openreview.net/forum?id=HJWLfGWRb&noteId=rJUY2VdbM
@@ -210,7 +210,7 @@ class ConvCaps(nn.Module):
         assert c == C
         assert (b, B, 1) == a_in.shape
 
-        r = torch.cuda.FloatTensor(b, B, C).fill_(1./C)
+        r = torch.full((b, B, C), 1./C, dtype=v.dtype, device=v.device)
         for iter_ in range(self.iters):
             a_out, mu, sigma_sq = self.m_step(a_in, r, v, eps, b, B, C, psize)
             if iter_ < self.iters - 1:
@@ -266,8 +266,8 @@ class ConvCaps(nn.Module):
         assert h == w
         v = v.view(b, h, w, B, C, psize)
         coor = 1. * torch.arange(h) / h
-        coor_h = torch.cuda.FloatTensor(1, h, 1, 1, 1, self.psize).fill_(0.)
-        coor_w = torch.cuda.FloatTensor(1, 1, w, 1, 1, self.psize).fill_(0.)
+        coor_h = torch.zeros((1, h, 1, 1, 1, self.psize), dtype=v.dtype, device=v.device)
+        coor_w = torch.zeros((1, 1, w, 1, 1, self.psize), dtype=v.dtype, device=v.device)
         coor_h[0, :, 0, 0, 0, 0] = coor
         coor_w[0, 0, :, 0, 0, 1] = coor
         v = v + coor_h + coor_w
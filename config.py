@@ -48,7 +48,29 @@ use_top_down_routing = False
 
 data_dir = './CityscapesData'
 
+use_target_cache = False  # caches the decoded images and targets of samples without random augmentation (i.e. val)
+target_cache_dir = './CityscapesCache'
+
+use_shards = False  # streams the samples from the packed shards written by shards.py
+shard_dir = './CityscapesShards'
+shard_size_mb = 512
+shuffle_buffer_size = 32
+
+use_pyramid = False  # decodes the samples from the pre-resized images written by pyramid.py
+pyramid_dir = './CityscapesPyramid'
+pyramid_scales = (1, 2, 4)  # downscaling factors of the stored resolutions, 1 is the original dataset
+
+point_list_scales = (4, 16)  # grid scales at which the instance points are also stored (used by scatter_capsules)
+
 num_workers = 8
+sampler_seed = 0  # seeds the order of the training samples, which is continued exactly when resuming from a checkpoint
+balance_instances = False  # builds batches with a similar total number of instances (see InstanceBalancedBatchSampler)
+instance_index_file = './instance_counts_train.json'  # written by samplers.py
+balance_window_batches = 8
+
+profile_pipeline = False  # records the latency of every data pipeline stage and the time training waits for data
+pipeline_stats_file = './pipeline_stats.jsonl'
+pipeline_stats_every_n_iters = 100
 
 seg_coef = 1.0
 regression_coef = 1.0
@@ -57,3 +79,15 @@ class_coef = 1.0
 h, w = 512, 1024
 
 use_instance = True
+
+hough_vote_memory_mb = 512  # memory ceiling of the vote map in HoughRouting1, None computes the whole map at once
+hough_center_index = 'brute_force'  # 'brute_force' or 'grid', how pixels are assigned to their closest center (same results)
+hough_batched = True  # groups the instances of all images of a batch at once (same results as one image at a time)
+hough_scale = 1  # 4 finds the centers and groups the pixels at the resolution of the capsules (h/4), see bench_low_res_hough
+
+instance_routing_memory_mb = 256 if use_cuda else 8  # memory ceiling of the padded instance capsules routed at once (see route_instances), small on the CPU to stay in cache
+
+inference_hough_workers = 2  # threads grouping the instances in pipelined_inference.py
+inference_hough_backend = 'torch'  # 'numpy' groups the instances in worker processes with hough_numpy.py (the same up to float32 rounding)
+inference_export_workers = 4  # threads saving the instance masks in pipelined_inference.py
+inference_batches_in_flight = 3  # batches between the forward pass and the classification in pipelined_inference.py
@@ -5,14 +5,283 @@ from torch.utils.data import DataLoader
 from torchvision.datasets import Cityscapes
 from torchvision import transforms
 from PIL import Image
+from target_cache import TargetCache
+from pyramid import ImagePyramid
+from packed_points import PackedPoints, pack_points
+from pipeline_stats import stage, flush_stages
 import config
 
 
+EVAL_ID_TO_TRAIN_ID = np.array([255, 255, 255, 255, 255, 255, 255, 0, 1, 255, 255, 2, 3, 4, 255, 255,
+                                255, 5, 255, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 255, 255, 16, 17, 18, 255])
+
+
 def get_cityscapes_dataset(root='./CityscapesData/', train=True):
     split = 'train' if train else 'val'
-    return CustomCityscapes(root, split=split, mode='fine', target_type=['semantic', 'instance'])
+
+    if config.use_shards:
+        from shards import ShardedCityscapes
+        return ShardedCityscapes(config.shard_dir, split, batch_size=config.batch_size)
+
+    target_cache = TargetCache(config.target_cache_dir) if config.use_target_cache else None
+    pyramid = ImagePyramid(root, config.pyramid_dir, config.pyramid_scales) if config.use_pyramid else None
+    return CustomCityscapes(root, split=split, mode='fine', target_type=['semantic', 'instance'], target_cache=target_cache, pyramid=pyramid)
+
+def get_instance_targets(instance_maps, segmentation_maps):
+    """
+    Builds the per-instance training targets with a single sort/bincount pass over the instance map.
+
+    :param instance_maps: An instance map of shape (H, W), where values >= 1000 are instance ids.
+    :param segmentation_maps: The semantic segmentation map of shape (H, W).
+    :return: The center regressions (2, H, W) in y-x order as int16, the regression presence map (H, W) as uint8, the
+    segmentation weights (H, W) as uint8, the class of each instance (K, ), the points of all instances concatenated with
+    shape (2, N) and the number of points of each instance (K, ).
+    """
+    h, w = instance_maps.shape
+
+    instance_regressions = np.zeros((2, h, w), dtype=np.int16)
+    regression_present = np.zeros((h, w), dtype=np.uint8)
+    segmentation_weights = np.ones((h, w), dtype=np.uint8)
+
+    flat_instances = instance_maps.ravel()
+    fg_inds = np.flatnonzero(flat_instances >= 1000)  # foreground pixels in raster order
+
+    if len(fg_inds) == 0:
+        empty_points, empty_counts = np.zeros((2, 0), dtype=np.int64), np.zeros((0, ), dtype=np.int64)
+        return instance_regressions, regression_present, segmentation_weights, segmentation_maps.ravel()[:0], empty_points, empty_counts
+
+    # groups the pixels by instance id while keeping the raster order within each instance (same as np.where)
+    order = np.argsort(flat_instances[fg_inds], kind='stable')
+    fg_inds = fg_inds[order]
+    sorted_values = flat_instances[fg_inds]
+
+    starts = np.flatnonzero(np.concatenate(([True], sorted_values[1:] != sorted_values[:-1])))
+    counts = np.diff(np.append(starts, len(fg_inds)))
+    instance_ids = np.repeat(np.arange(len(starts)), counts)
+
+    classes = segmentation_maps.ravel()[fg_inds[starts]]  # the class of the first pixel of each instance
+
+    pixels = np.stack(np.divmod(fg_inds, w))  # (2, N) in y-x order
+
+    n_instances = len(starts)
+    sums = np.stack([np.bincount(instance_ids, weights=pixels[0], minlength=n_instances),
+                     np.bincount(instance_ids, weights=pixels[1], minlength=n_instances)])
+
+    centers = np.round(sums / counts).astype(np.int32)  # gives the centers (y, x) - Shape (2, K)
+    centers[0] = np.clip(centers[0], 17, h - 17)
+    centers[1] = np.clip(centers[1], 17, w - 17)
+
+    instance_regressions.reshape(2, -1)[:, fg_inds] = pixels - centers[:, instance_ids]
+    regression_present.ravel()[fg_inds] = 1
+
+    small_instances = counts <= 64 * 64
+    segmentation_weights.ravel()[fg_inds[small_instances[instance_ids]]] = 10
+
+    return instance_regressions, regression_present, segmentation_weights, classes, pixels, counts
+
+
+def get_augmentation_params(image_size):
+    """
+    Draws the random flip and scale-crop of a training sample. The random calls are the same as in the previous
+    flip, pad, crop and resize pipeline, so the same crops are drawn for a given seed.
+
+    :param image_size: The (width, height) of the image.
+    :return: The flip flag and the crop box (x0, y0, x1, y1) in the coordinates of the (flipped) image. The box can extend
+    past the image borders, where the padding is filled with 255.
+    """
+    # random_sample([0, 1]) is an empty array, so samples are never flipped and no random number is consumed
+    flip = bool((np.random.random_sample([0, 1]) >= 0.5).any())
+
+    crop_perc = np.random.choice([x / 10 for x in range(5, 15)])
+    image_w, image_h = image_size
+    crop_w, crop_h = int(image_w * crop_perc), int(image_h * crop_perc)
+
+    left_padding, top_padding = 0, 0
+    if crop_perc > 1:
+        diff_w, diff_h = crop_w - image_w, crop_h - image_h
+        left_padding = np.random.randint(0, diff_w)
+        top_padding = np.random.randint(0, diff_h)
+
+        # the image is padded by crop_w and crop_h in total
+        image_w, image_h = image_w + crop_w, image_h + crop_h
+
+    start_x = np.random.randint(0, image_w - crop_w + 1) - left_padding
+    start_y = np.random.randint(0, image_h - crop_h + 1) - top_padding
+
+    return flip, (start_x, start_y, start_x + crop_w, start_y + crop_h)
+
+
+def resample_map(image, flip, crop_box, size, resample, fill=255):
+    """
+    Flips, crops and resizes an image or label map with a single resample, without full resolution intermediates.
+
+    :param image: A PIL image.
+    :param flip: If True, the image is flipped horizontally before cropping.
+    :param crop_box: The crop box (x0, y0, x1, y1) in the coordinates of the (flipped) image.
+    :param size: The (width, height) of the output.
+    :param resample: The PIL resampling filter, Image.NEAREST should be used for label maps (which are sampled exactly
+    like crop and resize).
+    :param fill: The value of the output pixels which fall outside of the image.
+    :return: The resampled PIL image.
+    """
+    w, h = size
+    image_w, image_h = image.size
+    x0, y0, x1, y1 = crop_box
+
+    scale_x, scale_y = (x1 - x0) / w, (y1 - y0) / h
+
+    bands = len(image.getbands())
+    fill = (fill, ) * bands if bands > 1 else fill
+
+    if resample == Image.NEAREST:
+        # The affine transform samples the same pixels as cropping and resizing, and fills the pixels outside the image
+        if flip:  # the small offset rounds pixel borders to the same side as flipping the full image
+            data = (-scale_x, 0, image_w - x0 - 1e-6, 0, scale_y, y0)
+        else:
+            data = (scale_x, 0, x0, 0, scale_y, y0)
+
+        return image.transform((w, h), Image.AFFINE, data, resample=Image.NEAREST, fillcolor=fill)
+
+    # Other filters use resize, which (unlike transform) antialiases when downscaling
+    if flip:  # crops the mirrored box, and flips the (small) output instead
+        x0, x1 = image_w - x1, image_w - x0
+
+    # the output pixels whose centers fall inside of the image
+    out_x0, out_x1 = max(0, int(np.ceil(-x0 / scale_x - 0.5))), min(w, int(np.ceil((image_w - x0) / scale_x - 0.5)))
+    out_y0, out_y1 = max(0, int(np.ceil(-y0 / scale_y - 0.5))), min(h, int(np.ceil((image_h - y0) / scale_y - 0.5)))
+
+    if (out_x0, out_y0, out_x1, out_y1) == (0, 0, w, h):
+        output = image.resize(size=(w, h), resample=resample, box=(x0, y0, x1, y1))
+    else:
+        output = Image.new(image.mode, (w, h), fill)
+
+        if out_x1 > out_x0 and out_y1 > out_y0:
+            box = (max(0, x0 + out_x0 * scale_x), max(0, y0 + out_y0 * scale_y),
+                   min(image_w, x0 + out_x1 * scale_x), min(image_h, y0 + out_y1 * scale_y))
+            output.paste(image.resize(size=(out_x1 - out_x0, out_y1 - out_y0), resample=resample, box=box), (out_x0, out_y0))
+
+    if flip:
+        output = output.transpose(Image.FLIP_LEFT_RIGHT)
+
+    return output
+
+
+def process_images(image, segmentation_maps, instance_maps, augmentation=None):
+    """
+    Augments and resizes the decoded image and label maps of a sample and builds its training targets.
+
+    :param image: The RGB PIL image.
+    :param segmentation_maps: The semantic PIL label map.
+    :param instance_maps: The instance PIL label map.
+    :param augmentation: The flip flag and crop box returned by get_augmentation_params (in the coordinates of the
+    given image), or None to resize the whole image.
+    :return: A dictionary of numpy arrays, which can be stored in the target cache.
+    """
+    h = config.h
+    w = config.w
+
+    if augmentation is not None:
+        flip, crop_box = augmentation
+    else:
+        flip, crop_box = False, (0, 0) + image.size
+
+    # flips, crops and resizes every map with a single resample
+    with stage('augmentation'):
+        image = resample_map(image, flip, crop_box, (w, h), Image.BILINEAR)
+        segmentation_maps = resample_map(segmentation_maps, flip, crop_box, (w, h), Image.NEAREST)
+        instance_maps = resample_map(instance_maps, flip, crop_box, (w, h), Image.NEAREST)
+
+    instance_maps = np.array(instance_maps)
+
+    with stage('targets'):
+        x = get_instance_targets(instance_maps, np.array(segmentation_maps))
+    instance_regressions, regression_present, segmentation_weights, classes, points, point_counts = x
+
+    instance_regressions = np.concatenate((instance_regressions[1:], instance_regressions[:1]), 0)  # Changes from y-x to x-y
+
+    instance_present = np.expand_dims(regression_present, 0)
+    segmentation_weights = np.expand_dims(segmentation_weights, 0)
+
+    segmentation_maps = np.expand_dims(np.array(segmentation_maps), 0)  # (H, W)
+
+    if config.n_classes == 19:
+        segmentation_maps[segmentation_maps == 255] = 0
+        segmentation_maps = EVAL_ID_TO_TRAIN_ID[segmentation_maps]
+    elif config.n_classes == 34:
+        segmentation_maps = segmentation_maps
+    else:
+        assert NotImplementedError, "Must have either 19 or 34 classes for Cityscapes"
+
+    sample = {'image': np.array(image), 'instance_regressions': instance_regressions, 'instance_present': instance_present,
+              'segmentation_weights': segmentation_weights, 'classes': classes}
+
+    # The points of all instances are packed into flat arrays, so that they cross the worker boundary as a few arrays
+    with stage('pack_points'):
+        packed_points = pack_points(points, point_counts, (h, w), config.point_list_scales)
+    sample.update({'points_' + name: array for name, array in packed_points.items()})
+
+    return sample
+
+
+def format_sample(sample, img_name):
+    """
+
+    :param sample: A dictionary of numpy arrays, as returned by process_images.
+    :param img_name: The image file name.
+    :return: The image, targets, class list, point list and image name, as returned by CustomCityscapes.
+    """
+    image = transforms.functional.to_tensor(np.array(sample['image']))
+
+    targets = (sample['instance_regressions'], sample['instance_present'], sample['segmentation_weights'])
+
+    class_list = list(sample['classes'])
+
+    # the point arrays are small, so they are copied out of the (read-only) cache memory maps
+    packed_points = {name[len('points_'):]: np.array(array) for name, array in sample.items() if name.startswith('points_')}
+    point_list = PackedPoints.from_numpy(packed_points, image.shape[1:], config.point_list_scales)
+
+    return image, targets, class_list, point_list, img_name
+
+
+def get_batch_buffer(shape, dtype):
+    """
+    Allocates the tensor a batch is collated into. Inside DataLoader workers it is placed in shared memory, so the batch
+    is not copied again when it is sent to the main process.
+    """
+    batch = torch.empty(shape, dtype=dtype)
+
+    if torch.utils.data.get_worker_info() is not None:
+        batch.share_memory_()
+
+    return batch
+
+
+def stack_arrays(arrays):
+    """
+
+    :param arrays: A list of numpy arrays with the same shape and dtype.
+    :return: A tensor of shape (B, ...) with the dtype of the arrays, filled with a single copy of each array.
+    """
+    dtype = torch.from_numpy(np.empty(0, dtype=arrays[0].dtype)).dtype
+    batch = get_batch_buffer((len(arrays), ) + arrays[0].shape, dtype)
+
+    batch_array = batch.numpy()
+    for i, array in enumerate(arrays):
+        batch_array[i] = array
+
+    return batch
+
 
 def custom_collate(batch):
+    with stage('collate'):
+        batch = collate_batch(batch)
+
+    flush_stages()  # sends the stage timings of this worker to the main process, if they are recorded
+
+    return batch
+
+
+def collate_batch(batch):
     image = []
     instance_regressions = []
     instance_present = []
@@ -22,27 +291,31 @@ def custom_collate(batch):
     image_name = []
     for image1, (instance_regressions1, instance_present1, segmentation_weights1), class_list1, point_list1, image_name1 in batch:
        image.append(image1)
-       instance_regressions.append(torch.tensor(instance_regressions1))
-       instance_present.append(torch.tensor(instance_present1))
-       segmentation_weights.append(torch.tensor(segmentation_weights1))
+       instance_regressions.append(instance_regressions1)
+       instance_present.append(instance_present1)
+       segmentation_weights.append(segmentation_weights1)
        class_list.append(torch.tensor(class_list1).long() if class_list1 != [] else [])
-       point_list.append([torch.Tensor(item).long() for item in point_list1]) # point_list1 is a list of 4 tensors (2, N)
+       point_list.append(point_list1)  # PackedPoints holding the (2, N) points of each instance
        image_name.append(image_name1)
-    image = torch.stack(image)
-    instance_regressions = torch.stack(instance_regressions)
-    instance_present = torch.stack(instance_present)
-    segmentation_weights = torch.stack(segmentation_weights)
+    image = torch.stack(image, out=get_batch_buffer((len(image), ) + image[0].shape, image[0].dtype))
+
+    # the targets keep their compact dtypes
+    instance_regressions = stack_arrays(instance_regressions)
+    instance_present = stack_arrays(instance_present)
+    segmentation_weights = stack_arrays(segmentation_weights)
     
     return image, (instance_regressions, instance_present, segmentation_weights), class_list, point_list, image_name
 
 
 
 class CustomCityscapes(Cityscapes):
-    def __init__(self, root, split, mode, target_type):
+    def __init__(self, root, split, mode, target_type, target_cache=None, pyramid=None):
         super(CustomCityscapes, self).__init__(root, split=split, mode=mode, target_type=target_type)
         self.to_tensor = transforms.ToTensor()
 
         self.split = split
+        self.target_cache = target_cache
+        self.pyramid = pyramid
 
         self.gaussian = np.zeros((33, 33))
         for i in range(33):
@@ -61,89 +334,44 @@ class CustomCityscapes(Cityscapes):
 
     def __getitem__(self, index):
         img_name = self.images[index]
-        h = config.h
-        w = config.w
-
-        image, (segmentation_maps, instance_maps) = super().__getitem__(index)
-
-        if self.split == 'train':
-            if np.random.random_sample([0, 1]) >= 0.5:
-                image = transforms.functional.hflip(image)
-                segmentation_maps = transforms.functional.hflip(segmentation_maps)
-                instance_maps = transforms.functional.hflip(instance_maps)
-
-            crop_perc = np.random.choice([x / 10 for x in range(5, 15)])
-            image_w, image_h = image.size
-            crop_w, crop_h = int(image_w * crop_perc), int(image_h * crop_perc)
-
-            if crop_perc > 1:
-                diff_w, diff_h = crop_w - image_w, crop_h - image_h
-                left_padding = np.random.randint(0, diff_w)
-                top_padding = np.random.randint(0, diff_h)
-                pad_tuple = (left_padding, top_padding, crop_w - left_padding, crop_h - top_padding)
-
-                image = transforms.functional.pad(image, pad_tuple, fill=255)
-                segmentation_maps = transforms.functional.pad(segmentation_maps, pad_tuple, fill=255)
-                instance_maps = transforms.functional.pad(instance_maps, pad_tuple, fill=255)
-
-                image_w, image_h = image.size
 
-            start_x = np.random.randint(0, image_w - crop_w + 1)
-            start_y = np.random.randint(0, image_h - crop_h + 1)
-            crop_tuple = (start_x, start_y, start_x + crop_w, start_y + crop_h)
-            image = image.crop(crop_tuple)
-            segmentation_maps = segmentation_maps.crop(crop_tuple)
-            instance_maps = instance_maps.crop(crop_tuple)
+        if self.target_cache is not None and self.split != 'train':  # only samples without random augmentation are cached
+            key = self.target_cache.get_key(img_name, [self.images[index]] + self.targets[index])
 
-        image = image.resize(size=(w, h), resample=Image.BILINEAR)
-        segmentation_maps = segmentation_maps.resize(size=(w, h), resample=Image.NEAREST)
-        instance_maps = instance_maps.resize(size=(w, h), resample=Image.NEAREST)
-
-        instance_maps = np.array(instance_maps)
-        instance_regressions = np.zeros((2, h, w))
-        regression_present = np.zeros((h, w))
-        segmentation_weights = np.ones((h, w))
-
-        unique_values = np.unique(instance_maps)
-
-        instance_values = [x for x in unique_values if x >= 1000]
-
-        point_list = []
-        class_list = []
-        for instance in instance_values:
-            pixels = np.stack(np.where(instance_maps == instance))
-
-            point_list.append(pixels)
-
-            center = np.round(np.mean(pixels, 1)).astype(np.int32)  # gives the center (y, x)
-            center = np.array((min(h - 17, max(17, center[0])), min(w - 17, max(17, center[1]))))
-            
-            class_list.append(np.array(segmentation_maps)[pixels[0][0]][pixels[1][0]])
-
-            dists = pixels - np.expand_dims(center, 1)
-
-            instance_regressions[:, pixels[0], pixels[1]] = dists
-            regression_present[pixels[0], pixels[1]] = 1
-
-            if pixels.shape[1] <= 64 * 64:
-                segmentation_weights[pixels[0], pixels[1]] = 10
+            with stage('cache_load'):
+                sample = self.target_cache.load(key)
+            if sample is None:
+                sample = self.get_sample(index)
+                with stage('cache_save'):
+                    self.target_cache.save(key, sample)
+        else:
+            sample = self.get_sample(index)
 
-        instance_regressions = np.concatenate((instance_regressions[1:], instance_regressions[:1]), 0)  # Changes from y-x to x-y
+        with stage('format'):
+            return format_sample(sample, img_name)
 
-        instance_present = np.expand_dims(regression_present, 0)
-        segmentation_weights = np.expand_dims(segmentation_weights, 0)
+    def get_sample(self, index):
+        """
+        Decodes the image and label maps of a sample, augments and resizes them and builds the training targets.
 
-        image = self.to_tensor(image)
+        :return: A dictionary of numpy arrays, which can be stored in the target cache.
+        """
+        if self.pyramid is not None:
+            files = [self.images[index]] + self.targets[index]
 
-        segmentation_maps = np.expand_dims(np.array(segmentation_maps), 0)  # (H, W)
+            image_size = self.pyramid.get_image_size(files)
+            flip, crop_box = get_augmentation_params(image_size) if self.split == 'train' else (False, (0, 0) + image_size)
 
-        if config.n_classes == 19:
-            segmentation_maps[segmentation_maps == 255] = 0
-            segmentation_maps = self.conv_eval_to_train(segmentation_maps)
-        elif config.n_classes == 34:
-            segmentation_maps = segmentation_maps
+            # decodes the smallest stored resolution which covers the crop, and scales the crop box to it
+            scale = self.pyramid.get_scale(crop_box, (config.w, config.h))
+            with stage('decode'):
+                image, segmentation_maps, instance_maps = self.pyramid.load(files, scale)
+                segmentation_maps.load(), instance_maps.load()  # PIL decodes lazily, so this keeps the decode in this stage
+            augmentation = (flip, tuple(c / scale for c in crop_box))
         else:
-            assert NotImplementedError, "Must have either 19 or 34 classes for Cityscapes"
-
-        return image, (instance_regressions, instance_present, segmentation_weights), class_list, point_list, img_name
+            with stage('decode'):
+                image, (segmentation_maps, instance_maps) = super().__getitem__(index)
+                segmentation_maps.load(), instance_maps.load()
+            augmentation = get_augmentation_params(image.size) if self.split == 'train' else None
 
+        return process_images(image, segmentation_maps, instance_maps, augmentation)
@@ -0,0 +1,287 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # the vectorized NumPy versions of the loops are used
+    numba = None
+
+
+# A CPU implementation of the Hough grouping of HoughRouting1 (with scale 1) on NumPy arrays. It does not use torch, so
+# that it can run in worker processes (see group_images), and uses Numba to compile the loops over the pixels when it is
+# installed.
+#
+# The vote errors are summed over the circle in raster order, while HoughCapsules.get_vote_errors reduces the (K, K)
+# patches in the order of torch's kernels, so the errors (and the center threshold) differ by float32 rounding, by at
+# most VOTE_ERROR_RTOL relative. All other operations are the same as in HoughCapsules.py, so the outputs are identical
+# unless such a difference decides a near tie of the NMS or the center threshold, which can move or drop a center.
+VOTE_ERROR_RTOL = 1e-5
+
+
+def jit(fn):
+    return numba.njit(cache=True)(fn) if numba is not None else None
+
+
+def get_circle_offsets(circle_radius=5):
+    """
+
+    :return: The (x, y) offsets of the kernel positions inside the circle (M, 2) in raster order, the number of positions
+    and the error threshold of the centers, as in HoughCapsules.get_circle_kernel.
+    """
+    k_size = circle_radius * 2 + 1
+
+    y_coords, x_coords = np.mgrid[:k_size, :k_size] - circle_radius
+    circle_dists = np.sqrt((x_coords ** 2 + y_coords ** 2).astype(np.float32))
+    inside = circle_dists <= circle_radius
+
+    n_pixels_in_circle = np.float32(inside.sum())
+
+    center_threshold = circle_dists[inside].sum() / n_pixels_in_circle + np.float32(0.5)
+
+    return np.stack((x_coords[inside], y_coords[inside]), 1), n_pixels_in_circle, center_threshold
+
+
+def vote_error_loop(regressions, offsets, n_pixels_in_circle, errors):
+    # regressions are padded by the circle radius r
+    r = (regressions.shape[1] - errors.shape[0]) // 2
+    h, w = errors.shape
+
+    for y in range(h):
+        for x in range(w):
+            error_sum = np.float32(0)
+            for k in range(offsets.shape[0]):
+                dx, dy = offsets[k, 0], offsets[k, 1]
+                x_error = np.float32(dx) - regressions[0, y + r + dy, x + r + dx]
+                y_error = np.float32(dy) - regressions[1, y + r + dy, x + r + dx]
+                error_sum += np.sqrt(x_error * x_error + y_error * y_error)
+            errors[y, x] = error_sum / n_pixels_in_circle
+
+
+vote_error_loop_jit = jit(vote_error_loop)
+
+
+def get_vote_errors(center_regressions, circle_radius=5):
+    """
+    The same as HoughCapsules.get_vote_errors for one image, up to float32 rounding (see VOTE_ERROR_RTOL).
+
+    :param center_regressions: The center regressions of shape (2, H, W) as float32.
+    :return: The mean center error of shape (H, W).
+    """
+    _, h, w = center_regressions.shape
+    offsets, n_pixels_in_circle, _ = get_circle_offsets(circle_radius)
+    r = circle_radius
+
+    regressions = np.pad(center_regressions, ((0, 0), (r, r), (r, r)))
+
+    if vote_error_loop_jit is not None:
+        errors = np.empty((h, w), dtype=np.float32)
+        vote_error_loop_jit(regressions, offsets, n_pixels_in_circle, errors)
+        return errors
+
+    error_sum = np.zeros((h, w), dtype=np.float32)
+    for dx, dy in offsets.tolist():
+        regression_window = regressions[:, r + dy:r + dy + h, r + dx:r + dx + w]
+
+        x_error, y_error = np.float32(dx) - regression_window[0], np.float32(dy) - regression_window[1]
+        error_sum += np.sqrt(x_error * x_error + y_error * y_error)
+
+    return error_sum / n_pixels_in_circle
+
+
+def min_filter(x, kernel_size):
+    # The minimum over the kernel_size x kernel_size window around every pixel, the same as -max_pool2d(-x)
+    pad = kernel_size // 2
+    x = np.pad(x, pad, constant_values=np.inf)
+
+    x = np.lib.stride_tricks.sliding_window_view(x, kernel_size, axis=0).min(-1)
+    return np.lib.stride_tricks.sliding_window_view(x, kernel_size, axis=1).min(-1)
+
+
+def get_center_map(center_regressions, circle_radius=5, nms_kernel_size=7):
+    """
+    The same as HoughRouting1.get_center_maps for one image.
+
+    :return: The center map (H, W), where the centers have their error + 1 and all other pixels are 0.
+    """
+    _, _, center_threshold = get_circle_offsets(circle_radius)
+
+    vote_map = get_vote_errors(center_regressions, circle_radius) + np.float32(1)
+
+    vote_map[min_filter(vote_map, nms_kernel_size) != vote_map] = 0  # performs NMS on the prediction error
+    vote_map[vote_map >= center_threshold] = 0
+
+    return vote_map
+
+
+def get_centers(center_map, top_k=200):
+    """
+    The same as HoughCapsules.get_centers.
+
+    :return: The top_k center coordinates (N, 2) in y-x order and their errors (N, ), or None, None without centers.
+    """
+    center_coords = np.stack(np.nonzero(center_map), 1)  # in raster order
+
+    if center_coords.shape[0] == 0:
+        return None, None
+
+    center_errors = center_map[center_coords[:, 0], center_coords[:, 1]]
+    top_k_inds = np.argsort(center_errors, kind='stable')[:top_k]
+
+    return center_coords[top_k_inds], center_errors[top_k_inds]
+
+
+def nearest_center_loop(coords_pred, x_centers, y_centers, closest_inds):
+    tie_scale = np.float32(1 + 2 ** -21)
+
+    for i in range(coords_pred.shape[1]):
+        x_pred, y_pred = coords_pred[0, i], coords_pred[1, i]
+
+        min_dist, closest = np.float32(np.inf), 0
+        for k in range(x_centers.shape[0]):
+            dx, dy = x_pred - x_centers[k], y_pred - y_centers[k]
+            dist = dx * dx + dy * dy
+            if dist < min_dist:
+                min_dist, closest = dist, k
+
+        # near ties are resolved on the rounded distances, with the first center winning
+        n_ties = 0
+        for k in range(x_centers.shape[0]):
+            dx, dy = x_pred - x_centers[k], y_pred - y_centers[k]
+            if dx * dx + dy * dy <= min_dist * tie_scale:
+                n_ties += 1
+
+        if n_ties > 1:
+            min_root = np.float32(np.inf)
+            for k in range(x_centers.shape[0]):
+                dx, dy = x_pred - x_centers[k], y_pred - y_centers[k]
+                root = np.sqrt(dx * dx + dy * dy)
+                if root < min_root:
+                    min_root, closest = root, k
+
+        closest_inds[i] = closest
+
+
+nearest_center_loop_jit = jit(nearest_center_loop)
+
+
+def assign_nearest_centers(coords_pred, center_coords, max_memory_mb=64):
+    """
+    The same as HoughCapsules.assign_nearest_centers.
+
+    :param coords_pred: The center predictions with shape (2, N) in x-y order, as float32.
+    :param center_coords: The list of center coordinates (K, 2) in y-x order.
+    :return: The index of the closest center of every prediction (N, ).
+    """
+    k, _ = center_coords.shape
+    x_centers, y_centers = center_coords[:, 1].astype(np.float32), center_coords[:, 0].astype(np.float32)
+
+    closest_inds = np.empty(coords_pred.shape[1], dtype=np.int64)
+
+    if nearest_center_loop_jit is not None:
+        nearest_center_loop_jit(np.ascontiguousarray(coords_pred), x_centers, y_centers, closest_inds)
+        return closest_inds
+
+    chunk_size = max(1, int(max_memory_mb * 2 ** 20 // (k * (4 * coords_pred.itemsize + 1))))
+    for start in range(0, coords_pred.shape[1], chunk_size):
+        x_pred, y_pred = coords_pred[:, start:start + chunk_size, None]  # (n, 1) each
+
+        dist = x_pred - x_centers
+        dist_y = y_pred - y_centers
+        dist = dist * dist + dist_y * dist_y  # squared distances (n, K)
+        del dist_y
+
+        chunk_inds = np.argmin(dist, -1)
+        min_dist = dist[np.arange(len(chunk_inds)), chunk_inds]
+
+        ties = np.nonzero((dist <= (min_dist * np.float32(1 + 2 ** -21))[:, None]).sum(-1) > 1)[0]
+        if ties.shape[0] != 0:
+            chunk_inds[ties] = np.argmin(np.sqrt(dist[ties]), -1)
+
+        closest_inds[start:start + chunk_size] = chunk_inds
+
+    return closest_inds
+
+
+def create_inst_map(center_coords_pred, center_coords, things_segs, max_memory_mb=64):
+    """
+    The same as HoughCapsules.create_inst_maps.
+
+    :return: The instance map (H, W), with the index + 1 of the closest center of every foreground pixel.
+    """
+    h, w = things_segs.shape
+
+    fg_inds = np.flatnonzero(things_segs)
+
+    instance_map = np.zeros(h * w, dtype=np.int64)
+    instance_map[fg_inds] = assign_nearest_centers(center_coords_pred.reshape(2, -1)[:, fg_inds], center_coords, max_memory_mb) + 1
+
+    return instance_map.reshape(h, w)
+
+
+def get_instance_pixels(instance_map):
+    """
+    The same as HoughCapsules.get_instance_pixels, without the masks.
+
+    :return: The raster indices of the points of all instances (N, ) as int32, grouped by instance and in raster order
+    within each instance, and the offsets of the instances (K + 1, ), as stored in PackedPoints.
+    """
+    flat_instances = instance_map.reshape(-1)
+    fg_inds = np.flatnonzero(flat_instances)
+
+    fg_inds = fg_inds[np.argsort(flat_instances[fg_inds], kind='stable')]
+
+    sorted_instances = flat_instances[fg_inds]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_instances[1:] != sorted_instances[:-1])))
+    offsets = np.append(starts, len(fg_inds)) if len(fg_inds) != 0 else np.zeros(1, dtype=np.int64)
+
+    return fg_inds.astype(np.int32), offsets.astype(np.int64)
+
+
+def group_image(fg_pred, center_regressions, top_k=200, circle_radius=5, nms_kernel_size=7, max_memory_mb=64):
+    """
+    Groups the foreground pixels of an image into instances, as HoughRouting1 with scale 1.
+
+    :param fg_pred: The foreground probabilities (H, W).
+    :param center_regressions: The center regressions (2, H, W) in x-y order.
+    :return: The instance map (H, W) and the points of the instances (see get_instance_pixels), or None if the image
+    has no centers.
+    """
+    _, h, w = center_regressions.shape
+    center_regressions = center_regressions.astype(np.float32)
+
+    center_map = get_center_map(center_regressions, circle_radius, nms_kernel_size)
+
+    center_coords, _ = get_centers(center_map, top_k)
+    if center_coords is None:
+        return None
+
+    y_coords, x_coords = np.mgrid[1:h + 1, 1:w + 1]  # the +1 coordinates of HoughRouting1
+    center_coords_pred = np.stack((x_coords, y_coords)).astype(np.float32) - center_regressions
+
+    inst_map = create_inst_map(center_coords_pred, center_coords, fg_pred >= 0.5, max_memory_mb)
+
+    return (inst_map, ) + get_instance_pixels(inst_map)
+
+
+def group_images(fg_pred, center_regressions, pool=None, **kwargs):
+    """
+    Groups the images of a batch, one image per task of the pool (e.g. multiprocessing.Pool) if one is given.
+
+    :param fg_pred: The foreground probabilities (B, 1, H, W).
+    :param center_regressions: The center regressions (B, 2, H, W).
+    :return: The outputs of group_image for every image.
+    """
+    args = [(fg_pred[i, 0], center_regressions[i]) for i in range(len(fg_pred))]
+
+    if pool is None:
+        return [group_image(*image_args, **kwargs) for image_args in args]
+
+    return pool.starmap(GroupImage(**kwargs), args)
+
+
+class GroupImage(object):
+    # group_image with fixed keyword arguments, which can be sent to worker processes
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def __call__(self, fg_pred, center_regressions):
+        return group_image(fg_pred, center_regressions, **self.kwargs)
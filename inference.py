@@ -11,8 +11,11 @@ def mkdir(dir_name):
     if os.path.isdir(dir_name):
         return
     else:
+        try:
+            os.mkdir(dir_name)
+        except FileExistsError:  # created by another export thread in the meantime
+            return
         print('Directory %s has been created.' % dir_name, flush=True)
-        os.mkdir(dir_name)
 
 
 class Converter(nn.Module):
@@ -37,6 +40,51 @@ class Converter(nn.Module):
         return eval_preds
         
 
+def export_instances(class_probs, segmentation_list, img_name):
+    """
+    Saves the binary mask of every predicted instance of an image as a PNG and lists them with their classes and
+    scores in a text file, in the format of the Cityscapes instance evaluation.
+
+    :param class_probs: The class probabilities of the instances (N, C), or an empty list if there are none.
+    :param segmentation_list: The InstanceMasks of the instances.
+    :param img_name: The file name of the image.
+    """
+    img_name_split = img_name.split('/')
+    city = img_name_split[-2]
+
+    mkdir('./SavedImages/val/Instance/' + city)
+    inst_dir_name = './SavedImages/val/Instance/' + city + '/' + img_name_split[-1].replace('leftImg8bit', '')[:-5] + '/'
+    mkdir(inst_dir_name)
+
+    if len(class_probs) != 0:
+        class_probs = class_probs.cpu()
+
+        class_preds = np.argmax(class_probs, -1)
+
+    lines = []
+    for inst in range(len(class_probs)):
+        binary_map = segmentation_list.get_dense(inst)  # the masks are stored cropped to the instance
+        inst_class = class_preds[inst]
+        inst_prob = 1.0
+        seg_prob = class_probs[inst, inst_class]
+
+        binary_map = binary_map.data.cpu().numpy()
+
+        img = Image.fromarray(binary_map, mode='L')  # Converts numpy array to PIL Image
+        img = img.resize(size=(2048, 1024), resample=Image.NEAREST)  # Resizes image
+        img.save(inst_dir_name + 'instance%d.png' % inst, 'PNG', mode='L')  # Saves image
+
+        line_str = (inst_dir_name + 'instance%d.png'% inst).replace('./SavedImages/val/Instance/', '')
+
+        line_str = line_str + (' %d %.4f\n' % (inst_class, inst_prob*seg_prob))
+
+        lines.append(line_str)
+
+    file_dir_name = './SavedImages/val/Instance/' + img_name_split[-1].replace('leftImg8bit', '')[:-5] + '.txt'
+    with open(file_dir_name, 'w') as f:
+        f.writelines(lines)
+
+
 def inference(model, data_loader):
     model.eval()
     convert_to_eval = Converter(dims=(config.h, config.w))
@@ -68,44 +116,7 @@ def inference(model, data_loader):
 
 
         for j in range(len(y_pred_fg_seg)):
-            img_name_split = img_name[j].split('/')
-            city = img_name_split[-2]
-
-            mkdir('./SavedImages/val/Instance/' + city)
-            inst_dir_name = './SavedImages/val/Instance/' + city + '/' + img_name_split[-1].replace('leftImg8bit', '')[:-5] + '/'
-            mkdir(inst_dir_name)
-
-            class_probs = y_pred_class[j]  # Shape (N, C)
-
-            if len(class_probs) != 0:
-                class_probs = class_probs.cpu()
-
-                class_preds = np.argmax(class_probs, -1)
-
-                segmentation_list = segmentation_lists[j]  # length N
-
-            lines = []
-            for inst in range(len(class_probs)):
-                binary_map = segmentation_list[inst]
-                inst_class = class_preds[inst]
-                inst_prob = 1.0
-                seg_prob = class_probs[inst, inst_class]
-
-                binary_map = binary_map.data.cpu().numpy()
-
-                img = Image.fromarray(binary_map, mode='L')  # Converts numpy array to PIL Image
-                img = img.resize(size=(2048, 1024), resample=Image.NEAREST)  # Resizes image
-                img.save(inst_dir_name + 'instance%d.png' % inst, 'PNG', mode='L')  # Saves image
-
-                line_str = (inst_dir_name + 'instance%d.png'% inst).replace('./SavedImages/val/Instance/', '')
-
-                line_str = line_str + (' %d %.4f\n' % (inst_class, inst_prob*seg_prob))
-
-                lines.append(line_str)
-
-            file_dir_name = './SavedImages/val/Instance/' + img_name_split[-1].replace('leftImg8bit', '')[:-5] + '.txt'
-            with open(file_dir_name, 'w') as f:
-                f.writelines(lines)
+            export_instances(y_pred_class[j], segmentation_lists[j], img_name[j])
 
         if (i+1) % 5 == 0:
             print('Finished %d batches' % (i+1), flush=True)
@@ -9,6 +9,7 @@ from decoder import fg_decoder, inst_decoder
 from HoughCapsules import HoughRouting1
 from setTransformer import TransformerRouting
 from capsules import PrimaryCaps
+from packed_points import get_downsampled_points, get_all_downsampled_points
 
 class VotingModule(nn.Module):
     def __init__(self, n_caps_in, in_caps_dim, vote_dim, kernel_dim=1, dilation=1, relu=False):
@@ -17,10 +18,24 @@ class VotingModule(nn.Module):
         self.n_caps_in = n_caps_in
         self.in_caps_dim = in_caps_dim
         self.vote_dim = vote_dim
+        self.kernel_dim = kernel_dim
+        self.dilation = dilation
         padding = (kernel_dim - 1 + (kernel_dim - 1)*(dilation - 1))//2
-        self.vote_transform = nn.ModuleList([nn.Conv2d(in_caps_dim, vote_dim, kernel_dim, padding=padding, dilation=dilation) for _ in range(n_caps_in)])
+
+        # a separate convolution for every capsule type, computed as one grouped convolution
+        self.vote_transform = nn.Conv2d(n_caps_in*in_caps_dim, n_caps_in*vote_dim, kernel_dim, padding=padding, dilation=dilation, groups=n_caps_in)
         self.relu = relu
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints written before the grouped convolution stored one convolution per capsule type, whose weights are the
+        # groups of the grouped convolution in order
+        for name in ['weight', 'bias']:
+            keys = [prefix + 'vote_transform.%d.%s' % (i, name) for i in range(self.n_caps_in)]
+            if keys[0] in state_dict:
+                state_dict[prefix + 'vote_transform.' + name] = torch.cat([state_dict.pop(key) for key in keys], 0)
+
+        super(VotingModule, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, poses):
         """
 
@@ -31,14 +46,7 @@ class VotingModule(nn.Module):
         b, f1, h, w = poses.shape
         assert f1 == self.n_caps_in*self.in_caps_dim
 
-        poses = poses.view(b, self.n_caps_in, self.in_caps_dim, h, w)
-
-        votes = []
-        for i in range(self.n_caps_in):
-            votes.append(self.vote_transform[i](poses[:, i]))
-        votes = torch.stack(votes, 1)
-
-        votes = votes.view(b, self.n_caps_in*self.vote_dim, h, w)
+        votes = self.vote_transform(poses)  # the votes of capsule type i are the channels i*F_2 to (i+1)*F_2
 
         if self.relu:
             return F.relu(votes)
@@ -61,7 +69,7 @@ def resize_capsules(poses, acts, size):
     return poses_up, acts_up
 
 
-def get_outputs_from_caps(fgbg_poses, fgbg_acts, regression_layer, input_size):
+def get_outputs_from_caps(fgbg_poses, fgbg_acts, regression_layer, input_size, return_native=False):
     h, w = input_size
 
     fg_pred = fgbg_acts[..., 0].unsqueeze(1)  # Shape (batch_size, 1, h/16, w/16)
@@ -70,15 +78,99 @@ def get_outputs_from_caps(fgbg_poses, fgbg_acts, regression_layer, input_size):
     regressions = regression_layer(fg_poses).permute(0, 3, 1, 2)
     regressions = F.tanh(regressions)
 
+    # the regressions at the resolution of the capsules, in full resolution pixels (used by reduced resolution Hough routing)
+    native_regressions = regressions * torch.tensor([w, h], dtype=regressions.dtype, device=regressions.device).view(1, 2, 1, 1)
+
     # Resizes the output maps
     fg_pred = F.upsample(fg_pred, size=(h, w), mode="bilinear")  # (shape: (batch_size, num_classes, h, w))
     regressions = F.upsample(regressions, size=(h, w), mode="bilinear")
     regressions[:, 0] = regressions[:, 0] * w
     regressions[:, 1] = regressions[:, 1] * h
 
+    if return_native:
+        return fg_pred, regressions, native_regressions
+
     return fg_pred, regressions
 
 
+def route_instances(transformer_routing, votes_list, acts_list, max_memory_mb=config.instance_routing_memory_mb, max_padding=1.5):
+    """
+    Routes the capsules of every instance with transformer_routing, in a few batched calls instead of one per instance.
+
+    The instances are sorted by their number of capsules and split into chunks, whose votes are padded to the largest
+    instance of the chunk. The padding is masked with the presence of TransformerRouting, so the outputs are the same as
+    routing each instance separately (up to the order of the floating point sums). An instance only joins a chunk if the
+    largest instance of the chunk has at most max_padding times as many capsules, so the number of chunks grows with the
+    range of the instance sizes rather than their count. A chunk is also limited to max_memory_mb for the votes and the
+    attention scores (n_heads*N_j per vote) of its padded capsules, a single larger instance is routed on its own.
+
+    :param votes_list: The votes of the K instances, with shapes (N_i, F).
+    :param acts_list: The activations of the K instances, with shapes (N_i, ).
+    :return: The output poses (K, N_j, F_out) and activations (K, N_j), in the order of votes_list.
+    """
+    n_caps_out = transformer_routing.inducing_points.shape[0]
+    device = transformer_routing.inducing_points.device
+
+    if len(votes_list) == 0:
+        return torch.zeros((0, n_caps_out, transformer_routing.output_dim), device=device), torch.zeros((0, n_caps_out), device=device)
+
+    n_votes = [len(votes) for votes in votes_list]
+    order = sorted(range(len(votes_list)), key=lambda k: -n_votes[k])
+
+    bytes_per_vote = (n_caps_out * transformer_routing.n_heads + transformer_routing.hidden_dim) * votes_list[0].element_size()
+    max_votes = max_memory_mb * 2 ** 20 // bytes_per_vote if max_memory_mb is not None else float('inf')
+
+    chunks = [[order[0]]]
+    for k in order[1:]:
+        chunk_votes = n_votes[chunks[-1][0]]
+        if (len(chunks[-1]) + 1) * chunk_votes > max_votes or chunk_votes > max_padding * n_votes[k]:
+            chunks.append([])
+        chunks[-1].append(k)
+
+    out_poses, out_acts = [], []
+    for chunk in chunks:
+        votes = nn.utils.rnn.pad_sequence([votes_list[k] for k in chunk], batch_first=True)  # (k, N_max, F)
+        acts = nn.utils.rnn.pad_sequence([acts_list[k] for k in chunk], batch_first=True)  # (k, N_max)
+
+        presence = torch.arange(votes.shape[1], device=votes.device) < torch.tensor([n_votes[k] for k in chunk], device=votes.device).unsqueeze(1)
+
+        chunk_poses, chunk_acts = transformer_routing(votes, acts, presence.to(votes.dtype))  # (k, N_j, F_out), (k, N_j)
+        out_poses.append(chunk_poses)
+        out_acts.append(chunk_acts)
+
+    inverse_order = torch.argsort(torch.tensor(order, device=device))
+
+    return torch.cat(out_poses)[inverse_order], torch.cat(out_acts)[inverse_order]
+
+
+def get_instance_index_map(point_lists, scale, size, device):
+    """
+    Finds the instance of every position of a downsampled map, where the capsules of the instances are written. Where
+    instances overlap, the position is given to the last instance, the same as writing the instances one after another.
+
+    :param point_lists: The points of the instances of every image, either PackedPoints or lists of point tensors.
+    :param scale: The scale of the map.
+    :param size: The (h, w) size of the map.
+    :return: The index of the instance at every position (B, h, w), counting the instances of all images in order (as
+    route_all_instances), or -1 where there is no instance.
+    """
+    h, w = size
+
+    keys, instance_inds = [], []
+    n_instances = 0
+    for i, point_list in enumerate(point_lists):
+        (y_coords, x_coords), image_instance_inds = get_all_downsampled_points(point_list, scale)
+
+        keys.append((i * h + y_coords) * w + x_coords)
+        instance_inds.append(image_instance_inds + n_instances)
+        n_instances += len(point_list)
+
+    instance_map = torch.full((len(point_lists) * h * w, ), -1, dtype=torch.long, device=device)
+    instance_map.scatter_reduce_(0, torch.cat(keys).to(device), torch.cat(instance_inds).to(device), 'amax')  # the last instance wins
+
+    return instance_map.view(len(point_lists), h, w)
+
+
 class CapsuleModel5(nn.Module):
     def __init__(self, model_id, project_dir):
         super(CapsuleModel5, self).__init__()
@@ -95,7 +187,8 @@ class CapsuleModel5(nn.Module):
         self.noise_scale = 4.0
         in_feats = 1280
 
-        self.hough_routing = HoughRouting1()
+        self.hough_routing = HoughRouting1(max_vote_memory_mb=config.hough_vote_memory_mb, center_index=config.hough_center_index, batched=config.hough_batched,
+                                           scale=config.hough_scale)
 
         self.n_init_capsules = [4, 4, 8]
         self.init_capsule_dim = [4, 8, 32]
@@ -168,6 +261,8 @@ class CapsuleModel5(nn.Module):
         return (capsule_poses, capsule_acts), (fgbg_poses, fgbg_acts)
 
     def create_inst_maps(self, point_lists, gt_reg, gt_seg, fg_pred, regressions):
+        # Hough routing gives the points of every image as PackedPoints and the segmentations as InstanceMasks
+        # With config.hough_scale > 1, regressions are the native (capsule resolution) regressions
         if point_lists is None:
             if gt_reg is None:
                 inst_maps, point_lists, segmentation_lists = self.hough_routing(fg_pred, regressions, gt_seg)
@@ -179,61 +274,86 @@ class CapsuleModel5(nn.Module):
 
         return point_lists, inst_maps, segmentation_lists
 
-    def scatter_capsules(self, point_lists, capsule_votes_inst, capsule_acts, input_size, instance_scale):
+    def get_instance_votes(self, point_list, k, capsule_votes_inst, capsule_acts, input_size, pos_vote_transform=None):
+        """
+
+        :param capsule_votes_inst: The votes of one image, with shape (n_caps*vote_dim, h/s, w/s).
+        :param capsule_acts: The activations of one image, with shape (n_caps, h/s, w/s).
+        :return: The votes (n_caps*p, vote_dim) and activations (n_caps*p, ) of the p capsule positions of instance k.
+        """
         h, w = input_size
-        b_size, _, h_inp, w_inp = capsule_votes_inst.shape
-        assert h//h_inp == w/w_inp
-        capsule_scale = h//h_inp
+        capsule_scale = h//capsule_votes_inst.shape[-2]
 
-        instance_poses = torch.zeros((b_size, h//instance_scale, w//instance_scale, self.num_inst_classes, 16))
-        instance_acts = torch.zeros((b_size, h//instance_scale, w//instance_scale, self.num_inst_classes))
+        # gather capsules corresponding to inst_points
+        inst_points_down16 = get_downsampled_points(point_list, k, capsule_scale)
 
-        class_outputs = []
-        for i, point_list in enumerate(point_lists):
+        y_coords, x_coords = inst_points_down16[0, :], inst_points_down16[1, :]
 
-            class_outs = []
-            for inst_points in point_list:
-                # gather capsules corresponding to inst_points
-                inst_points_down16 = torch.unique(inst_points // capsule_scale, dim=1)
+        inst_capsule_votes = capsule_votes_inst[:, y_coords, x_coords]  # (n_caps*vote_dim, p)
+        inst_capsule_votes = inst_capsule_votes.view(self.n_init_capsules[2], self.vote_dim, len(y_coords))  # (n_caps, vote_dim, p)
+        inst_capsule_votes = torch.transpose(inst_capsule_votes, 1, 2).reshape(self.n_init_capsules[2] * len(y_coords), self.vote_dim)  # (n_caps*p, vote_dim)
 
-                y_coords, x_coords = inst_points_down16[0, :], inst_points_down16[1, :]
+        if config.positional_encoding == True:
+            inst_points = point_list[k]
+            inst_points_mean = torch.mean(inst_points.float(), 0, keepdim=True)
+            inst_points_rel = inst_points - inst_points_mean  # gets the relative coordinates
+            y_coords_rel, x_coords_rel = inst_points_rel[0, :], inst_points_rel[1, :]
+            y_coords_rel, x_coords_rel = y_coords_rel / float(h / capsule_scale), x_coords_rel / float(w / capsule_scale)  # Performs normalization between 0 and 1
 
-                inst_capsule_votes = capsule_votes_inst[i, :, y_coords, x_coords]  # (n_caps*vote_dim, p)
-                inst_capsule_votes = inst_capsule_votes.view(self.n_init_capsules[2], self.vote_dim, len(y_coords))  # (n_caps, vote_dim, p)
-                inst_capsule_votes = torch.transpose(inst_capsule_votes, 1, 2).reshape(self.n_init_capsules[2] * len(y_coords), self.vote_dim)  # (n_caps*p, vote_dim)
+            # x_coords_rel and y_coords_rel should be of shape (p, )
+            x_coords_rel = x_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2] * len(y_coords), )  # makes x_coords_rel of shape (N*P, )
+            y_coords_rel = y_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2] * len(y_coords), )  # makes y_coords_rel of shape (N*P, )
 
-                if config.positional_encoding == True:
-                    inst_points_mean = torch.mean(inst_points.float(), 0, keepdim=True)
-                    inst_points_rel = inst_points - inst_points_mean  # gets the relative coordinates
-                    y_coords_rel, x_coords_rel = inst_points_rel[0, :], inst_points_rel[1, :]
-                    y_coords_rel, x_coords_rel = y_coords_rel / float(h / capsule_scale), x_coords_rel / float(w / capsule_scale)  # Performs normalization between 0 and 1
+            if config.positional_encoding_type == 'addition':
+                inst_capsule_votes[:, -1] += x_coords_rel.to(inst_capsule_votes.device)
+                inst_capsule_votes[:, -2] += y_coords_rel.to(inst_capsule_votes.device)
+            elif config.positional_encoding_type == 'concat':
+                inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().to(inst_capsule_votes.device), x_coords_rel.unsqueeze(1).float().to(inst_capsule_votes.device)), 1)
 
-                    # x_coords_rel and y_coords_rel should be of shape (p, )
-                    x_coords_rel = x_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2] * len(y_coords), )  # makes x_coords_rel of shape (N*P, )
-                    y_coords_rel = y_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2] * len(y_coords), )  # makes y_coords_rel of shape (N*P, )
+            inst_capsule_votes = pos_vote_transform(inst_capsule_votes)
 
-                    if config.positional_encoding_type == 'addition':
-                        inst_capsule_votes[:, -1] += x_coords_rel.cuda()
-                        inst_capsule_votes[:, -2] += y_coords_rel.cuda()
-                    elif config.positional_encoding_type == 'concat':
-                        inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().cuda(), x_coords_rel.unsqueeze(1).float().cuda()), 1)
+        inst_capsule_acts = capsule_acts[:, y_coords, x_coords]  # (n_caps, p)
+        inst_capsule_acts = inst_capsule_acts.view(self.n_init_capsules[2] * len(y_coords), )  # (n_caps*p, )
 
-                    inst_capsule_votes = self.pos_vote_transform(inst_capsule_votes)
+        return inst_capsule_votes, inst_capsule_acts
+
+    def route_all_instances(self, transformer_routing, point_lists, capsule_votes_inst, capsule_acts, input_size, pos_vote_transform=None):
+        """
+        Routes the capsules of all instances of the batch with transformer_routing (see route_instances).
 
-                inst_capsule_acts = capsule_acts[i, :, y_coords, x_coords]  # (n_caps, p)
-                inst_capsule_acts = inst_capsule_acts.view(self.n_init_capsules[2] * len(y_coords), )  # (n_caps*p, )
+        :return: The output poses (K, 34, F_out) and activations (K, 34) of all K instances, ordered by image and then by
+        instance, and the class outputs of every image (n_k, 34), or [] for images without instances.
+        """
+        votes_list, acts_list = [], []
+        for i, point_list in enumerate(point_lists):
+            for k in range(len(point_list)):
+                inst_capsule_votes, inst_capsule_acts = self.get_instance_votes(point_list, k, capsule_votes_inst[i], capsule_acts[i], input_size, pos_vote_transform)
+                votes_list.append(inst_capsule_votes)
+                acts_list.append(inst_capsule_acts)
 
-                out_capsule_poses, out_capsule_acts = self.transformer_routing(inst_capsule_votes, inst_capsule_acts)  # (34, F_out), (34, )
+        out_capsule_poses, out_capsule_acts = route_instances(transformer_routing, votes_list, acts_list)  # (K, 34, F_out), (K, 34)
 
-                inst_points_down4 = torch.unique(inst_points // instance_scale, dim=1)
-                y_coords, x_coords = inst_points_down4[0, :], inst_points_down4[1, :]
+        class_outputs = []
+        start = 0
+        for point_list in point_lists:
+            class_outputs.append(out_capsule_acts[start:start + len(point_list)] if len(point_list) != 0 else [])
+            start += len(point_list)
 
-                instance_poses[i, y_coords, x_coords] = out_capsule_poses.cpu()
-                instance_acts[i, y_coords, x_coords] = out_capsule_acts.cpu()
+        return out_capsule_poses, out_capsule_acts, class_outputs
 
-                class_outs.append(out_capsule_acts)
+    def scatter_capsules(self, point_lists, capsule_votes_inst, capsule_acts, input_size, instance_scale):
+        h, w = input_size
+        b_size, _, h_inp, w_inp = capsule_votes_inst.shape
+        assert h//h_inp == w/w_inp
 
-            class_outputs.append(torch.stack(class_outs) if len(class_outs) != 0 else [])
+        x = self.route_all_instances(self.transformer_routing, point_lists, capsule_votes_inst, capsule_acts, input_size, getattr(self, 'pos_vote_transform', None))
+        out_capsule_poses, out_capsule_acts, class_outputs = x
+
+        # gathers the capsules of the instance at every position, where the first row holds the empty capsules
+        instance_map = get_instance_index_map(point_lists, instance_scale, (h//instance_scale, w//instance_scale), out_capsule_poses.device) + 1  # (B, h/4, w/4)
+
+        instance_poses = torch.cat((out_capsule_poses.new_zeros((1, ) + out_capsule_poses.shape[1:]), out_capsule_poses))[instance_map]  # (B, h/4, w/4, 34, 16)
+        instance_acts = torch.cat((out_capsule_acts.new_zeros((1, ) + out_capsule_acts.shape[1:]), out_capsule_acts))[instance_map]  # (B, h/4, w/4, 34)
 
         return instance_poses, instance_acts, class_outputs
 
@@ -241,57 +361,54 @@ class CapsuleModel5(nn.Module):
         h, w = input_size
         b_size, _, h_inp, w_inp = capsule_votes_inst.shape
         assert h//h_inp == w/w_inp
-        capsule_scale = h//h_inp
-
-        class_outputs = []
-        for i, point_list in enumerate(point_lists):
 
-            class_outs = []
-            for inst_points in point_list:
-                # gather capsules corresponding to inst_points
-                inst_points_down16 = torch.unique(inst_points // capsule_scale, dim=1)
+        x = self.route_all_instances(self.transformer_routing2, point_lists, capsule_votes_inst, capsule_acts, input_size, getattr(self, 'pos_vote_transform2', None))
 
-                y_coords, x_coords = inst_points_down16[0, :], inst_points_down16[1, :]
+        return x[2]
 
-                inst_capsule_votes = capsule_votes_inst[i, :, y_coords, x_coords]  # (n_caps*vote_dim, p)
-                inst_capsule_votes = inst_capsule_votes.view(self.n_init_capsules[2], self.vote_dim, len(y_coords))  # (n_caps, vote_dim, p)
-                inst_capsule_votes = torch.transpose(inst_capsule_votes, 1, 2).reshape(self.n_init_capsules[2] * len(y_coords), self.vote_dim)  # (n_caps*p, vote_dim)
-
-                if config.positional_encoding == True:
-                    inst_points_mean = torch.mean(inst_points.float(), 0, keepdim=True)
-                    inst_points_rel = inst_points - inst_points_mean  # gets the relative coordinates
-                    y_coords_rel, x_coords_rel = inst_points_rel[0, :], inst_points_rel[1, :]
-                    y_coords_rel, x_coords_rel = y_coords_rel / float(h / capsule_scale), x_coords_rel / float(w / capsule_scale)  # Performs normalization between 0 and 1
+    def forward(self, x, point_lists=None, gt_seg=None, gt_reg=None, two_stage=True):
+        # (x has shape (batch_size, 3, h, w))
+        _, _, h, w = x.shape
 
-                    # x_coords_rel and y_coords_rel should be of shape (p, )
-                    x_coords_rel = x_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2] * len(y_coords), )  # makes x_coords_rel of shape (N*P, )
-                    y_coords_rel = y_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2] * len(y_coords), )  # makes y_coords_rel of shape (N*P, )
+        fg_preds, reg_preds, class_preds, inst_maps_preds, seg_list_preds = [], [], [], [], []
 
-                    if config.positional_encoding_type == 'addition':
-                        inst_capsule_votes[:, -1] += x_coords_rel.cuda()
-                        inst_capsule_votes[:, -2] += y_coords_rel.cuda()
-                    elif config.positional_encoding_type == 'concat':
-                        inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().cuda(), x_coords_rel.unsqueeze(1).float().cuda()), 1)
+        x = self.forward_first_stage(x, point_lists, gt_seg, gt_reg)
+        (fg_pred, regressions, class_outputs, inst_maps, segmentation_lists), (primary_poses, primary_acts), second_stage_inputs = x
 
-                    inst_capsule_votes = self.pos_vote_transform2(inst_capsule_votes)
+        # appends network outputs
+        fg_preds.append(fg_pred)
+        reg_preds.append(regressions)
+        class_preds.append([class8to34(class_output) for class_output in class_outputs])
+        inst_maps_preds.append(inst_maps)
+        seg_list_preds.append(segmentation_lists)
+        
+        if two_stage:
+            fg_pred, regressions, hough_regressions = self.get_second_stage_outputs(*second_stage_inputs, (h, w))
 
-                inst_capsule_acts = capsule_acts[i, :, y_coords, x_coords]  # (n_caps, p)
-                inst_capsule_acts = inst_capsule_acts.view(self.n_init_capsules[2] * len(y_coords), )  # (n_caps*p, )
+            point_lists, inst_maps, segmentation_lists = self.create_inst_maps(point_lists, gt_reg, gt_seg, fg_pred, hough_regressions)
 
-                out_capsule_poses, out_capsule_acts = self.transformer_routing2(inst_capsule_votes, inst_capsule_acts)  # (34, F_out), (34, )
+            class_outputs = self.get_second_stage_classes(point_lists, primary_poses, primary_acts, (h, w))
 
-                class_outs.append(out_capsule_acts)
+            # appends network outputs
+            fg_preds.append(fg_pred)
+            reg_preds.append(regressions)
+            class_preds.append([class8to34(class_output) for class_output in class_outputs])
+            inst_maps_preds.append(inst_maps)
+            seg_list_preds.append(segmentation_lists)
 
-            class_outputs.append(torch.stack(class_outs) if len(class_outs) != 0 else [])
+        # Should output center with shape (B, 1, H/16, W/16)
+        # and regressions with shape(B, 2, H/16, W/16)
+        
+        return fg_preds, reg_preds, class_preds, inst_maps_preds, seg_list_preds
 
-        return class_outputs
+    def forward_first_stage(self, x, point_lists=None, gt_seg=None, gt_reg=None):
+        """
 
-    def forward(self, x, point_lists=None, gt_seg=None, gt_reg=None, two_stage=True):
-        # (x has shape (batch_size, 3, h, w))
+        :return: The first stage outputs (fg_pred, regressions, class_outputs, inst_maps, segmentation_lists), the primary
+        capsules (poses, acts) and the capsules used by the second stage (fgbg_poses, fgbg_acts, instance_poses, instance_acts).
+        """
         _, _, h, w = x.shape
 
-        fg_preds, reg_preds, class_preds, inst_maps_preds, seg_list_preds = [], [], [], [], []
-
         # Encoder:
         feature_map, skip_8, skip_4 = self.resnet(x)  # (shape: (batch_size, 512, h/16, w/16)) (assuming self.resnet is ResNet18_OS16 or ResNet34_OS16. If self.resnet is ResNe$
 
@@ -302,56 +419,46 @@ class CapsuleModel5(nn.Module):
         (primary_poses, primary_acts), (fgbg_poses, fgbg_acts) = x
 
         # gets the network outputs (foreground segmentations and regressions) from foreground-background capsules
-        fg_pred, regressions = get_outputs_from_caps(fgbg_poses, fgbg_acts, self.regression_linear, (h, w))
+        fg_pred, regressions, native_regressions = get_outputs_from_caps(fgbg_poses, fgbg_acts, self.regression_linear, (h, w), return_native=True)
+        hough_regressions = native_regressions if self.hough_routing.scale != 1 else regressions
 
         # Uses hough-routing method to get instance maps from the foreground segmentations and regressions
-        point_lists1, inst_maps, segmentation_lists = self.create_inst_maps(point_lists, gt_reg, gt_seg, fg_pred, regressions)
+        point_lists1, inst_maps, segmentation_lists = self.create_inst_maps(point_lists, gt_reg, gt_seg, fg_pred, hough_regressions)
 
         capsule_votes_inst = self.vote_transform_class(primary_poses)  # (batch_size, n_caps*vote_dim, h/16, w/16)
 
-        b_size, h_new, w_new, _, _ = fgbg_poses.shape
-
         # performs scatter capsule operation
         x = self.scatter_capsules(point_lists1, capsule_votes_inst, primary_acts, (h, w), instance_scale=4)
         instance_poses, instance_acts, class_outputs = x
 
-        # appends network outputs
-        fg_preds.append(fg_pred)
-        reg_preds.append(regressions)
-        class_preds.append([class8to34(class_output) for class_output in class_outputs])
-        inst_maps_preds.append(inst_maps)
-        seg_list_preds.append(segmentation_lists)
-        
-        if two_stage:
-            new_capsules_poses = torch.cat((fgbg_poses.cuda(), instance_poses.cuda()), -2)
-            new_capsules_acts = torch.cat((fgbg_acts.cuda(), instance_acts.cuda()), -1)
+        return (fg_pred, regressions, class_outputs, inst_maps, segmentation_lists), (primary_poses, primary_acts), (fgbg_poses, fgbg_acts, instance_poses, instance_acts)
 
-            new_capsules_poses = new_capsules_poses.view(b_size, h_new, w_new, -1).permute(0, 3, 1, 2)
-            capsule_votes_seg2 = self.vote_transform_seg2(new_capsules_poses)  # (batch_size, n_caps*vote_dim, h/4, w/4)
-            capsule_votes_seg3 = self.vote_transform_seg3(capsule_votes_seg2)
-            capsule_votes_seg3 = capsule_votes_seg3.permute(0, 2, 3, 1).view(b_size, h_new, w_new, self.num_inst_classes+2, self.vote_dim_seg)
- 
-            fgbg_poses, fgbg_acts = self.transformer_routing_seg(capsule_votes_seg3, new_capsules_acts)  # (B, H_new, W_new, 2, 16), (B, H_new, W_new, 2)
+    def get_second_stage_outputs(self, fgbg_poses, fgbg_acts, instance_poses, instance_acts, input_size):
+        """
 
-            fg_pred, regressions = get_outputs_from_caps(fgbg_poses, fgbg_acts, self.regression_linear2, (h, w))
+        :return: The second stage foreground segmentations and regressions, and the regressions used by Hough routing.
+        """
+        b_size, h_new, w_new, _, _ = fgbg_poses.shape
 
-            point_lists, inst_maps, segmentation_lists = self.create_inst_maps(point_lists, gt_reg, gt_seg, fg_pred, regressions)
+        new_capsules_poses = torch.cat((fgbg_poses, instance_poses), -2)
+        new_capsules_acts = torch.cat((fgbg_acts, instance_acts), -1)
 
-            capsule_votes_inst2 = self.vote_transform_class2(primary_poses)
+        new_capsules_poses = new_capsules_poses.view(b_size, h_new, w_new, -1).permute(0, 3, 1, 2)
+        capsule_votes_seg2 = self.vote_transform_seg2(new_capsules_poses)  # (batch_size, n_caps*vote_dim, h/4, w/4)
+        capsule_votes_seg3 = self.vote_transform_seg3(capsule_votes_seg2)
+        capsule_votes_seg3 = capsule_votes_seg3.permute(0, 2, 3, 1).view(b_size, h_new, w_new, self.num_inst_classes+2, self.vote_dim_seg)
 
-            class_outputs = self.scatter_capsules2(point_lists, capsule_votes_inst2, primary_acts, (h, w))
+        fgbg_poses, fgbg_acts = self.transformer_routing_seg(capsule_votes_seg3, new_capsules_acts)  # (B, H_new, W_new, 2, 16), (B, H_new, W_new, 2)
 
-            # appends network outputs
-            fg_preds.append(fg_pred)
-            reg_preds.append(regressions)
-            class_preds.append([class8to34(class_output) for class_output in class_outputs])
-            inst_maps_preds.append(inst_maps)
-            seg_list_preds.append(segmentation_lists)
+        fg_pred, regressions, native_regressions = get_outputs_from_caps(fgbg_poses, fgbg_acts, self.regression_linear2, input_size, return_native=True)
+        hough_regressions = native_regressions if self.hough_routing.scale != 1 else regressions
 
-        # Should output center with shape (B, 1, H/16, W/16)
-        # and regressions with shape(B, 2, H/16, W/16)
-        
-        return fg_preds, reg_preds, class_preds, inst_maps_preds, seg_list_preds
+        return fg_pred, regressions, hough_regressions
+
+    def get_second_stage_classes(self, point_lists, primary_poses, primary_acts, input_size):
+        capsule_votes_inst2 = self.vote_transform_class2(primary_poses)
+
+        return self.scatter_capsules2(point_lists, capsule_votes_inst2, primary_acts, input_size)
 
     def create_model_dirs(self):
         self.logs_dir = self.project_dir + "/training_logs"
@@ -378,9 +485,10 @@ def class8to34(y):
 
 
 if __name__ == '__main__':
-    tester = CapsuleModel5('CapsuleModel5', 'SimpleSegmentation/').cuda()
+    device = 'cuda' if config.use_cuda else 'cpu'
+    tester = CapsuleModel5('CapsuleModel5', 'SimpleSegmentation/').to(device)
 
-    inp = torch.zeros((5, 3, 512, 1024)).cuda()
+    inp = torch.zeros((5, 3, 512, 1024), device=device)
 
     x = tester(inp)
 
@@ -398,7 +506,8 @@ class CapsuleModel6(nn.Module):
 
         in_feats = 1280
 
-        self.hough_routing = HoughRouting1()
+        self.hough_routing = HoughRouting1(max_vote_memory_mb=config.hough_vote_memory_mb, center_index=config.hough_center_index, batched=config.hough_batched,
+                                           scale=config.hough_scale)
 
         self.n_init_capsules = [4, 4, 8]
         self.init_capsule_dim = [4, 8, 32]
@@ -535,10 +644,10 @@ class CapsuleModel6(nn.Module):
                     y_coords_rel = y_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2]*len(y_coords), )  # makes y_coords_rel of shape (N*P, )
 
                     if config.positional_encoding_type == 'addition':
-                        inst_capsule_votes[:, -1] += x_coords_rel.cuda()
-                        inst_capsule_votes[:, -2] += y_coords_rel.cuda()
+                        inst_capsule_votes[:, -1] += x_coords_rel.to(inst_capsule_votes.device)
+                        inst_capsule_votes[:, -2] += y_coords_rel.to(inst_capsule_votes.device)
                     elif config.positional_encoding_type == 'concat':
-                        inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().cuda(), x_coords_rel.unsqueeze(1).float().cuda()), 1)
+                        inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().to(inst_capsule_votes.device), x_coords_rel.unsqueeze(1).float().to(inst_capsule_votes.device)), 1)
 
                     inst_capsule_votes = self.pos_vote_transform(inst_capsule_votes)
 
@@ -566,8 +675,8 @@ class CapsuleModel6(nn.Module):
             seg_list_preds.append(segmentation_lists)
             
             if two_stage:
-                new_capsules_poses = torch.cat((fgbg_poses.cuda(), instance_poses.cuda()), -2)
-                new_capsules_acts = torch.cat((fgbg_acts.cuda(), instance_acts.cuda()), -1)
+                new_capsules_poses = torch.cat((fgbg_poses, instance_poses.to(fgbg_poses.device)), -2)
+                new_capsules_acts = torch.cat((fgbg_acts, instance_acts.to(fgbg_acts.device)), -1)
 
                 new_capsules_poses = new_capsules_poses.detach()
                 new_capsules_acts = new_capsules_acts.detach()
@@ -636,10 +745,10 @@ class CapsuleModel6(nn.Module):
                             y_coords_rel = y_coords_rel.unsqueeze(0).repeat(self.n_init_capsules[2], 1).reshape(self.n_init_capsules[2]*len(y_coords), )  # makes y_coords_rel of shape (N*P, )
 
                             if config.positional_encoding_type == 'addition':
-                                inst_capsule_votes[:, -1] += x_coords_rel.cuda()
-                                inst_capsule_votes[:, -2] += y_coords_rel.cuda()
+                                inst_capsule_votes[:, -1] += x_coords_rel.to(inst_capsule_votes.device)
+                                inst_capsule_votes[:, -2] += y_coords_rel.to(inst_capsule_votes.device)
                             elif config.positional_encoding_type == 'concat':
-                                inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().cuda(), x_coords_rel.unsqueeze(1).float().cuda()), 1)
+                                inst_capsule_votes = torch.cat((inst_capsule_votes, y_coords_rel.unsqueeze(1).float().to(inst_capsule_votes.device), x_coords_rel.unsqueeze(1).float().to(inst_capsule_votes.device)), 1)
 
                             inst_capsule_votes = self.pos_vote_transform2(inst_capsule_votes)
 
@@ -0,0 +1,238 @@
+import torch
+import numpy as np
+
+
+def pack_points(points, counts, size, scales=()):
+    """
+    Packs the points of all instances into flat raster indices with per-instance offsets (CSR layout).
+
+    :param points: The points of all instances concatenated, with shape (2, N) in y-x order.
+    :param counts: The number of points of each instance, with shape (K, ).
+    :param size: The (h, w) size of the map the points belong to.
+    :param scales: Grid scales for which the unique downsampled points of each instance are also stored.
+    :return: A dictionary of numpy arrays with the keys indices, offsets and indices_s, offsets_s for every scale s.
+    """
+    h, w = size
+    n_instances = len(counts)
+
+    indices = (points[0] * w + points[1]).astype(np.int32)
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    packed = {'indices': indices, 'offsets': offsets}
+
+    instance_ids = np.repeat(np.arange(n_instances), counts)
+    for scale in scales:
+        grid_h, grid_w = get_grid_size(size, scale)
+
+        grid_inds = (points[0] // scale) * grid_w + points[1] // scale
+        keys = np.unique(instance_ids * (grid_h * grid_w) + grid_inds)  # sorted by instance, then by raster order
+
+        key_instance_ids, key_grid_inds = np.divmod(keys, grid_h * grid_w)
+
+        packed['indices_%d' % scale] = key_grid_inds.astype(np.int32)
+        packed['offsets_%d' % scale] = np.concatenate(([0], np.cumsum(np.bincount(key_instance_ids, minlength=n_instances)))).astype(np.int64)
+
+    return packed
+
+
+def get_grid_size(size, scale):
+    h, w = size
+    return (h - 1) // scale + 1, (w - 1) // scale + 1
+
+
+class PackedPoints(object):
+    """
+    The points of all instances of an image in compressed sparse row (CSR) form.
+
+    The points of instance k are indices[offsets[k]:offsets[k + 1]], stored as flat raster indices y*w + x of a map with
+    the given size. grids can hold the same layout for downsampled grids, where grids[s] contains the unique points
+    (y//s, x//s) of every instance, sorted in raster order (the same as torch.unique(points // s, dim=1)).
+
+    Indexing or iterating gives the points of each instance with shape (2, N), like the previous lists of point tensors.
+    """
+    def __init__(self, indices, offsets, size, grids=None):
+        self.indices = indices
+        self.offsets = offsets
+        self.size = tuple(size)
+        self.grids = grids if grids is not None else {}
+
+    @classmethod
+    def from_numpy(cls, packed, size, scales=()):
+        """
+
+        :param packed: A dictionary of numpy arrays, as returned by pack_points.
+        :param size: The (h, w) size of the map the points belong to.
+        :param scales: The downsampled grids to be used from packed.
+        """
+        grids = {scale: (torch.from_numpy(packed['indices_%d' % scale]), torch.from_numpy(packed['offsets_%d' % scale]))
+                 for scale in scales}
+        return cls(torch.from_numpy(packed['indices']), torch.from_numpy(packed['offsets']), size, grids)
+
+    @classmethod
+    def from_point_list(cls, point_list, size):
+        """
+
+        :param point_list: A list of point tensors with shape (2, N).
+        :param size: The (h, w) size of the map the points belong to.
+        """
+        w = size[1]
+        counts = torch.tensor([points.shape[1] for points in point_list], dtype=torch.long)
+        offsets = torch.cat((torch.zeros(1, dtype=torch.long), torch.cumsum(counts, 0)))
+
+        if len(point_list) == 0:
+            return cls(torch.zeros(0, dtype=torch.int32), offsets, size)
+
+        points = torch.cat(list(point_list), 1)
+        return cls((points[0] * w + points[1]).int(), offsets, size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        return self.get_points(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.get_points(k)
+
+    def get_points(self, k, scale=1):
+        """
+
+        :param k: The instance index.
+        :param scale: The grid scale, 1 gives the full resolution points.
+        :return: The unique points of instance k at the given scale, with shape (2, N) in y-x order.
+        """
+        if scale == 1:
+            inds = self.indices[self.offsets[k]:self.offsets[k + 1]].long()
+            grid_w = self.size[1]
+        elif scale in self.grids:
+            indices, offsets = self.grids[scale]
+            inds = indices[offsets[k]:offsets[k + 1]].long()
+            grid_w = get_grid_size(self.size, scale)[1]
+        else:
+            inds = self.indices[self.offsets[k]:self.offsets[k + 1]].long()
+            grid_w = get_grid_size(self.size, scale)[1]
+            inds = torch.unique((inds // self.size[1]) // scale * grid_w + (inds % self.size[1]) // scale)
+
+        return torch.stack((inds // grid_w, inds % grid_w), 0)
+
+    def get_all_points(self, scale=1):
+        """
+
+        :param scale: The grid scale, 1 gives the full resolution points.
+        :return: The points of all instances at the given scale concatenated with shape (2, N) in y-x order, and the
+        instance index of every point (N, ). Unlike get_points, the downsampled points of an instance are only unique if
+        the grid of the scale is stored.
+        """
+        indices, offsets = self.grids[scale] if scale in self.grids else (self.indices, self.offsets)
+        inds = indices.long()
+        instance_ids = torch.repeat_interleave(torch.arange(len(self), device=inds.device), offsets[1:] - offsets[:-1])
+
+        if scale in self.grids or scale == 1:
+            grid_w = get_grid_size(self.size, scale)[1]
+            return torch.stack((inds // grid_w, inds % grid_w), 0), instance_ids
+
+        return torch.stack(((inds // self.size[1]) // scale, (inds % self.size[1]) // scale), 0), instance_ids
+
+    def to(self, device):
+        grids = {scale: (indices.to(device), offsets.to(device)) for scale, (indices, offsets) in self.grids.items()}
+        return PackedPoints(self.indices.to(device), self.offsets.to(device), self.size, grids)
+
+
+class InstanceMasks(object):
+    """
+    The binary segmentations of all instances of an image, each cropped to the bounding box of the instance.
+
+    The crops are stored row-major one after another in a single uint8 tensor, where the crop of instance k starts at
+    offsets[k] and has the size of boxes[k] = (y0, x0, y1, x1) (exclusive ends).
+    """
+    def __init__(self, data, offsets, boxes, size):
+        self.data = data
+        self.offsets = offsets
+        self.boxes = boxes
+        self.size = tuple(size)
+
+    @classmethod
+    def from_packed_points(cls, point_list):
+        """
+
+        :param point_list: The points of the instances as PackedPoints.
+        """
+        device = point_list.indices.device
+        n_instances = len(point_list)
+
+        if n_instances == 0:
+            return cls(torch.zeros(0, dtype=torch.uint8, device=device), point_list.offsets.clone(),
+                       torch.zeros((0, 4), dtype=torch.long, device=device), point_list.size)
+
+        w = point_list.size[1]
+        inds = point_list.indices.long()
+        y, x = inds // w, inds % w
+
+        instance_ids = torch.repeat_interleave(torch.arange(n_instances, device=device), point_list.offsets[1:] - point_list.offsets[:-1])
+
+        boxes = torch.zeros((n_instances, 4), dtype=torch.long, device=device)
+        for i, (coords, reduce) in enumerate([(y, 'amin'), (x, 'amin'), (y, 'amax'), (x, 'amax')]):
+            boxes[:, i].scatter_reduce_(0, instance_ids, coords, reduce, include_self=False)
+        boxes[:, 2:] += 1
+
+        box_h, box_w = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+        offsets = torch.cat((torch.zeros(1, dtype=torch.long, device=device), torch.cumsum(box_h * box_w, 0)))
+
+        data = torch.zeros(int(offsets[-1]), dtype=torch.uint8, device=device)
+        data[offsets[instance_ids] + (y - boxes[instance_ids, 0]) * box_w[instance_ids] + (x - boxes[instance_ids, 1])] = 1
+
+        return cls(data, offsets, boxes, point_list.size)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, k):
+        """
+
+        :return: The segmentation of instance k cropped to its bounding box, with shape (y1 - y0, x1 - x0).
+        """
+        y0, x0, y1, x1 = self.boxes[k].tolist()
+        return self.data[self.offsets[k]:self.offsets[k + 1]].view(y1 - y0, x1 - x0)
+
+    def get_dense(self, k):
+        """
+
+        :return: The segmentation of instance k with the shape (H, W) of the image, as uint8.
+        """
+        y0, x0, y1, x1 = self.boxes[k].tolist()
+        dense = torch.zeros(self.size, dtype=torch.uint8, device=self.data.device)
+        dense[y0:y1, x0:x1] = self[k]
+        return dense
+
+
+def get_all_downsampled_points(point_list, scale):
+    """
+
+    :param point_list: Either PackedPoints or a list of point tensors with shape (2, N).
+    :param scale: The grid scale.
+    :return: The points (y//scale, x//scale) of all instances concatenated with shape (2, N), which can contain
+    duplicates within an instance, and the instance index of every point (N, ).
+    """
+    if isinstance(point_list, PackedPoints):
+        return point_list.get_all_points(scale)
+
+    if len(point_list) == 0:
+        return torch.zeros((2, 0), dtype=torch.long), torch.zeros(0, dtype=torch.long)
+
+    counts = torch.tensor([points.shape[1] for points in point_list], dtype=torch.long, device=point_list[0].device)
+    return torch.cat(list(point_list), 1) // scale, torch.repeat_interleave(torch.arange(len(point_list), device=counts.device), counts)
+
+
+def get_downsampled_points(point_list, k, scale):
+    """
+
+    :param point_list: Either PackedPoints or a list of point tensors with shape (2, N).
+    :param k: The instance index.
+    :param scale: The grid scale.
+    :return: The unique points (y//scale, x//scale) of instance k, with shape (2, N).
+    """
+    if isinstance(point_list, PackedPoints):
+        return point_list.get_points(k, scale)
+
+    return torch.unique(point_list[k] // scale, dim=1)
@@ -0,0 +1,157 @@
+import json
+import time
+import queue
+import numpy as np
+import multiprocessing as mp
+import config
+
+# Upper edges of the latency histogram bins in milliseconds, from 0.1ms to ~100s
+BIN_EDGES = 0.1 * 2 ** np.arange(21, dtype=np.float64)
+
+_recorder = None  # set in every process whose stages are timed, see PipelineStats
+
+
+class StageRecorder(object):
+    """
+    Records the latency histograms of the data pipeline stages of a single process.
+
+    In DataLoader workers the histograms are sent to the main process through a queue after every batch, in the main
+    process they are added to the PipelineStats directly.
+    """
+    def __init__(self, worker_id, stats_queue=None, stats=None):
+        self.worker_id = worker_id
+        self.stats_queue = stats_queue
+        self.stats = stats
+        self.histograms = {}
+
+    def record(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = np.zeros(len(BIN_EDGES) + 1, dtype=np.int64)
+
+        self.histograms[name][np.searchsorted(BIN_EDGES, seconds * 1000)] += 1
+
+    def flush(self):
+        if len(self.histograms) == 0:
+            return
+
+        if self.stats is not None:
+            self.stats.add(self.worker_id, self.histograms)
+        else:
+            try:
+                self.stats_queue.put_nowait((self.worker_id, self.histograms))
+            except queue.Full:  # the stats are dropped rather than stalling the worker
+                return
+
+        self.histograms = {}
+
+
+class stage(object):
+    """
+    Times the enclosed block as the given pipeline stage, if the stats of this process are recorded:
+
+        with stage('decode'):
+            ...
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _recorder is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if _recorder is not None:
+            _recorder.record(self.name, time.perf_counter() - self.start)
+
+
+def flush_stages():
+    # Called once per batch by custom_collate
+    if _recorder is not None:
+        _recorder.flush()
+
+
+def summarize(histogram):
+    """
+
+    :param histogram: The bin counts of a stage.
+    :return: The number of samples and the approximate mean and percentiles in milliseconds (taken as bin upper edges).
+    """
+    count = int(histogram.sum())
+    centers = np.append(BIN_EDGES / np.sqrt(2), BIN_EDGES[-1] * np.sqrt(2))
+    cumulative = np.cumsum(histogram) / max(count, 1)
+    upper_edges = np.append(BIN_EDGES, np.inf)
+
+    summary = {'count': count, 'mean_ms': float((histogram * centers).sum() / max(count, 1))}
+    for p in [50, 90, 99]:
+        summary['p%d_ms' % p] = float(upper_edges[min(np.searchsorted(cumulative, p / 100), len(upper_edges) - 1)])
+
+    return summary
+
+
+class PipelineStats(object):
+    """
+    Aggregates the per-stage latency histograms of all DataLoader workers, and the time the training loop waits for the
+    next batch, and periodically appends a summary of them to a JSONL file.
+
+    Usage: pass stats.init_worker as the worker_init_fn of the DataLoader, time every next(data_loader) with
+    stats.record_wait and call stats.log(iteration) after every iteration.
+    """
+    def __init__(self, stats_file=config.pipeline_stats_file, log_every_n_iters=config.pipeline_stats_every_n_iters):
+        global _recorder
+
+        self.stats_file = stats_file
+        self.log_every_n_iters = log_every_n_iters
+        self.stats_queue = mp.Queue(maxsize=1000)
+        self.histograms = {}  # (worker id, stage) -> bin counts
+        self.wait_histogram = np.zeros(len(BIN_EDGES) + 1, dtype=np.int64)
+        self.wait_time = 0
+        self.start_time = time.time()
+
+        _recorder = StageRecorder('main', stats=self)  # used when the data is loaded in the main process
+
+    def init_worker(self, worker_id):
+        global _recorder
+        _recorder = StageRecorder(worker_id, stats_queue=self.stats_queue)
+
+    def add(self, worker_id, histograms):
+        for name, histogram in histograms.items():
+            key = (worker_id, name)
+            self.histograms[key] = self.histograms.get(key, 0) + histogram
+
+    def collect(self):
+        while True:
+            try:
+                self.add(*self.stats_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def record_wait(self, seconds):
+        self.wait_histogram[np.searchsorted(BIN_EDGES, seconds * 1000)] += 1
+        self.wait_time += seconds
+
+    def log(self, iteration):
+        if iteration % self.log_every_n_iters != 0:
+            return
+
+        self.collect()
+
+        stages, workers = {}, {}
+        for (worker_id, name), histogram in self.histograms.items():
+            stages[name] = stages.get(name, 0) + histogram
+            workers.setdefault(str(worker_id), {})[name] = summarize(histogram)
+
+        elapsed = time.time() - self.start_time
+        summary = {'iteration': iteration, 'elapsed_s': elapsed, 'num_workers': config.num_workers,
+                   'loader_wait': dict(summarize(self.wait_histogram), total_s=self.wait_time, fraction=self.wait_time / elapsed),
+                   'stages': {name: summarize(histogram) for name, histogram in stages.items()},
+                   'workers': workers}
+
+        with open(self.stats_file, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+
+        # every summary covers the iterations since the previous one
+        self.histograms = {}
+        self.wait_histogram[:] = 0
+        self.wait_time = 0
+        self.start_time = time.time()
@@ -0,0 +1,200 @@
+import os
+import sys
+import time
+import queue
+import itertools
+import threading
+import multiprocessing as mp
+import torch
+import config
+import hough_numpy
+from dataloader import DataLoader, get_cityscapes_dataset, custom_collate
+from inference import mkdir, inference, export_instances
+from modelNew import CapsuleModel5, class8to34
+from HoughCapsules import from_numpy_outputs
+
+
+class WorkerPool(object):
+    """
+    A pool of threads which call fn on the items of a bounded queue. Adding an item blocks while the queue is full, which
+    applies back-pressure to the producer. The results are put into output_queue, if given.
+
+    Threads are used rather than processes since the Hough grouping (torch) and the PNG encoding release the GIL, and the
+    CPU tensors are shared without copies. An exception raised by fn is re-raised in the main thread by check.
+    """
+    def __init__(self, fn, n_workers, queue_size, output_queue=None):
+        self.fn = fn
+        self.input_queue = queue.Queue(maxsize=queue_size)
+        self.output_queue = output_queue
+        self.error = None
+
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(n_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.input_queue.get()
+            if item is None:
+                break
+
+            key, args = item
+            try:
+                result = self.fn(*args)
+            except Exception as e:
+                self.error = e
+                result = e
+
+            if self.output_queue is not None:
+                self.output_queue.put((key, result))
+
+    def put(self, key, args):
+        self.check()
+        self.input_queue.put((key, args))
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        for _ in self.threads:
+            self.input_queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.check()
+
+
+def group_instances(hough_routing, fg_pred, regressions):
+    with torch.no_grad():
+        inst_maps, point_lists, segmentation_lists = hough_routing(fg_pred, regressions)
+
+    return point_lists, segmentation_lists
+
+
+def group_instances_numpy(hough_routing, pool, fg_pred, regressions):
+    # The same as group_instances, with the images grouped by hough_numpy in the worker processes of pool
+    outputs = hough_numpy.group_images(fg_pred.numpy(), regressions.numpy(), pool, top_k=hough_routing.top_k,
+                                       circle_radius=hough_routing.circle_radius, nms_kernel_size=hough_routing.kernel_size)
+    inst_maps, point_lists, segmentation_lists = from_numpy_outputs(outputs)
+
+    return point_lists, segmentation_lists
+
+
+def pipelined_inference(model, data_loader, n_hough_workers=config.inference_hough_workers, n_export_workers=config.inference_export_workers,
+                        max_batches_in_flight=config.inference_batches_in_flight):
+    """
+    Runs the same inference as inference.inference, with the CPU post-processing overlapped with the network.
+
+    The main thread runs the network up to the second stage foreground segmentations and regressions, which are handed
+    to a pool of Hough grouping workers. The instances they find are classified by the main thread (second stage
+    routing) and the results are handed to a pool of export workers, which save the masks. At most
+    max_batches_in_flight batches are between the network and the classification, the forward pass of the next batch
+    waits (while classifying) until a batch leaves.
+
+    With config.inference_hough_backend = 'numpy', the Hough grouping runs in a pool of n_hough_workers processes
+    (see hough_numpy.py) instead of the threads, which gives the same instances up to float32 rounding of the vote errors.
+
+    :return: The number of images processed.
+    """
+    model.eval()
+
+    if config.use_cuda:
+        model.cuda()
+
+    hough_processes = None
+    if config.inference_hough_backend == 'numpy':
+        assert model.hough_routing.scale == 1, 'hough_numpy only groups the instances at the full resolution'
+        hough_processes = mp.Pool(n_hough_workers)
+        group = lambda fg_pred, regressions: group_instances_numpy(model.hough_routing, hough_processes, fg_pred, regressions)
+    else:
+        group = lambda fg_pred, regressions: group_instances(model.hough_routing, fg_pred, regressions)
+
+    hough_outputs = queue.Queue()  # holds at most max_batches_in_flight batches
+    hough_pool = WorkerPool(group, n_hough_workers, max_batches_in_flight, hough_outputs)
+    export_pool = WorkerPool(export_instances, n_export_workers, config.batch_size * max_batches_in_flight)
+
+    in_flight = {}  # batch index -> (primary capsule poses, primary capsule acts, input size, image names)
+
+    def classify_next_batch():
+        i, result = hough_outputs.get()
+        if isinstance(result, Exception):
+            raise result
+
+        point_lists, segmentation_lists = result
+        primary_poses, primary_acts, input_size, img_name = in_flight.pop(i)
+
+        with torch.no_grad():
+            class_outputs = model.get_second_stage_classes(point_lists, primary_poses, primary_acts, input_size)
+
+        for j in range(len(img_name)):
+            class_probs = class8to34(class_outputs[j])
+            export_pool.put(i, (class_probs.cpu() if len(class_probs) != 0 else class_probs, segmentation_lists[j], img_name[j]))
+
+    n_images = 0
+    for i, sample in enumerate(data_loader):
+        image, img_name = sample[0], sample[-1]
+
+        while len(in_flight) >= max_batches_in_flight:
+            classify_next_batch()
+
+        if config.use_cuda:
+            image = image.cuda()
+
+        with torch.no_grad():
+            _, (primary_poses, primary_acts), second_stage_inputs = model.forward_first_stage(image)
+            fg_pred, _, hough_regressions = model.get_second_stage_outputs(*second_stage_inputs, image.shape[-2:])
+
+        in_flight[i] = (primary_poses, primary_acts, image.shape[-2:], img_name)
+        hough_pool.put(i, (fg_pred.cpu(), hough_regressions.cpu()))
+        n_images += len(img_name)
+
+        if (i+1) % 5 == 0:
+            print('Finished the forward pass of %d batches' % (i+1), flush=True)
+
+    while len(in_flight) != 0:
+        classify_next_batch()
+
+    hough_pool.close()
+    export_pool.close()
+
+    if hough_processes is not None:
+        hough_processes.close()
+
+    return n_images
+
+
+def main():
+    # Usage: python pipelined_inference.py [n_batches]
+    # Compares the throughput of the serial and the pipelined inference on the first n_batches of the val split
+    mkdir('./SavedImages/')
+    mkdir('./SavedImages/val/')
+    mkdir('./SavedImages/val/Pixel/')
+    mkdir('./SavedImages/val/Instance/')
+
+    iteration = 50000
+    n_batches = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    model = CapsuleModel5('CapsuleModel5', 'SimpleSegmentation/')
+    model.load_state_dict(torch.load(os.path.join(config.save_dir, 'model_iteration_{}.pth'.format(iteration)))['state_dict'])
+
+    val_dataset = get_cityscapes_dataset(config.data_dir, False)
+    val_dataloader = DataLoader(val_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.num_workers, collate_fn=custom_collate)
+
+    start = time.time()
+    inference(model, itertools.islice(val_dataloader, n_batches))
+    serial_time = time.time() - start
+
+    start = time.time()
+    n_images = pipelined_inference(model, itertools.islice(val_dataloader, n_batches))
+    pipelined_time = time.time() - start
+
+    print('Serial inference: %.2f images/s' % (n_images / serial_time), flush=True)
+    print('Pipelined inference: %.2f images/s (%d %s Hough workers, %d export workers, %d batches in flight), %.2fx'
+          % (n_images / pipelined_time, config.inference_hough_workers, config.inference_hough_backend, config.inference_export_workers, config.inference_batches_in_flight,
+             serial_time / pipelined_time), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+from PIL import Image
+from torchvision.datasets import Cityscapes
+import config
+
+
+class ImagePyramid(object):
+    """
+    Pre-resized copies of the Cityscapes images and label maps, written by build_pyramid.
+
+    The copy of a file at downscaling factor s is stored under pyramid_dir/s/ with the same path relative to the dataset
+    root, where images are resized bilinearly and label maps with nearest interpolation. Scale 1 is the original file.
+    """
+    def __init__(self, root, pyramid_dir, scales=config.pyramid_scales):
+        self.root = root
+        self.pyramid_dir = pyramid_dir
+        self.scales = sorted(set(scales) | {1})
+
+    def get_path(self, file_name, scale):
+        if scale == 1:
+            return file_name
+
+        return os.path.join(self.pyramid_dir, str(scale), os.path.relpath(file_name, self.root))
+
+    def get_image_size(self, files):
+        """
+
+        :param files: The image, semantic and instance files of a sample.
+        :return: The (width, height) of the original image, read from the header of the smallest stored copy.
+        """
+        scale = self.scales[-1]
+        w, h = Image.open(self.get_path(files[0], scale)).size
+
+        return w * scale, h * scale
+
+    def get_scale(self, crop_box, output_size):
+        """
+
+        :param crop_box: The crop box (x0, y0, x1, y1) in the coordinates of the original image.
+        :param output_size: The (width, height) the crop is resized to.
+        :return: The largest downscaling factor at which the crop still has at least the output resolution.
+        """
+        crop_w, crop_h = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+        w, h = output_size
+
+        return max(scale for scale in self.scales if scale == 1 or (crop_w / scale >= w and crop_h / scale >= h))
+
+    def load(self, files, scale):
+        """
+
+        :param files: The image, semantic and instance files of a sample.
+        :param scale: The downscaling factor.
+        :return: The decoded image, semantic map and instance map, as loaded by the torchvision Cityscapes dataset.
+        """
+        image_file, semantic_file, instance_file = [self.get_path(file_name, scale) for file_name in files]
+
+        return Image.open(image_file).convert('RGB'), Image.open(semantic_file), Image.open(instance_file)
+
+
+def build_pyramid(root, split, pyramid_dir, scales=config.pyramid_scales):
+    pyramid = ImagePyramid(root, pyramid_dir, scales)
+    dataset = Cityscapes(root, split=split, mode='fine', target_type=['semantic', 'instance'])
+
+    for i in range(len(dataset)):
+        files = [dataset.images[i]] + dataset.targets[i]
+        image, segmentation_maps, instance_maps = pyramid.load(files, 1)
+        w, h = image.size
+
+        for scale in pyramid.scales[1:]:
+            assert w % scale == 0 and h % scale == 0, 'Image sizes must be divisible by the pyramid scales'
+            size = (w // scale, h // scale)
+
+            for file_name, image_map, resample in zip(files, [image, segmentation_maps, instance_maps], [Image.BILINEAR, Image.NEAREST, Image.NEAREST]):
+                level_path = pyramid.get_path(file_name, scale)
+                if not os.path.isdir(os.path.dirname(level_path)):
+                    os.makedirs(os.path.dirname(level_path), exist_ok=True)
+
+                image_map.resize(size=size, resample=resample).save(level_path, 'PNG')
+
+        if (i + 1) % 100 == 0:
+            print('Resized %d/%d %s samples' % (i + 1, len(dataset), split), flush=True)
+
+
+if __name__ == '__main__':
+    # Usage: python pyramid.py [split ...]
+    for split in (sys.argv[1:] if len(sys.argv) > 1 else ['train', 'val']):
+        build_pyramid(config.data_dir, split, config.pyramid_dir)
@@ -0,0 +1,141 @@
+import os
+import json
+import torch
+import numpy as np
+from PIL import Image
+from torch.utils.data import Sampler
+from torchvision.datasets import Cityscapes
+import config
+
+
+class InfiniteSampler(Sampler):
+    """
+    An endless stream of sample indices for iteration-based training.
+
+    The stream is the concatenation of one permutation of the dataset per epoch, where the permutation of epoch e is
+    seeded with seed + e. Position i of the stream is therefore fixed by the seed alone, so training can be resumed at any
+    sample by starting the stream at that position. Used with a DataLoader, batches run across epoch boundaries without
+    restarting the workers.
+    """
+    def __init__(self, n_samples, shuffle=True, seed=0, start_index=0):
+        self.n_samples = n_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.start_index = start_index
+
+    def get_permutation(self, epoch):
+        if not self.shuffle:
+            return torch.arange(self.n_samples)
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(self.n_samples, generator=generator)
+
+    def __iter__(self):
+        epoch, offset = divmod(self.start_index, self.n_samples)
+
+        while True:
+            for index in self.get_permutation(epoch)[offset:].tolist():
+                yield index
+
+            epoch, offset = epoch + 1, 0
+
+    def state_dict(self, n_consumed):
+        """
+
+        :param n_consumed: The number of samples consumed from this sampler, i.e. the number of batches times the batch size.
+        :return: The position of the next sample in the stream, to be stored in checkpoints.
+        """
+        return {'seed': self.seed, 'index': self.start_index + n_consumed}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.start_index = state_dict['index']
+
+
+class InstanceBalancedBatchSampler(InfiniteSampler):
+    """
+    An endless stream of batches whose total number of instances is balanced, for iteration-based training.
+
+    The step time grows with the number of instances in a batch, since every instance is routed separately. Every epoch
+    the dataset is shuffled as in InfiniteSampler, and every window of window_batches * batch_size consecutive samples is
+    split into batches with the largest-first greedy assignment: samples are taken in decreasing order of their instance
+    count and added to the non-full batch with the smallest load. The batches of a window are yielded in random order.
+
+    Positions are counted in samples, so the state dict is compatible with InfiniteSampler.
+    """
+    def __init__(self, instance_counts, batch_size, window_batches=8, seed=0, start_index=0):
+        super(InstanceBalancedBatchSampler, self).__init__(len(instance_counts), shuffle=True, seed=seed, start_index=start_index)
+
+        self.instance_counts = np.asarray(instance_counts)
+        self.batch_size = batch_size
+        self.window_batches = window_batches
+        self.n_batches = len(instance_counts) // batch_size  # the remainder of every epoch is dropped
+
+    def get_batches(self, epoch):
+        permutation = self.get_permutation(epoch).numpy()[:self.n_batches * self.batch_size]
+        rng = np.random.RandomState([self.seed, epoch])
+
+        batches = []
+        for start in range(0, len(permutation), self.window_batches * self.batch_size):
+            window = permutation[start:start + self.window_batches * self.batch_size]
+            n_batches = len(window) // self.batch_size
+
+            window_batches = [[] for _ in range(n_batches)]
+            loads = np.zeros(n_batches)
+            for index in window[np.argsort(-self.instance_counts[window], kind='stable')]:
+                loads_available = np.where([len(batch) < self.batch_size for batch in window_batches], loads, np.inf)
+                b = int(np.argmin(loads_available))
+                window_batches[b].append(int(index))
+                loads[b] += self.instance_counts[index]
+
+            batches += [window_batches[b] for b in rng.permutation(n_batches)]
+
+        return batches
+
+    def __iter__(self):
+        epoch, offset = divmod(self.start_index, self.n_batches * self.batch_size)
+
+        while True:
+            for batch in self.get_batches(epoch)[offset // self.batch_size:]:
+                yield batch
+
+            epoch, offset = epoch + 1, 0
+
+    def __len__(self):
+        return self.n_batches
+
+
+def build_instance_index(root, split, index_file):
+    """
+    Counts the instances of every image of a split and writes them to a json file, used by InstanceBalancedBatchSampler.
+    The counts are taken on the full image, so crops of train samples contain fewer instances.
+    """
+    dataset = Cityscapes(root, split=split, mode='fine', target_type=['instance'])
+
+    instance_counts = {}
+    for i in range(len(dataset)):
+        instance_maps = np.array(Image.open(dataset.targets[i][0]))
+        instance_counts[os.path.relpath(dataset.images[i], root)] = int(np.count_nonzero(np.unique(instance_maps) >= 1000))
+
+        if (i + 1) % 100 == 0:
+            print('Counted the instances of %d/%d %s images' % (i + 1, len(dataset), split), flush=True)
+
+    with open(index_file, 'w') as f:
+        json.dump(instance_counts, f)
+
+
+def load_instance_counts(dataset, index_file):
+    """
+
+    :return: The number of instances of every image of the dataset, in the order of dataset.images.
+    """
+    with open(index_file) as f:
+        instance_counts = json.load(f)
+
+    return [instance_counts[os.path.relpath(image, dataset.root)] for image in dataset.images]
+
+
+if __name__ == '__main__':
+    # Usage: python samplers.py
+    build_instance_index(config.data_dir, 'train', config.instance_index_file)
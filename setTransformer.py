@@ -7,10 +7,10 @@ from math import sqrt
 def qkv_attention(queries, keys, values, presence, top_down=False):
     """
 
-    :param queries: Shape (N_j, F)
-    :param keys:  Shape (N_i, F)
-    :param values:  Shape (N_i, F)
-    :param acts:   Shape (N_i, ), should be binary or close to it
+    :param queries: Shape (..., N_j, F), e.g. with the heads as a preceding dimension
+    :param keys:  Shape (..., N_i, F)
+    :param values:  Shape (..., N_i, F)
+    :param presence:   Shape (..., N_i), should be binary or close to it
     :param top_down: Boolean, if True, then softmax is performed over the columns (i.e. information from the lower level
     capsule is sent to the higher level capsule that it most agrees with), if False, then softmax is performed across
     the row (i.e. information from lower level capsules is sent based on if it has a high agreement with the higher
@@ -33,6 +33,75 @@ def qkv_attention(queries, keys, values, presence, top_down=False):
         return torch.matmul(qk, values)  # (N_j, F)
 
 
+def split_heads(x, n_heads, split_size):
+    """
+
+    :param x: Shape (..., N, F)
+    :return: Shape (..., n_heads, N, split_size), the first n_heads slices of split_size features, which are the heads
+    torch.split(x, split_size, -1)[:n_heads]
+    """
+    x = x[..., :n_heads*split_size]
+    return torch.transpose(x.reshape(x.shape[:-1] + (n_heads, split_size)), -2, -3)
+
+
+def merge_heads(x):
+    """
+
+    :param x: Shape (..., n_heads, N, F)
+    :return: Shape (..., N, n_heads*F), the heads concatenated along the features
+    """
+    x = torch.transpose(x, -2, -3)
+    return x.reshape(x.shape[:-2] + (-1, ))
+
+
+def multi_head_attention(queries, keys, values, n_heads, presence=None, top_down=False):
+    """
+    The same as qkv_attention for each of the n_heads slices of the features (torch.split(x, F/n_heads, -1)), with the
+    outputs of the heads concatenated, for queries which are shared by all preceding dimensions of the keys.
+
+    The features are reshaped into (..., n_heads, N, F/n_heads), so the scores, the softmax and the aggregation of the
+    values of all heads are each a single batched operation.
+
+    :param queries: Shape (N_j, F)
+    :param keys: Shape (..., N_i, F)
+    :param values: Shape (..., N_i, F)
+    :param presence: Shape (..., N_i), should be binary or close to it
+    :param top_down: See qkv_attention
+    :return: Shape (..., N_j, F)
+    """
+    split_size = queries.shape[-1] // n_heads
+
+    q_heads = split_heads(queries, n_heads, split_size)  # (n_heads, N_j, F/n_heads)
+    k_heads = split_heads(keys, n_heads, split_size)  # (..., n_heads, N_i, F/n_heads)
+    v_heads = split_heads(values, n_heads, split_size)
+
+    if presence is not None:
+        presence = presence.unsqueeze(-2)  # (..., 1, N_i), the same for all heads
+
+    return merge_heads(qkv_attention(q_heads, k_heads, v_heads, presence, top_down=top_down))  # (..., N_j, F)
+
+
+def agreement_cost(poses, votes, acts):
+    """
+    The activation weighted mean of the squared differences between the poses and the votes, in every dimension.
+
+    The sum over the votes is expanded as sum_i a_i*(p - v_i)^2 = p^2*sum_i a_i - 2*p*sum_i a_i*v_i + sum_i a_i*v_i^2, so
+    the differences of all pairs of poses and votes (..., N_j, N_i, F) are never created.
+
+    :param poses: Shape (..., N_j, F)
+    :param votes: Shape (..., N_i, F)
+    :param acts: Shape (..., N_i)
+    :return: Shape (..., N_j, F)
+    """
+    acts_res = acts.unsqueeze(-2)  # (..., 1, N_i)
+
+    sum_acts = torch.sum(acts_res, -1, keepdim=True)  # (..., 1, 1)
+    sum_votes = torch.matmul(acts_res, votes)  # (..., 1, F)
+    sum_squares = torch.matmul(acts_res, votes**2)  # (..., 1, F)
+
+    return (poses**2*sum_acts - 2*poses*sum_votes + sum_squares) / (sum_acts + 1e-8)  # (..., N_j, F)
+
+
 class MultiHeadQKVAttention(nn.Module):
     def __init__(self, n_feats_in, n_heads):
         super(MultiHeadQKVAttention, self).__init__()
@@ -61,14 +130,15 @@ class MultiHeadQKVAttention(nn.Module):
         k_tr = self.linear_k(keys)
         v_tr = self.linear_v(values)
 
-        q_splits = torch.split(q_tr, self.n_heads, -1)
-        k_splits = torch.split(k_tr, self.n_heads, -1)
-        v_splits = torch.split(v_tr, self.n_heads, -1)
+        # the heads are slices of n_heads (not n_feats) features, of which the first n_heads are used
+        q_heads = split_heads(q_tr, self.n_heads, self.n_heads)  # (n_heads, N_j, n_heads)
+        k_heads = split_heads(k_tr, self.n_heads, self.n_heads)
+        v_heads = split_heads(v_tr, self.n_heads, self.n_heads)
 
-        heads = []
-        for i in range(self.n_heads):
-            heads.append(qkv_attention(q_splits[i], k_splits[i], v_splits[i], presence))
-        heads = torch.cat(heads, -1)  # (N_j, F_1)
+        if presence is not None:
+            presence = presence.unsqueeze(-2)  # the same presence for every head
+
+        heads = merge_heads(qkv_attention(q_heads, k_heads, v_heads, presence))  # (N_j, F_1)
 
         return self.linear_out(heads)  # (N_j, F_2)
 
@@ -98,13 +168,17 @@ class TransformerRouting(nn.Module):
 
         self.linear_output = nn.Linear(hidden_dim, self.output_dim)
 
-    def forward(self, capsule_poses, capsule_acts):
+    def forward(self, capsule_poses, capsule_acts, presence=None):
         """
 
         :param capsule_poses: Shape (..., N_i, F_in)
         :param capsule_acts: Shape (..., N_i)    ---   or (N_i, ) if no preceding dimensions
+        :param presence: Shape (..., N_i), binary, or None if all capsules are present. Capsules which are not present
+        (e.g. padding) are ignored by the attention and the agreement cost
         :return: Shape (..., N_j, F_out), (..., N_j)  ---   or (N_j, F_out), (N_j, ) if no preceding dimensions
         """
+        if presence is not None:
+            capsule_acts = capsule_acts * presence
 
         # This would require inputting the votes, and removing this first vote transform
         if self.use_vote_transform:
@@ -116,25 +190,9 @@ class TransformerRouting(nn.Module):
         k_tr = self.linear_k(votes)
         v_tr = self.linear_v(votes)  # (N_i, F) - these are the votes
 
-        q_splits = torch.split(q_tr, self.split_size, -1)
-        k_splits = torch.split(k_tr, self.split_size, -1)
-        v_splits = torch.split(v_tr, self.split_size, -1)
-
-        heads = []
-        for i in range(self.n_heads):
-            heads.append(qkv_attention(q_splits[i], k_splits[i], v_splits[i], None, top_down=self.top_down_routing))
-        pred_poses = torch.cat(heads, -1)  # (N_j, F)
-
-        out_poses_res = pred_poses.unsqueeze(-2)  # (N_j, 1, F)
-        votes_res = v_tr.unsqueeze(-3)  # (1, N_i, F)
-
-        diff = (out_poses_res - votes_res)**2  # (N_j, N_i, F)
-
-        acts_res = capsule_acts.unsqueeze(-1).unsqueeze(-3)
-
-        sum_acts = torch.sum(acts_res, -2)
+        pred_poses = multi_head_attention(q_tr, k_tr, v_tr, self.n_heads, presence, top_down=self.top_down_routing)  # (N_j, F)
 
-        cost_per_dim = torch.sum(diff*acts_res, -2) / (sum_acts + 1e-8)  # (N_j, F)
+        cost_per_dim = agreement_cost(pred_poses, v_tr, capsule_acts)  # (N_j, F)
 
         total_cost = torch.sum(cost_per_dim, -1) / (cost_per_dim.shape[-1]**0.5 + 1e-9)  # (N_j, )
 
@@ -0,0 +1,194 @@
+import io
+import os
+import sys
+import json
+import random
+import torch
+from torch.utils.data import IterableDataset
+from torchvision.datasets import Cityscapes
+from PIL import Image
+from dataloader import get_augmentation_params, process_images, format_sample
+from pipeline_stats import stage
+import config
+
+
+def get_index_path(shard_dir, split):
+    return os.path.join(shard_dir, '%s-index.json' % split)
+
+
+def write_shards(root, split, shard_dir, shard_size_mb=config.shard_size_mb):
+    """
+    Packs the leftImg8bit images and gtFine semantic and instance maps of a split into large sequential shard files.
+
+    Each shard is the concatenation of the encoded PNG files of its samples, in order. The index lists the shards and,
+    for every sample, the image name and the (offset, length) of its image, semantic and instance PNGs.
+
+    :param root: The Cityscapes root directory.
+    :param split: The split to be converted.
+    :param shard_dir: The output directory.
+    :param shard_size_mb: The approximate size of each shard.
+    """
+    dataset = Cityscapes(root, split=split, mode='fine', target_type=['semantic', 'instance'])
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    shards = []
+    shard_file = None
+    for i in range(len(dataset)):
+        if shard_file is None or shard_file.tell() >= shard_size_mb * 2 ** 20:
+            if shard_file is not None:
+                shard_file.close()
+
+            shard_name = '%s-%05d.shard' % (split, len(shards))
+            shard_file = open(os.path.join(shard_dir, shard_name), 'wb')
+            shards.append({'file': shard_name, 'samples': []})
+
+        sample = {'name': dataset.images[i]}
+        for key, file_name in zip(['image', 'semantic', 'instance'], [dataset.images[i]] + dataset.targets[i]):
+            with open(file_name, 'rb') as f:
+                data = f.read()
+
+            sample[key] = (shard_file.tell(), len(data))
+            shard_file.write(data)
+
+        shards[-1]['samples'].append(sample)
+
+        if (i + 1) % 100 == 0:
+            print('Packed %d/%d %s samples into %d shards' % (i + 1, len(dataset), split, len(shards)), flush=True)
+
+    if shard_file is not None:
+        shard_file.close()
+
+    with open(get_index_path(shard_dir, split), 'w') as f:
+        json.dump({'split': split, 'shards': shards}, f)
+
+
+class ShardedCityscapes(IterableDataset):
+    """
+    Streams Cityscapes samples from the shards written by write_shards, producing the same outputs as CustomCityscapes.
+
+    The samples of an epoch are read shard by shard. When shuffling, the shard order is shuffled every epoch (see
+    set_epoch) and the samples are drawn through a shuffle buffer, so that the reads stay close to sequential. This order
+    is computed from the index only, identically in every DataLoader worker, and its batches are dealt to the workers
+    round-robin, which is the order the DataLoader collects them in. The loader therefore yields exactly this order for any
+    number of workers, and every worker gets samples even with more workers than shards.
+
+    With infinite, the order continues with the next epoch when an epoch is exhausted, so that persistent workers never
+    need a new epoch. set_epoch(epoch, start_index) skips the first start_index samples of the epoch, which resumes a run.
+    """
+    def __init__(self, shard_dir, split, shuffle=None, shuffle_buffer=config.shuffle_buffer_size, seed=0, infinite=False, batch_size=1):
+        super(ShardedCityscapes, self).__init__()
+
+        self.shard_dir = shard_dir
+        self.split = split
+        self.shuffle = (split == 'train') if shuffle is None else shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.infinite = infinite
+        self.batch_size = batch_size  # the batch size of the DataLoader, the unit dealt to the workers
+        self.epoch = 0
+        self.start_index = 0
+
+        with open(get_index_path(shard_dir, split)) as f:
+            self.shards = json.load(f)['shards']
+
+    def __len__(self):
+        return sum(len(shard['samples']) for shard in self.shards)
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def get_epoch_order(self, epoch):
+        """
+        :return: The list of (shard, sample) of the epoch, in the order they are yielded.
+        """
+        shards = list(self.shards)
+        rng = random.Random(self.seed + epoch)
+        if self.shuffle:
+            rng.shuffle(shards)
+
+        samples = [(shard, sample) for shard in shards for sample in shard['samples']]
+        if not self.shuffle:
+            return samples
+
+        order, buffer = [], []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+
+            i = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            order.append(sample)
+
+        rng.shuffle(buffer)
+
+        return order + buffer
+
+    def get_worker_samples(self):
+        """
+        Yields the (shard, sample) of this worker, starting start_index samples into the epoch set by set_epoch. Sample
+        j after the start belongs to worker (j // batch_size) % num_workers.
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        if len(self) == 0:  # an infinite stream would never yield
+            raise ValueError('The %s split in %s has no samples' % (self.split, self.shard_dir))
+
+        epoch, start, j = self.epoch + self.start_index // len(self), self.start_index % len(self), 0
+        while True:
+            for sample in self.get_epoch_order(epoch)[start:]:
+                if (j // self.batch_size) % num_workers == worker_id:
+                    yield sample
+                j += 1
+
+            if not self.infinite:
+                break
+            epoch, start = epoch + 1, 0
+
+    def read_samples(self, samples):
+        f, file_name = None, None
+        try:
+            for shard, sample in samples:
+                if shard['file'] != file_name:
+                    if f is not None:
+                        f.close()
+                    file_name = shard['file']
+                    f = open(os.path.join(self.shard_dir, file_name), 'rb')
+
+                data = {}
+                for key in ['image', 'semantic', 'instance']:  # the files of each sample are stored in order
+                    offset, length = sample[key]
+                    f.seek(offset)
+                    data[key] = f.read(length)
+
+                yield sample['name'], data
+        finally:
+            if f is not None:
+                f.close()
+
+    def __iter__(self):
+        for sample in self.read_samples(self.get_worker_samples()):
+            yield self.decode_sample(*sample)
+
+    def decode_sample(self, img_name, data):
+        with stage('decode'):
+            image = Image.open(io.BytesIO(data['image'])).convert('RGB')
+            segmentation_maps = Image.open(io.BytesIO(data['semantic']))
+            instance_maps = Image.open(io.BytesIO(data['instance']))
+            segmentation_maps.load(), instance_maps.load()
+
+        augmentation = get_augmentation_params(image.size) if self.split == 'train' else None
+        sample = process_images(image, segmentation_maps, instance_maps, augmentation)
+
+        with stage('format'):
+            return format_sample(sample, img_name)
+
+
+if __name__ == '__main__':
+    # Usage: python shards.py [split ...]
+    for split in (sys.argv[1:] if len(sys.argv) > 1 else ['train', 'val']):
+        write_shards(config.data_dir, split, config.shard_dir)
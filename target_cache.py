@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+import config
+
+# Increase whenever the contents of a sample returned by CustomCityscapes.get_sample change
+CACHE_VERSION = 3
+
+# The config values which the cached samples depend on (see process_images, format_sample and CustomCityscapes.get_sample)
+CACHE_CONFIG = ['h', 'w', 'n_classes', 'point_list_scales', 'use_pyramid', 'pyramid_scales']
+
+
+class TargetCache(object):
+    """
+    An on-disk cache of decoded, resized images and their precomputed training targets.
+
+    Every sample is stored as a directory of .npy files, which are read back as read-only memory-mapped arrays. The key
+    of a sample covers the image name, the config values in CACHE_CONFIG, the augmentation parameters and the size and
+    modification time of the source files, so entries are invalidated when any of them change.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, img_name, source_files, aug_params=None):
+        sources = []
+        for file_name in source_files:
+            stat = os.stat(file_name)
+            sources.append((os.path.basename(file_name), stat.st_size, stat.st_mtime_ns))
+
+        config_values = {name: getattr(config, name) for name in CACHE_CONFIG}
+
+        key = json.dumps([CACHE_VERSION, os.path.basename(img_name), config_values, aug_params, sources], sort_keys=True)
+
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def load(self, key):
+        """
+
+        :param key: The key of the sample, obtained from get_key.
+        :return: A dictionary of memory-mapped arrays, or None if the sample is not cached.
+        """
+        path = self.get_path(key)
+        if not os.path.isdir(path):
+            return None
+
+        sample = {}
+        for file_name in os.listdir(path):
+            sample[file_name[:-4]] = np.load(os.path.join(path, file_name), mmap_mode='r')
+
+        return sample
+
+    def save(self, key, sample):
+        """
+
+        :param key: The key of the sample, obtained from get_key.
+        :param sample: A dictionary of numpy arrays.
+        """
+        path = self.get_path(key)
+        if os.path.isdir(path):
+            return
+
+        # Writes into a temporary directory first, so that other workers never read a partially written sample
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in sample.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:  # another worker has already cached this sample
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def build_cache(splits=('val', )):
+    from dataloader import CustomCityscapes
+
+    target_cache = TargetCache(config.target_cache_dir)
+
+    for split in splits:
+        dataset = CustomCityscapes(config.data_dir, split=split, mode='fine', target_type=['semantic', 'instance'], target_cache=target_cache)
+
+        for i in range(len(dataset)):
+            dataset[i]
+
+            if (i + 1) % 100 == 0:
+                print('Cached %d/%d %s samples' % (i + 1, len(dataset), split), flush=True)
+
+    print('Finished building the target cache in %s' % config.target_cache_dir)
+
+
+if __name__ == '__main__':
+    # Usage: python target_cache.py [split ...]
+    # Train samples use random augmentation, so only the deterministic splits are cached
+    build_cache(sys.argv[1:] if len(sys.argv) > 1 else ('val', ))
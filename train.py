@@ -4,10 +4,14 @@ import torch.nn.functional as F
 from torch.autograd.variable import Variable
 import numpy as np
 from dataloader import DataLoader, get_cityscapes_dataset, custom_collate
+from torch.utils.data import IterableDataset
+from samplers import InfiniteSampler, InstanceBalancedBatchSampler, load_instance_counts
+from pipeline_stats import PipelineStats
 import torch.nn as nn
 import torch.optim as optim
 from modelNew import CapsuleModel5, CapsuleModel6
 import os
+import time
 from losses import MarginLoss
 from focal import FocalLoss
 
@@ -17,20 +21,25 @@ def get_accuracy(y_pred, y):
     return torch.mean((y_argmax.long() == y.long()).type(torch.float))
 
 
-def train(model, data_loader, criterion1, criterion2, criterion3, criterion4, optimizer, iteration):
+def train(model, data_loader, criterion1, criterion2, criterion3, criterion4, optimizer, iteration, sampler=None, pipeline_stats=None):
     model.train()
 
     if config.use_cuda:
         model.cuda()
 
-    losses, accs = [], []
+    losses, accs, step_times = [], [], []
 
+    wait_start = time.perf_counter()
     for i, sample in enumerate(data_loader):
+        if pipeline_stats is not None:
+            pipeline_stats.record_wait(time.perf_counter() - wait_start)
+
+        if iteration >= config.n_iterations:  # the data loader is infinite
+            break
+
+        step_start = time.perf_counter()
+
         image, (y_gt_regression, y_gt_fgbg_seg, segmentation_weights), gt_class_list, gt_point_list, img_name = sample
-        image = Variable(image.type(torch.FloatTensor))
-        y_gt_regression = Variable(y_gt_regression.type(torch.FloatTensor))
-        y_gt_fgbg_seg = Variable(y_gt_fgbg_seg.type(torch.FloatTensor))
-        segmentation_weights = Variable(segmentation_weights.type(torch.FloatTensor))
 
         if config.use_cuda:
             image = image.cuda()
@@ -39,6 +48,12 @@ def train(model, data_loader, criterion1, criterion2, criterion3, criterion4, op
             segmentation_weights = segmentation_weights.cuda()
             gt_class_list = [i.cuda() if len(i) != 0 else [] for i in gt_class_list]
 
+        # targets arrive as int16/uint8 and are converted to float once they are on the device
+        image = image.float()
+        y_gt_regression = y_gt_regression.float()
+        y_gt_fgbg_seg = y_gt_fgbg_seg.float()
+        segmentation_weights = segmentation_weights.float()
+
         iteration += 1
         if config.poly_lr_scheduler:
             for param_group in optimizer.param_groups:
@@ -82,11 +97,14 @@ def train(model, data_loader, criterion1, criterion2, criterion3, criterion4, op
         optimizer.step()
         losses.append(loss.item())
         accs.append(acc.item())
+        step_times.append(time.perf_counter() - step_start)
 
         del image, y_gt_regression, y_gt_fgbg_seg, loss, acc, y_pred_fgbg_seg, y_pred_regression, segmentation_weights, gt_class_list, gt_point_list
 
         if (i + 1) % 10 == 0:
-            print('Finished training %d batches. Loss: %.4f. Accuracy: %.4f.' % (i + 1, float(np.mean(losses)), float(np.mean(accs))), flush=True)
+            print('Finished training %d batches. Loss: %.4f. Accuracy: %.4f. Step time: %.3fs (std %.3fs, max %.3fs).'
+                  % (i + 1, float(np.mean(losses)), float(np.mean(accs)), float(np.mean(step_times[-10:])), float(np.std(step_times[-10:])),
+                     float(np.max(step_times[-10:]))), flush=True)
 
         if iteration % config.save_every_n_iters == 0:
             print('Model Saving.')
@@ -97,6 +115,8 @@ def train(model, data_loader, criterion1, criterion2, criterion3, criterion4, op
                 'state_dict': model.state_dict(),
                 'optimizer': optimizer.state_dict()
             }
+            if sampler is not None:
+                states['sampler'] = sampler.state_dict((i + 1) * config.batch_size)
             try:
                 os.mkdir(config.save_dir)
             except:
@@ -104,6 +124,11 @@ def train(model, data_loader, criterion1, criterion2, criterion3, criterion4, op
             torch.save(states, save_file_path)
             print('Model saved ', str(save_file_path))
 
+        if pipeline_stats is not None:
+            pipeline_stats.log(iteration)
+
+        wait_start = time.perf_counter()
+
     print('Finished training %d iterations. Loss: %.4f. Accuracy: %.4f.' % (iteration, float(np.mean(losses)), float(np.mean(accs))))
 
     return float(np.mean(losses)), float(np.mean(accs)), iteration
@@ -133,15 +158,48 @@ def run_experiment():
             exit()
 
         print('Loaded from: ', save_file_path)
-        saved_weights = torch.load(save_file_path)['state_dict']
-        model.load_state_dict(saved_weights)
-        saved_weights.clear()
-
-    iteration = config.start_iteration
-    while iteration < config.n_iterations:
-        tr_dataloader = DataLoader(tr_dataset, batch_size=config.batch_size, shuffle=True, num_workers=config.num_workers, collate_fn=custom_collate)
-
-        losses, _, iteration = train(model, tr_dataloader, criterion1, criterion2, criterion3, criterion4, optimizer, iteration)
+        saved_states = torch.load(save_file_path)
+        model.load_state_dict(saved_states['state_dict'])
+        sampler_state = saved_states.get('sampler')
+        saved_states.clear()
+    else:
+        sampler_state = None
+
+    pipeline_stats = PipelineStats() if config.profile_pipeline else None
+    worker_init_fn = pipeline_stats.init_worker if pipeline_stats is not None else None
+
+    # The data loader is created once and streams batches until n_iterations, so the workers are never restarted
+    start_index = config.start_iteration * config.batch_size
+    if isinstance(tr_dataset, IterableDataset):  # streamed datasets shuffle their shards themselves
+        tr_dataset.infinite = True
+        tr_dataset.set_epoch(start_index // len(tr_dataset), start_index % len(tr_dataset))  # skips the samples already trained on
+        tr_sampler = None
+        tr_dataloader = DataLoader(tr_dataset, batch_size=config.batch_size, num_workers=config.num_workers, collate_fn=custom_collate,
+                                   persistent_workers=config.num_workers > 0, worker_init_fn=worker_init_fn)
+    else:
+        if config.balance_instances:
+            instance_counts = load_instance_counts(tr_dataset, config.instance_index_file)
+            tr_sampler = InstanceBalancedBatchSampler(instance_counts, config.batch_size, config.balance_window_batches, seed=config.sampler_seed,
+                                                      start_index=start_index)
+        else:
+            tr_sampler = InfiniteSampler(len(tr_dataset), shuffle=True, seed=config.sampler_seed, start_index=start_index)
+        if sampler_state is not None:
+            tr_sampler.load_state_dict(sampler_state)
+
+        # seeds the random augmentation of the workers from the resume position
+        generator = torch.Generator()
+        generator.manual_seed(tr_sampler.seed + tr_sampler.start_index)
+
+        if config.balance_instances:
+            sampler_args = {'batch_sampler': tr_sampler}
+        else:
+            sampler_args = {'batch_size': config.batch_size, 'sampler': tr_sampler}
+
+        tr_dataloader = DataLoader(tr_dataset, num_workers=config.num_workers, collate_fn=custom_collate, persistent_workers=config.num_workers > 0,
+                                   generator=generator, worker_init_fn=worker_init_fn, **sampler_args)
+
+    losses, _, iteration = train(model, tr_dataloader, criterion1, criterion2, criterion3, criterion4, optimizer, config.start_iteration, tr_sampler,
+                             pipeline_stats)
 
     print('Training Finished')
 